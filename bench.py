@@ -0,0 +1,2257 @@
+# -*- coding: utf-8 -*-
+"""
+A JEWEL STUDIO — Benchmarks
+
+Usage:  python bench.py <name> [options]
+
+  overhead   cost of the metrics timing layer per message
+  replay     replay webhook payloads against local upstream stubs
+  batch      100-message multi-entry deliveries, serial vs per-phone parallel
+  statuses   delivery/read status callback throughput (target 1k events/s)
+  catalog    catalog registry load + hot-reload swap at 10k collections
+  startup    gunicorn cold start → first 200 from /health
+  text       single-pass text analyser vs the old per-message scans
+  search     fuzzy_search precision, recall and Aru fall-through per scorer × threshold
+  analytics  event emit cost, bounded queue + drop counts under a burst
+  tenants    memory of N tenants in one process vs N deployments
+  customers  Shopify customer index: bulk load, lookups, polling, webhooks
+  phones     canon_phone cost, dedup-sheets on a messy sheet, wa_id lookup agreement
+  budget     per-message latency with slow upstreams, time budget off vs on
+  breakers   latency through a Shopify/Sheets/Gemini outage, breakers off vs on
+  orders     order ledger at 1M orders: writes, reference lookups, payment webhooks
+  campaign   100k-recipient template campaign, killed mid-run and resumed
+  prefetch   collection-open latency with no product cache, cache only, cache + prefetch
+  cluster    several gunicorn nodes: phone ownership, forwarding cost, leave/crash/join
+  workers    gunicorn sync vs gthread under hundreds of concurrent webhooks
+  profile    /admin/profile: overhead while sampling, collapsed output, CPU vs wait
+  overload   traffic spike past capacity: admission control and load shedding off vs on
+  media      custom-order images: inline Graph URL + email vs background media store
+"""
+
+import os, sys, re, json, time, random, logging, argparse, statistics, itertools, tempfile
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# Never talk to real upstreams from a benchmark.
+for _k in ('WHATSAPP_TOKEN', 'SHOPIFY_ACCESS_TOKEN', 'GOOGLE_SERVICE_ACCOUNT_KEY',
+           'RAZORPAY_KEY_ID', 'GEMINI_API_KEY', 'GMAIL_USER'):
+    os.environ.pop(_k, None)
+
+main = None
+
+def _load(stubs=None):
+    """Import main.py, wired to the given stubs. Must run before any other use of main."""
+    global main
+    if stubs is not None:
+        os.environ.update(stubs.env())
+    os.environ.setdefault('ANALYTICS_DIR', tempfile.mkdtemp(prefix='bench-analytics-'))
+    os.environ.setdefault('ORDERS_DB', os.path.join(tempfile.mkdtemp(prefix='bench-orders-'), 'orders.db'))
+    # Replayed traffic outruns Meta's per-number send rate; measure the bot, not the cap.
+    os.environ.setdefault('TENANT_SEND_RATE', '0')
+    import main as m
+    main = m
+    logging.getLogger('main').setLevel(logging.WARNING)
+    if stubs is not None:
+        stubs.attach(main)
+    return main
+
+def _kv(text: str) -> dict:
+    """'graph=0.05,shopify=0.2' → {'graph': 0.05, 'shopify': 0.2}"""
+    out = {}
+    for part in filter(None, (text or '').split(',')):
+        k, v = part.split('=')
+        out[k.strip()] = float(v)
+    return out
+
+def _pct(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+# ─────────────────────────────────────────────────────────────
+# OVERHEAD
+# One message = handle() + the timed calls a typical text message
+# makes (customer_status, 2 lookups, fuzzy, aru, 3 posts, 2 sleeps).
+# ─────────────────────────────────────────────────────────────
+
+_CALLS_PER_MSG = 10
+
+def bench_overhead(args):
+    _load()
+
+    def noop(*a, **k):
+        return True
+    wrapped = main.timed('bench_noop', ok=bool)(noop)
+
+    def plain_msg():
+        for _ in range(_CALLS_PER_MSG):
+            noop()
+
+    def timed_msg():
+        for _ in range(_CALLS_PER_MSG):
+            wrapped()
+
+    def run(fn):
+        best = float('inf')
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            for _ in range(args.n):
+                main._call('handle', 'bench', fn)
+            best = min(best, (time.perf_counter() - t0) / args.n)
+        return best
+
+    def run_plain():
+        best = float('inf')
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            for _ in range(args.n):
+                plain_msg()
+            best = min(best, (time.perf_counter() - t0) / args.n)
+        return best
+
+    base = run_plain()
+    inst = run(timed_msg)
+    over = (inst - base) * 1e6
+    print(f"calls/message      : {_CALLS_PER_MSG + 1}")
+    print(f"uninstrumented     : {base * 1e6:8.2f} µs/message")
+    print(f"instrumented       : {inst * 1e6:8.2f} µs/message")
+    print(f"overhead           : {over:8.2f} µs/message  (budget 50 µs)")
+    print("render /metrics    : "
+          f"{statistics.median(_time(main.render_metrics, 50)) * 1e6:8.1f} µs")
+    return 0 if over < 50 else 1
+
+def _time(fn, n: int) -> list:
+    out = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        out.append(time.perf_counter() - t0)
+    return out
+
+# ─────────────────────────────────────────────────────────────
+# PAYLOADS
+# Synthetic Meta webhook deliveries, or recorded ones from a JSONL file
+# (one webhook POST body per line).
+# ─────────────────────────────────────────────────────────────
+
+PHONE_ID = '100000000000001'
+
+_TEXTS = [
+    'hi', 'menu', 'hello', 'jhumka dikhao', 'mens kada', 'chandbali',
+    'timing kya hai', 'about your studio', 'track my order',
+    'mujhe shaadi ke liye kuch accha chahiye', 'do you have light weight daily wear',
+    'AJS-3211-1700000000', 'referral code', 'english please',
+]
+_BUTTONS = ['W_FACE', 'W_HAND', 'W_NECK', 'W_LOWER', 'F_EARRINGS', 'F_NOSE',
+            'F_HEAD', 'H_BANGLES', 'H_RINGS', 'S_WATCHES', 'S_ACCSS']
+_LISTS   = ['ACT_CATALOGS', 'CAT_BABY', 'CAT_WOMEN', 'CAT_MEN', 'CAT_STUDIO',
+            'M_RINGS', 'M_CHAINS', 'M_ACCESSORIES']
+_MIX     = {'text': 40, 'list_reply': 25, 'button_reply': 20, 'image': 8, 'order': 7}
+
+_ids = itertools.count(1)
+
+def envelope(messages: list, phone_id: str = PHONE_ID) -> dict:
+    return {'object': 'whatsapp_business_account', 'entry': [{
+        'id': 'WABA', 'changes': [{'field': 'messages', 'value': {
+            'messaging_product': 'whatsapp',
+            'metadata': {'display_phone_number': '918141356990', 'phone_number_id': phone_id},
+            'contacts': [{'profile': {'name': 'Bench'}, 'wa_id': m['from']} for m in messages],
+            'messages': messages,
+        }}]}]}
+
+def synth_message(kind: str, phone: str, rnd: random.Random) -> dict:
+    m = {'from': phone, 'id': f"wamid.BENCH{next(_ids):010d}",
+         'timestamp': str(int(time.time())), 'type': kind}
+    if kind == 'text':
+        m['text'] = {'body': rnd.choice(_TEXTS)}
+    elif kind == 'list_reply':
+        lid = rnd.choice(_LISTS + [f"C_{cid}" for cid in rnd.sample(list(main._catalog['id_to_name']), 4)])
+        m.update(type='interactive', interactive={'type': 'list_reply',
+                 'list_reply': {'id': lid, 'title': lid}})
+    elif kind == 'button_reply':
+        bid = rnd.choice(_BUTTONS)
+        m.update(type='interactive', interactive={'type': 'button_reply',
+                 'button_reply': {'id': bid, 'title': bid}})
+    elif kind == 'image':
+        m['image'] = {'id': f"{rnd.randrange(10**15)}", 'mime_type': 'image/jpeg'}
+    elif kind == 'order':
+        m['order'] = {'catalog_id': 'stub-catalog', 'product_items': [
+            {'product_retailer_id': f"SKU{rnd.randrange(999)}", 'quantity': rnd.randint(1, 2),
+             'item_price': rnd.choice([1499, 2999, 8999]), 'currency': 'INR'}
+            for _ in range(rnd.randint(1, 3))]}
+    return m
+
+def synth_phones(n: int, rnd: random.Random) -> list:
+    return [f"9198{rnd.randrange(10**8):08d}" for _ in range(n)]
+
+def synth_payloads(n: int, phones: list, rnd: random.Random, mix: dict = None,
+                   phone_id: str = PHONE_ID) -> list:
+    mix   = mix or _MIX
+    kinds = rnd.choices(list(mix), weights=list(mix.values()), k=n)
+    return [envelope([synth_message(k, rnd.choice(phones), rnd)], phone_id) for k in kinds]
+
+def load_payloads(path: str) -> list:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def msg_kind(m: dict) -> str:
+    if m.get('type') == 'interactive':
+        return m.get('interactive', {}).get('type', 'interactive')
+    return m.get('type') or 'unknown'
+
+def payload_kind(body: dict) -> str:
+    for e in body.get('entry', []):
+        for c in e.get('changes', []):
+            for m in c.get('value', {}).get('messages', []):
+                return msg_kind(m)
+    return 'status'
+
+def seed_customers(stubs, payloads: list):
+    """Register every sender with the Shopify stub, so the customer index knows them."""
+    stubs.shopify.seed({m.get('from', '')
+                        for body in payloads
+                        for e in body.get('entry', [])
+                        for c in e.get('changes', [])
+                        for m in c.get('value', {}).get('messages', [])})
+
+def _reid(body: dict, suffix: str) -> dict:
+    """Copy of a recorded payload with fresh message ids, so dedup doesn't skip replays."""
+    body = json.loads(json.dumps(body))
+    for e in body.get('entry', []):
+        for c in e.get('changes', []):
+            for m in c.get('value', {}).get('messages', []):
+                m['id'] = f"{m.get('id', 'wamid')}.{suffix}"
+    return body
+
+# ─────────────────────────────────────────────────────────────
+# REPLAY
+# ─────────────────────────────────────────────────────────────
+
+def _post_all(payloads: list, concurrency: int) -> list:
+    """POST every payload to /webhook; returns [(kind, seconds, status)]."""
+    def one(body):
+        kind = payload_kind(body)
+        t0   = time.perf_counter()
+        r    = main.app.test_client().post('/webhook', json=body)
+        return kind, time.perf_counter() - t0, r.status_code
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        return list(ex.map(one, payloads))
+
+def _no_pacing():
+    main._p = main.timed('_p')(lambda t=0.4: None)
+
+def bench_replay(args):
+    from stubs import Stubs
+    stubs = Stubs(latency=_kv(args.latency), errors=_kv(args.errors)).start()
+    _load(stubs)
+    if not args.pace:
+        _no_pacing()
+    rnd = random.Random(args.seed)
+
+    total = args.warmup + args.n
+    if args.payloads:
+        recorded = load_payloads(args.payloads)
+        payloads = [_reid(recorded[i % len(recorded)], f"r{i}") for i in range(total)]
+    else:
+        payloads = synth_payloads(total, synth_phones(args.phones, rnd), rnd)
+    seed_customers(stubs, payloads)
+    warmup, payloads = payloads[:args.warmup], payloads[args.warmup:]
+
+    _post_all(warmup, args.concurrency)
+    calls0 = stubs.calls()
+    t0     = time.perf_counter()
+    res    = _post_all(payloads, args.concurrency)
+    wall   = time.perf_counter() - t0
+    calls  = {k: v - calls0[k] for k, v in stubs.calls().items()}
+    stubs.stop()
+
+    report = _report(res, wall, calls, args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            _compare(report, json.load(f))
+    return 0 if all(st == 200 for _, _, st in res) else 1
+
+def _report(res: list, wall: float, calls: dict, args) -> dict:
+    by_kind = defaultdict(list)
+    for kind, dt, _ in res:
+        by_kind[kind].append(dt)
+    n = len(res)
+    report = {
+        'messages':     n,
+        'seconds':      round(wall, 3),
+        'msgs_per_sec': round(n / wall, 2) if wall else 0,
+        'concurrency':  args.concurrency,
+        'paced':        args.pace,
+        'types':        {k: {'n':   len(v),
+                             'p50': round(_pct(v, .50) * 1000, 2),
+                             'p95': round(_pct(v, .95) * 1000, 2),
+                             'p99': round(_pct(v, .99) * 1000, 2)}
+                         for k, v in sorted(by_kind.items())},
+        'calls_per_msg': {k: round(v / n, 3) for k, v in calls.items()} if n else {},
+    }
+    print(f"messages      : {n} in {wall:.2f} s → {report['msgs_per_sec']} msg/s "
+          f"(concurrency {args.concurrency}, pacing {'on' if args.pace else 'off'})")
+    print(f"{'type':<14}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for k, t in report['types'].items():
+        print(f"{k:<14}{t['n']:>6}{t['p50']:>10.1f}{t['p95']:>10.1f}{t['p99']:>10.1f}")
+    cpm = report['calls_per_msg']
+    print("calls/message : " + '  '.join(f"{k} {v:.2f}" for k, v in cpm.items())
+          + f"  | total {sum(cpm.values()):.2f}")
+    return report
+
+def _compare(now: dict, base: dict):
+    def d(a, b):
+        return f"{(a - b) / b * 100:+.1f}%" if b else 'n/a'
+    print(f"vs baseline   : msg/s {d(now['msgs_per_sec'], base['msgs_per_sec'])}")
+    for k, t in now['types'].items():
+        b = base.get('types', {}).get(k)
+        if b:
+            print(f"  {k:<12} p50 {d(t['p50'], b['p50'])}  p95 {d(t['p95'], b['p95'])}"
+                  f"  p99 {d(t['p99'], b['p99'])}")
+    print(f"  calls/msg    {d(sum(now['calls_per_msg'].values()), sum(base['calls_per_msg'].values()))}")
+
+# ─────────────────────────────────────────────────────────────
+# BATCH
+# Deliveries of --size messages from --senders phones, spread over
+# several entries and changes the way Meta batches at high volume.
+# ─────────────────────────────────────────────────────────────
+
+def batch_delivery(size: int, senders: int, rnd: random.Random, entries: int = 4) -> dict:
+    phones = synth_phones(senders, rnd)
+    kinds  = rnd.choices(list(_MIX), weights=list(_MIX.values()), k=size)
+    msgs   = [synth_message(k, rnd.choice(phones), rnd) for k in kinds]
+    body   = {'object': 'whatsapp_business_account', 'entry': []}
+    step   = -(-size // (entries * 2))
+    for i in range(0, size, step):
+        chunk = envelope(msgs[i:i + step])['entry'][0]
+        if len(body['entry']) < entries:
+            body['entry'].append(chunk)
+        else:
+            body['entry'][len(body['entry']) - 1]['changes'] += chunk['changes']
+    return body
+
+def _handled() -> int:
+    return sum(st[0] for (fam, _), st in list(main._metrics.items()) if fam == 'handle')
+
+def _calls(name: str) -> int:
+    st = main._metrics.get(('call', name))
+    return st[0] if st else 0
+
+def bench_batch(args):
+    from stubs import Stubs
+    stubs = Stubs(latency=_kv(args.latency)).start()
+    _load(stubs)
+    _no_pacing()
+    rnd = random.Random(args.seed)
+
+    print(f"delivery: {args.size} messages, {args.senders} senders, "
+          f"upstream latency {args.latency or 'none'}")
+    print(f"{'mode':<10}{'deliveries':>11}{'p50 ms':>10}{'p95 ms':>10}{'msg/s':>9}"
+          f"{'handled':>9}{'profile lookups':>17}")
+    rc, runs = 0, {}
+    for mode in ('serial', 'parallel'):
+        runs[mode] = [batch_delivery(args.size, args.senders, rnd) for _ in range(args.deliveries)]
+        seed_customers(stubs, runs[mode])
+    for mode, workers in (('serial', 1), ('parallel', args.workers)):
+        main._pool = ThreadPoolExecutor(max_workers=workers)
+        bodies = runs[mode]
+        h0, c0 = _handled(), _calls('customer_status')
+        times  = []
+        for body in bodies:
+            t0 = time.perf_counter()
+            main.app.test_client().post('/webhook', json=body)
+            times.append(time.perf_counter() - t0)
+        handled, lookups = _handled() - h0, _calls('customer_status') - c0
+        total = args.size * args.deliveries
+        rc |= handled != total
+        print(f"{mode:<10}{args.deliveries:>11}{_pct(times, .5) * 1000:>10.0f}"
+              f"{_pct(times, .95) * 1000:>10.0f}{total / sum(times):>9.1f}"
+              f"{handled:>9}{lookups:>17}")
+    stubs.stop()
+    return rc
+
+# ─────────────────────────────────────────────────────────────
+# STATUSES
+# sent → delivered → read callbacks for --messages tracked sends, with
+# --fail of them failing retryably, posted --per-post per webhook.
+# ─────────────────────────────────────────────────────────────
+
+def status_envelope(statuses: list, phone_id: str = PHONE_ID) -> dict:
+    return {'object': 'whatsapp_business_account', 'entry': [{
+        'id': 'WABA', 'changes': [{'field': 'messages', 'value': {
+            'messaging_product': 'whatsapp',
+            'metadata': {'display_phone_number': '918141356990', 'phone_number_id': phone_id},
+            'statuses': statuses,
+        }}]}]}
+
+def bench_statuses(args):
+    from stubs import Stubs
+    stubs = Stubs().start()
+    _load(stubs)
+    rnd, now = random.Random(args.seed), time.time()
+
+    events = []
+    for i in range(args.messages):
+        wamid, to = f"wamid.ST{i:010d}", f"9198{i:08d}"
+        main._remember_sent({'messages': [{'id': wamid}]},
+                            {'messaging_product': 'whatsapp', 'to': to,
+                             'type': 'text', 'text': {'body': 'hi'}})
+        base = {'id': wamid, 'recipient_id': to}
+        events.append({**base, 'status': 'sent', 'timestamp': str(int(now))})
+        if rnd.random() < args.fail:
+            events.append({**base, 'status': 'failed', 'timestamp': str(int(now) + 1),
+                           'errors': [{'code': 131000, 'title': 'Something went wrong'}]})
+            continue
+        events.append({**base, 'status': 'delivered', 'timestamp': str(int(now) + rnd.randint(1, 4))})
+        events.append({**base, 'status': 'read', 'timestamp': str(int(now) + rnd.randint(5, 60))})
+
+    bodies = [status_envelope(events[i:i + args.per_post])
+              for i in range(0, len(events), args.per_post)]
+    client, times = main.app.test_client(), []
+    t0 = time.perf_counter()
+    for body in bodies:
+        t1 = time.perf_counter()
+        client.post('/webhook', json=body)
+        times.append(time.perf_counter() - t1)
+    wall = time.perf_counter() - t0
+    rate = len(events) / wall
+
+    d = main.delivery_stats()
+    print(f"events        : {len(events)} in {len(bodies)} POSTs ({args.per_post}/POST)")
+    print(f"throughput    : {rate:,.0f} events/s  (target 1,000)")
+    print(f"per POST      : p50 {_pct(times, .5) * 1000:.2f} ms  p99 {_pct(times, .99) * 1000:.2f} ms")
+    print(f"failure rate  : {d['failure_rate']:.2%}   retry queue {d['retry_queue']}")
+    st = main._metrics.get(('delivery', 'delivered'))
+    if st:
+        print(f"delivery lat. : mean {st[3] / st[0]:.2f} s over {st[0]} messages")
+    stubs.stop()
+    return 0 if rate >= 1000 else 1
+
+# ─────────────────────────────────────────────────────────────
+# CATALOG
+# ─────────────────────────────────────────────────────────────
+
+_WORDS = ['Gold', 'Silver', 'Diamond', 'Bridal', 'Classic', 'Modern', 'Temple',
+          'Kundan', 'Polki', 'Pearl', 'Ruby', 'Emerald', 'Antique', 'Daily']
+_TYPES = ['Jhumka', 'Studs', 'Hoops', 'Chains', 'Kada', 'Bangles', 'Rings',
+          'Pendants', 'Anklets', 'Chokers', 'Nath', 'Tikka', 'Cufflinks', 'Watches']
+
+def synth_catalog(n: int, version: int, rnd: random.Random) -> dict:
+    menus, i = {}, 0
+    while i < n:
+        rows = {}
+        for _ in range(min(10, n - i)):
+            rows[f"{rnd.choice(_WORDS)} {rnd.choice(_TYPES)} {i}"] = str(26 * 10**15 + i)
+            i += 1
+        mid = f"G_{len(menus):05d}"
+        menus[mid] = {'header': f"Group {len(menus)}", 'prompt': 'collection',
+                      'sections': [{'title': f"Group {len(menus)}", 'collections': rows}]}
+    return {'version': version, 'menus': menus}
+
+def bench_catalog(args):
+    _load()
+    rnd  = random.Random(args.seed)
+    path = os.path.join(tempfile.mkdtemp(), 'catalog.json')
+    with open(path, 'w') as f:
+        json.dump(synth_catalog(args.collections, 2, rnd), f)
+    size = os.path.getsize(path)
+
+    loads = _time(lambda: main.load_catalog(path), args.repeat)
+    print(f"catalog file  : {args.collections} collections, {size / 1024:.0f} KiB")
+    print(f"load + build  : p50 {_pct(loads, .5) * 1000:.1f} ms  max {max(loads) * 1000:.1f} ms")
+
+    # Hot reload while a reader keeps searching: the swap must not stall it.
+    main.CATALOG_FILE, main.CATALOG_POLL = path, 0.0
+    main._catalog = main.load_catalog(path)
+    stop, lat = [False], []
+    def reader():
+        while not stop[0]:
+            t0 = time.perf_counter()
+            main.fuzzy_search('gold jhumka')
+            lat.append(time.perf_counter() - t0)
+    th = __import__('threading').Thread(target=reader)
+    th.start()
+    time.sleep(0.3)
+    before = len(lat)
+    with open(path, 'w') as f:
+        json.dump(synth_catalog(args.collections, 3, rnd), f)
+    os.utime(path, (time.time() + 1, time.time() + 1))
+    t0 = time.perf_counter()
+    main.catalog_watch()
+    while main._catalog['version'] != 3 and time.perf_counter() - t0 < 30:
+        time.sleep(0.001)
+    swap = time.perf_counter() - t0
+    time.sleep(0.3)
+    stop[0] = True
+    th.join()
+    base, during = lat[:before], lat[before:]
+    print(f"hot reload    : v2 → v{main._catalog['version']} visible after {swap * 1000:.1f} ms")
+    print(f"fuzzy search  : p50 {_pct(base, .5) * 1000:.2f} ms before, "
+          f"p99 {_pct(during, .99) * 1000:.2f} ms / max {max(during) * 1000:.2f} ms during reload")
+    return 0 if main._catalog['version'] == 3 else 1
+
+# ─────────────────────────────────────────────────────────────
+# TEXT
+# analyse_text() against the three separate scans it replaced
+# (update_lang + detect_kw + is_design_desc), over corpus/messages.txt.
+# ─────────────────────────────────────────────────────────────
+
+_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus', 'messages.txt')
+
+def load_corpus(path: str) -> list:
+    with open(path, encoding='utf-8') as f:
+        return [l.strip() for l in f if l.strip() and not l.startswith('#')]
+
+def _legacy_text(text: str) -> dict:
+    import re
+    tl, lang = text.lower(), None
+    if any(p in tl for p in main._EN_REQUEST):
+        lang = 'en'
+    elif set(tl.split()) & main._HI_WORDS:
+        lang = 'hi'
+    elif len(re.findall(r'[\u0900-\u097F]', text)) > 0:
+        lang = 'hi'
+    words, intent = set(tl.split()), None
+    for ktype, kwords in main._KW.items():
+        if words & kwords:
+            intent = ktype
+            break
+    design = bool(set(re.findall(r'\w+', tl)) & main._DESIGN_WORDS)
+    return {'lang': lang, 'intent': intent, 'design': design}
+
+def bench_text(args):
+    _load()
+    texts = load_corpus(args.corpus)
+
+    def run(fn):
+        best = float('inf')
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            for _ in range(args.rounds):
+                for t in texts:
+                    fn(t)
+            best = min(best, (time.perf_counter() - t0) / (args.rounds * len(texts)))
+        return best
+
+    old, new = run(_legacy_text), run(main.analyse_text)
+    print(f"corpus        : {len(texts)} messages ({args.corpus})")
+    print(f"three scans   : {old * 1e6:6.2f} µs/message")
+    print(f"analyse_text  : {new * 1e6:6.2f} µs/message  ({old / new:.1f}x)")
+
+    diff = []
+    for t in texts:
+        a, b = _legacy_text(t), main.analyse_text(t)
+        for k in ('lang', 'intent', 'design'):
+            if a[k] != b[k]:
+                diff.append((t, k, a[k], b[k]))
+    print(f"differences   : {len(diff)}")
+    for t, k, a, b in diff[:args.show]:
+        print(f"  {k:<6} {a!s:>8} → {b!s:<8} {t!r}")
+    return 0
+
+# ─────────────────────────────────────────────────────────────
+# SEARCH
+# fuzzy_search() against corpus/search.tsv: labelled Hinglish and
+# English queries, misspellings, and questions that no collection
+# answers. Queries a keyword intent or an AJS- reference catches
+# first never reach the search and are left out. Per scorer, with and
+# without normalising case: precision (opened collections that were
+# right), recall (labelled queries that opened a right one), the
+# share falling through to Aru/Gemini, and µs per query, at each
+# threshold. Expected cost per query = search + fall-through × --aru-ms.
+# ─────────────────────────────────────────────────────────────
+
+_SEARCH_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus', 'search.tsv')
+
+def load_search_corpus(path: str) -> list:
+    """[(query, {acceptable collection ids} — empty when Aru should answer)]"""
+    rows = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            query, ids = line.rstrip('\n').split('\t')[:2]
+            rows.append((query, set() if ids.strip() == '-' else set(ids.split('|'))))
+    return rows
+
+def _searched(text: str) -> bool:
+    """Would handle() run fuzzy_search on this text?"""
+    return not main.analyse_text(text)['intent'] and not re.match(r'AJS-[A-Z0-9]+-\d+', text.upper())
+
+def _score_all(rows: list, scorer: str, normalize: bool, repeat: int) -> list:
+    """[(expected ids, best match id, score, µs)] — best of `repeat` timings."""
+    out = []
+    for query, want in rows:
+        best = float('inf')
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            r  = main.fuzzy_search(query, scorer, 0, normalize)
+            best = min(best, time.perf_counter() - t0)
+        out.append((want, r.get('id'), r.get('score', 0.0), best * 1e6))
+    return out
+
+def _at(scored: list, threshold: float) -> dict:
+    pos    = sum(1 for want, *_ in scored if want)
+    found  = [(want, cid) for want, cid, score, _ in scored if score >= threshold]
+    right  = sum(1 for want, cid in found if cid in want)
+    p, r   = right / max(len(found), 1), right / max(pos, 1)
+    return {'threshold': threshold, 'precision': p, 'recall': r, 'f1': 2 * p * r / max(p + r, 1e-9),
+            'aru': 1 - len(found) / len(scored), 'wrong': len(found) - right}
+
+def bench_search(args):
+    _load()
+    rows   = load_search_corpus(args.corpus)
+    kept   = [row for row in rows if _searched(row[0])]
+    known  = set(main._catalog['id_to_name'])
+    stale  = {cid for _, want in rows for cid in want} - known
+    print(f"corpus        : {len(rows)} queries ({sum(1 for _, w in rows if w)} labelled, "
+          f"{sum(1 for _, w in rows if not w)} for Aru), {len(rows) - len(kept)} caught by a keyword intent first")
+    if stale:
+        print(f"  labels not in the catalog: {sorted(stale)}")
+    thresholds = [float(t) for t in range(args.lo, args.hi + 1, args.step)]
+    current    = (main.FUZZY_SCORER, main.FUZZY_NORMALIZE, main.FUZZY_THRESHOLD)
+    head = (f"{'scorer':<25} {'case':<7} {'thr':>4}  {'prec':>5}  {'recall':>6}  {'→ Aru':>5}  {'wrong':>5}  "
+            f"{'p50 µs':>6}  {'p99 µs':>6}  {'ms/query':>8}")
+    print(head)
+    results = {}
+    for scorer in args.scorers:
+        for norm in (False, True):
+            scored = _score_all(kept, scorer, norm, args.repeat)
+            us     = [u for *_, u in scored]
+            sweep  = [_at(scored, t) for t in sorted(set(thresholds) | ({current[2]} if (scorer, norm) == current[:2] else set()))]
+            results[(scorer, norm)] = (scored, sweep)
+            best   = max(sweep, key=lambda m: (round(m['f1'], 3), -m['aru']))
+            show   = [best]
+            if (scorer, norm) == current[:2]:
+                show = sweep if args.sweep else [m for m in sweep if m['threshold'] in (current[2], best['threshold'])]
+            for m in show:
+                mark = '*' if (scorer, norm, m['threshold']) == current else ' '
+                print(f"{scorer:<25} {'lower' if norm else 'as-is':<7} {m['threshold']:>3.0f}{mark}  "
+                      f"{m['precision']:5.2f}  {m['recall']:6.2f}  {m['aru']:5.0%}  {m['wrong']:5d}  "
+                      f"{_pct(us, .5):6.1f}  {_pct(us, .99):6.1f}  "
+                      f"{(_pct(us, .5) / 1000 + m['aru'] * args.aru_ms):8.0f}")
+    print("* = current setting; other rows are each scorer's best threshold by F1")
+
+    # Misses of the current setting
+    scored, _ = results.get(current[:2], (None, None))
+    if scored and args.show:
+        print(f"misses at the current setting (first {args.show}):")
+        shown = 0
+        for (query, want), (_, cid, score, _) in zip(kept, scored):
+            ok = (score >= current[2] and cid in want) or (score < current[2] and not want)
+            if not ok and shown < args.show:
+                got = main._catalog['id_to_name'].get(cid, '') if score >= current[2] else '→ Aru'
+                print(f"  {query!r:<36} {score:5.1f}  got {got!r:<22} want "
+                      f"{', '.join(main._catalog['id_to_name'].get(w, w) for w in sorted(want)) or 'Aru'}")
+                shown += 1
+    return 0
+
+# ─────────────────────────────────────────────────────────────
+# ANALYTICS
+# Request-path cost of emit(), and a burst far faster than the
+# writer can drain: memory stays bounded, overflow is counted.
+# ─────────────────────────────────────────────────────────────
+
+def _event(i: int, rnd: random.Random) -> dict:
+    ev = {'ts': time.time(), 'user': f"{i % 5000:016x}", 'type': 'text', 'lang': 'hi',
+          'status': 'retail', 'route': rnd.choice(['kw:greet', 'CAT_WOMEN', 'C_', None]),
+          'fuzzy_score': rnd.random() * 100, 'aru': rnd.random() < 0.2, 'ms': rnd.random() * 500}
+    if rnd.random() < 0.3:
+        ev['collection_id'], ev['collection'] = str(26 * 10**15 + i % 80), f"Collection {i % 80}"
+    if rnd.random() < 0.02:
+        ev['order_total'], ev['order_items'] = round(rnd.uniform(500, 50000), 2), 1
+    return ev
+
+def _acount(label: str) -> int:
+    return main._counts.get(('analytics', label), 0)
+
+def bench_analytics(args):
+    _load()
+    import manage
+    rnd = random.Random(args.seed)
+    main.ANALYTICS_QUEUE, main.ANALYTICS_BATCH = args.queue, args.batch
+
+    evs = [_event(i, rnd) for i in range(args.n)]
+    lat, peak = [], 0
+    t0 = time.perf_counter()
+    for ev in evs:
+        t1 = time.perf_counter()
+        main.emit(ev)
+        lat.append(time.perf_counter() - t1)
+        peak = max(peak, len(main._events))
+    burst = time.perf_counter() - t0
+    main.flush_events()
+
+    queued, dropped, written = _acount('queued'), _acount('dropped'), _acount('written')
+    files = [os.path.join(d, f) for d, _, fs in os.walk(main.ANALYTICS_DIR) for f in fs]
+    size  = sum(os.path.getsize(f) for f in files)
+    back  = manage.read_events(main.ANALYTICS_DIR)
+    print(f"burst         : {args.n} events in {burst * 1000:.0f} ms → {args.n / burst:,.0f} events/s")
+    print(f"emit()        : p50 {_pct(lat, .5) * 1e6:.2f} µs  p99 {_pct(lat, .99) * 1e6:.2f} µs  "
+          f"max {max(lat) * 1e6:.0f} µs")
+    print(f"queue         : peak {peak} / limit {args.queue}")
+    print(f"events        : queued {queued}  dropped {dropped}  written {written}  "
+          f"failed {_acount('failed')}  read back {len(back)}")
+    print(f"files         : {len(files)} ({os.path.splitext(files[0])[1] if files else '-'}), "
+          f"{size / 1024:.0f} KiB, {size / max(written, 1):.1f} B/event")
+    print(f"funnel        : {manage.funnel(back)}")
+    ok = peak <= args.queue and queued + dropped == args.n and len(back) == written == queued
+    return 0 if ok else 1
+
+# ─────────────────────────────────────────────────────────────
+# TENANTS
+# Memory of N tenants served by one process, against the RSS of a
+# single-tenant deployment (a child process running the same traffic
+# for one number). Also checks every tenant's replies went out from
+# its own number and its sessions stayed its own.
+# ─────────────────────────────────────────────────────────────
+
+def _tenant_traffic(stubs, phone_id: str, n: int, phones: int, rnd: random.Random, concurrency: int):
+    payloads = synth_payloads(n, synth_phones(phones, rnd), rnd, phone_id=phone_id)
+    seed_customers(stubs, payloads)
+    res = _post_all(payloads, concurrency)
+    return sum(st != 200 for _, _, st in res)
+
+def _rss_mib() -> float:
+    """Peak RSS. VmHWM, not ru_maxrss — the latter carries the parent's peak across fork+exec."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def bench_tenants(args):
+    import gc, tracemalloc, subprocess
+    from stubs import Stubs
+    stubs = Stubs().start()
+    _load(stubs)
+    _no_pacing()
+    rnd = random.Random(args.seed)
+
+    errors = _tenant_traffic(stubs, PHONE_ID, args.messages, args.phones, rnd, args.concurrency)
+    if args.child:
+        gc.collect()
+        print(json.dumps({'rss_mib': _rss_mib(), 'errors': errors}))
+        return 0
+
+    gc.collect()
+    if args.trace:
+        tracemalloc.start()
+    m0, rss0 = tracemalloc.get_traced_memory()[0], _rss_mib()
+    ids = [str(200000000000000 + i) for i in range(args.n)]
+    for i, tid in enumerate(ids):
+        main.register_tenant({'phone_id': tid, 'name': f"shop{i}", 'wa_token': 'stub-token',
+                              'catalog_id': f"catalog{i}", 'shop_domain': f"shop{i}.myshopify.com",
+                              'shopify_token': 'stub-token', 'shopify_api': stubs.shopify.url,
+                              'sheet_id': 'stub-sheet'})
+    m_reg = tracemalloc.get_traced_memory()[0]
+    for tid in ids:
+        errors += _tenant_traffic(stubs, tid, args.messages, args.phones, rnd, args.concurrency)
+    gc.collect()
+    m1, rss1 = tracemalloc.get_traced_memory()[0], _rss_mib()
+    tracemalloc.stop()
+    stubs.stop()
+
+    child = subprocess.run([sys.executable, os.path.abspath(__file__), 'tenants', '--child',
+                            '--messages', str(args.messages), '--phones', str(args.phones)],
+                           capture_output=True, text=True)
+    single = json.loads(child.stdout.strip().splitlines()[-1])['rss_mib']
+
+    sent     = stubs.graph.senders
+    own      = all(sent[tid] > 0 for tid in ids)
+    sessions = [len(main._tenants[tid].sessions) for tid in ids]
+    print(f"tenants       : {args.n} + default, {args.messages} messages from {args.phones} phones each")
+    if args.trace:
+        print(f"per tenant    : {(m_reg - m0) / args.n / 1024:.1f} KiB registered, "
+              f"{(m1 - m0) / args.n / 1024:.1f} KiB after traffic (sessions, pools + shared delivery/analytics state)")
+    else:
+        print(f"per tenant    : {(rss1 - rss0) / args.n * 1024:.0f} KiB RSS (--trace for live Python objects)")
+    print(f"one process   : {rss1:.0f} MiB RSS for {args.n + 1} tenants")
+    print(f"deployments   : {single:.0f} MiB RSS each → {single * (args.n + 1):.0f} MiB for {args.n + 1}")
+    print(f"isolation     : replies from own number {'ok' if own else 'FAILED'}, "
+          f"sessions per tenant {min(sessions)}–{max(sessions)}, errors {errors}")
+    return 0 if own and not errors else 1
+
+# ─────────────────────────────────────────────────────────────
+# CUSTOMERS
+# Local customer index against a Shopify stub with --customers
+# customers: bulk load time and memory, lookup latency vs live
+# search, agreement with the stub, then updated_at_min polling and
+# signed customers/* webhooks.
+# ─────────────────────────────────────────────────────────────
+
+def _shopify_hook(topic: str, c: dict, secret: str, domain: str, sign: bool = True) -> int:
+    import hmac, hashlib, base64
+    raw = json.dumps(c).encode()
+    sig = base64.b64encode(hmac.new(secret.encode(), raw, hashlib.sha256).digest()).decode()
+    r = main.app.test_client().post('/shopify/webhook', data=raw, headers={
+        'X-Shopify-Topic': topic, 'X-Shopify-Shop-Domain': domain,
+        'X-Shopify-Hmac-Sha256': sig if sign else 'bad', 'Content-Type': 'application/json'})
+    return r.status_code
+
+def bench_customers(args):
+    import gc
+    from stubs import Stubs
+    os.environ['SHOPIFY_WEBHOOK_SECRET'] = 'bench-secret'
+    stubs = Stubs(latency={'shopify': args.page_latency},
+                  shopify={'customers': args.customers}).start()
+    _load(stubs)
+    shop, t = stubs.shopify, main.tenant()
+    rnd  = random.Random(args.seed)
+    fail = []
+
+    # Bulk load
+    gc.collect()
+    rss0, pages0 = _rss_mib(), shop.hits['customers_list']
+    t0  = time.perf_counter()
+    idx = main.customer_index()
+    while not idx.ready and time.perf_counter() - t0 < 600:
+        time.sleep(0.01)
+    load = time.perf_counter() - t0
+    gc.collect()
+    print(f"bulk load     : {len(idx.names)} phones in {load:.1f} s, "
+          f"{shop.hits['customers_list'] - pages0} pages, +{_rss_mib() - rss0:.0f} MiB RSS")
+
+    # Agreement with the stub
+    sample = rnd.sample(shop.order, min(args.check, len(shop.order)))
+    for cid in sample:
+        c   = shop.customer(cid)
+        got = idx.lookup(c['phone'][1:])
+        if not got['exists'] or got['first_name'] != c['first_name'] or got['b2b'] != ('B2B' in c['tags']):
+            fail.append(('bulk', cid, got))
+    unknown = [f"9166{rnd.randrange(10**8):08d}" for _ in range(200)]
+    fail += [('unknown', p, None) for p in unknown if idx.lookup(p)['exists']]
+
+    # Lookup latency: index vs live search
+    phones = [shop.customer(cid)['phone'][1:] for cid in sample[:200]]
+    local  = _time(lambda: main.customer_status(rnd.choice(phones)), 2000)
+    shop.latency = args.live_latency
+    live   = _time(lambda: main.shopify_lookup(rnd.choice(phones)), 50)
+    shop.latency = args.page_latency
+    print(f"lookup        : index p50 {_pct(local, .5) * 1e6:.1f} µs  p99 {_pct(local, .99) * 1e6:.1f} µs | "
+          f"live search p50 {_pct(live, .5) * 1000:.1f} ms (stub latency {args.live_latency * 1000:.0f} ms)")
+
+    # Incremental: updated_at_min polling
+    time.sleep(1.1)
+    changed = rnd.sample(shop.order, args.changes)
+    for i, cid in enumerate(changed):
+        shop.update(cid, first_name=f"Renamed{i}", tags='B2B' if i % 2 else 'Retail')
+    added = [shop.add(f"+9188{i:08d}", f"New{i}", 'Wholesale') for i in range(args.changes)]
+    t0 = time.perf_counter()
+    n  = idx.poll()
+    poll = time.perf_counter() - t0
+    for i, cid in enumerate(changed):
+        got = idx.lookup(shop.customer(cid)['phone'])
+        if got['first_name'] != f"Renamed{i}" or got['b2b'] != bool(i % 2):
+            fail.append(('poll', cid, got))
+    fail += [('poll-new', cid, None) for cid in added if not idx.lookup(shop.customer(cid)['phone'])['b2b']]
+    print(f"poll          : {n} changed customers fetched in {poll * 1000:.0f} ms "
+          f"({len(changed)} updated, {len(added)} created)")
+
+    # Webhooks: update, phone change, delete, bad signature
+    cid = changed[0]
+    shop.update(cid, first_name='Hooked', tags='b2b')
+    c   = shop.customer(cid)
+    codes = [_shopify_hook('customers/update', c, 'bench-secret', t.shop_domain)]
+    if idx.lookup(c['phone']) != {'exists': True, 'first_name': 'Hooked', 'b2b': True}:
+        fail.append(('hook-update', cid, idx.lookup(c['phone'])))
+    old = c['phone']
+    shop.update(cid, phone='+919999000001')
+    codes.append(_shopify_hook('customers/update', shop.customer(cid), 'bench-secret', t.shop_domain))
+    if idx.lookup(old)['exists'] or not idx.lookup('919999000001')['exists']:
+        fail.append(('hook-phone', cid, None))
+    codes.append(_shopify_hook('customers/delete', {'id': cid}, 'bench-secret', t.shop_domain))
+    if idx.lookup('919999000001')['exists']:
+        fail.append(('hook-delete', cid, None))
+    bad = _shopify_hook('customers/update', {'id': 1, 'phone': '+911', 'first_name': 'X'},
+                        'bench-secret', t.shop_domain, sign=False)
+    if codes != [200, 200, 200] or bad != 401 or idx.lookup('911')['exists']:
+        fail.append(('hook-codes', codes, bad))
+    print(f"webhooks      : update/phone change/delete {codes}, bad signature → {bad}")
+
+    # Two customers sharing a phone: deleting one keeps the other
+    for cid in (-1, -2):
+        idx.apply({'id': cid, 'phone': '+919999000003', 'first_name': 'Twin', 'tags': ''})
+    idx.remove(-1)
+    if not idx.lookup('919999000003')['exists']:
+        fail.append(('shared-phone', -2, None))
+
+    # A customer the index hasn't seen yet: one live search confirms the miss, then rate-limited
+    shop.add('+919999000002', 'Fresh', 'Retail')
+    hits = shop.hits['customers_search']
+    got  = [main.customer_status('919999000002') for _ in range(3)]
+    live = shop.hits['customers_search'] - hits
+    if any(g != {'status': 'retail', 'first_name': 'Fresh'} for g in got) or live != 1:
+        fail.append(('miss-live', live, got))
+    print(f"index miss    : confirmed by {live} live search over {len(got)} messages")
+
+    # In neither the store nor the sheet: registered on the first message, the sheet isn't read again
+    sheets = stubs.all['sheets']
+    reads  = sheets.hits['values_get']
+    got    = [main.customer_status('919999000004')['status'] for _ in range(3)]
+    reads  = sheets.hits['values_get'] - reads
+    if got != ['new', 'incomplete', 'incomplete'] or reads != 1:
+        fail.append(('sheets-ttl', reads, got))
+    print(f"unknown phone : {reads} Registrations read over {len(got)} messages ({', '.join(got)})")
+
+    stubs.stop()
+    print(f"checked       : {len(sample)} sampled + {len(unknown)} unknown phones — "
+          f"{'all agree' if not fail else f'{len(fail)} FAILED'}")
+    for f in fail[:10]:
+        print(f"  {f}")
+    return 0 if not fail else 1
+
+# ─────────────────────────────────────────────────────────────
+# PHONES
+# canon_phone cold vs memoized, then a Registrations sheet with
+# mixed formats and duplicates: dedup-sheets must leave one row per
+# E.164 number, and every spelling must find the same row/session.
+# ─────────────────────────────────────────────────────────────
+
+def _spellings(digits: str) -> list:
+    """Ways customers and staff write the same Indian mobile number."""
+    n = digits[2:]
+    return [digits, '+' + digits, '0' + n, n, f"+91 {n[:5]} {n[5:]}",
+            f"0091-{n}", f"({n[:3]}) {n[3:6]}-{n[6:]}"]
+
+def bench_phones(args):
+    from stubs import Stubs
+    import manage
+    rnd   = random.Random(args.seed)
+    nums  = [f"91{rnd.choice('6789')}{rnd.randrange(10**9):09d}" for _ in range(args.rows)]
+    raw   = [rnd.choice(_spellings(d)) for d in nums]
+    rows  = [['Phone', 'First Name', 'Registered']]
+    for i, d in enumerate(nums):
+        rows.append([raw[i], f"Name{i}" if rnd.random() > .1 else '', '2026-01-01'])
+    dup   = rnd.sample(range(len(nums)), int(len(nums) * args.dups))
+    for i in dup:
+        rows.append([rnd.choice(_spellings(nums[i])), f"Name{i}", '2026-02-01'])
+    rows.append(['', 'note: imported from the old form', ''])
+    stubs = Stubs(sheets={'rows': rows}).start()
+    _load(stubs)
+    fail = []
+
+    # Normalisation cost
+    spelled = [rnd.choice(_spellings(d)) for d in nums]
+    main.canon_phone.cache_clear()
+    t0   = time.perf_counter()
+    for p in spelled:
+        main.canon_phone(p)
+    cold = (time.perf_counter() - t0) / len(spelled)
+    t0   = time.perf_counter()
+    for _ in range(args.rounds):
+        for p in spelled:
+            main.canon_phone(p)
+    warm = (time.perf_counter() - t0) / (args.rounds * len(spelled))
+    print(f"canon_phone   : cold {cold * 1e6:.2f} µs  memoized {warm * 1e6:.2f} µs "
+          f"({main.canon_phone.cache_info().currsize} cached)")
+    fail += [('canon', d, p) for d in nums[:200] for p in _spellings(d) if main.canon_phone(p) != '+' + d]
+
+    # dedup-sheets on the messy sheet
+    before = len(stubs.sheets.rows)
+    dry    = manage.main_cli(['dedup-sheets'])
+    if len(stubs.sheets.rows) != before:
+        fail.append(('dry-run wrote', before, len(stubs.sheets.rows)))
+    t0 = time.perf_counter()
+    rc = manage.main_cli(['dedup-sheets', '--apply'])
+    print(f"dedup-sheets  : {before} rows → {len(stubs.sheets.rows)} in {time.perf_counter() - t0:.2f} s")
+    keys = [main.canon_phone(r[0]) for r in stubs.sheets.rows if r and main.canon_phone(r[0])]
+    if dry or rc or len(keys) != len(set(keys)) or len(keys) != len(set(nums)):
+        fail.append(('dedup', len(keys), len(set(keys)), len(set(nums))))
+    if any(r[0] and r[0] != main.canon_phone(r[0]) for r in stubs.sheets.rows[1:] if main.canon_phone(r[0])):
+        fail.append(('not canonical',))
+    if stubs.sheets.rows[0][0] != 'Phone' or not any('note:' in c for r in stubs.sheets.rows for c in r):
+        fail.append(('non-phone rows lost',))
+    lost = [i for i in dup if not any(r[1] == f"Name{i}" for r in stubs.sheets.rows if r[0] == '+' + nums[i])]
+    fail += [('name lost', nums[i]) for i in lost]
+
+    # Whatever the sheet spelled, the wa_id finds its row; one session per number
+    sample = rnd.sample(nums, min(args.check, len(nums)))
+    for d in sample:
+        got = {json.dumps(main.sheets_lookup(p), sort_keys=True) for p in (d, '+' + d)}
+        if len(got) != 1 or not main.sheets_lookup(d)['exists']:
+            fail.append(('lookup', d, got))
+        main.get_session(d)
+        main.get_session('+' + d)
+    n = len(main.tenant().sessions)
+    if n != len(set(sample)):
+        fail.append(('sessions', n, len(set(sample))))
+    print(f"agreement     : {len(sample)} wa_ids vs {len(_spellings(nums[0]))} sheet spellings → {n} sessions")
+
+    # wa_ids carry their own country code: never re-prefixed with PHONE_CC
+    foreign = {'6591234567': '+6591234567', '14155550123': '+14155550123', '447700900123': '+447700900123'}
+    fail += [('wa_id', w, main.wa_key(w)) for w, e in foreign.items() if main.wa_key(w) != e]
+
+    stubs.stop()
+    print(f"checked       : {'all agree' if not fail else f'{len(fail)} FAILED'}")
+    for f in fail[:10]:
+        print(f"  {f}")
+    return 0 if not fail else 1
+
+# ─────────────────────────────────────────────────────────────
+# BUDGET
+# Slow upstreams (Gemini, Shopify search, Sheets) with the message
+# time budget off and on: per-message latency and the degradations
+# that kept it bounded. Profiles are live searches here
+# (SHOPIFY_SYNC_SECONDS=0) so Shopify latency is on the hot path.
+# ─────────────────────────────────────────────────────────────
+
+_BUDGET_MIX = {'text': 60, 'image': 20, 'list_reply': 20}
+
+def _degraded() -> dict:
+    return {label: n for (k, label), n in main._counts.items() if k == 'degraded'}
+
+def bench_budget(args):
+    from stubs import Stubs
+    os.environ['SHOPIFY_SYNC_SECONDS'] = '0'
+    os.environ['ADMIT_MAX_INFLIGHT']   = '0'       # measure the budget, not admission control
+    lat   = {'gemini': args.gemini, 'shopify': args.shopify, 'sheets': args.sheets, 'graph': args.graph}
+    stubs = Stubs(latency=lat).start()
+    _load(stubs)
+    main.BREAKER_MIN_CALLS = 10**9                 # an open Gemini breaker would stand in for the degradations
+    rnd  = random.Random(args.seed)
+    rows = {}
+    fail = []
+    print("stub latency  : " + '  '.join(f"{k} {v * 1000:.0f} ms" for k, v in lat.items())
+          + "  (×0.5–1.5 per call)")
+    for budget in (0.0, args.budget):
+        main.MSG_BUDGET_S = budget
+        payloads = synth_payloads(args.n, synth_phones(args.phones, rnd), rnd, _BUDGET_MIX)
+        seed_customers(stubs, payloads)
+        d0  = _degraded()
+        t0  = time.perf_counter()
+        res = _post_all(payloads, args.concurrency)
+        wall = time.perf_counter() - t0
+        dts = [dt for _, dt, _ in res]
+        deg = {k: v - d0.get(k, 0) for k, v in _degraded().items() if v - d0.get(k, 0)}
+        rows[budget] = dts
+        bad = sum(code != 200 for _, _, code in res)
+        if bad:
+            fail.append((f"not 200 at {budget:.0f} s", bad))
+        if budget and not deg:
+            fail.append(('nothing degraded', budget))
+        name = f"budget {budget:.0f} s" if budget else 'no budget'
+        print(f"{name:<14}: p50 {_pct(dts, .5):5.2f} s  p95 {_pct(dts, .95):5.2f} s  "
+              f"p99 {_pct(dts, .99):5.2f} s  max {max(dts):5.2f} s  ({len(res)} msgs in {wall:.0f} s)")
+        if budget:
+            print("degraded      : " + ('  '.join(f"{k} {v}" for k, v in sorted(deg.items())) or 'none'))
+    stubs.stop()
+    # A message may overrun by the call floor (the reply still goes out) plus stub jitter.
+    bound = args.budget + 2 * main.CALL_FLOOR_S
+    over  = sum(dt > bound for dt in rows[args.budget])
+    print(f"over {bound:.1f} s   : {over} of {len(rows[args.budget])} with the budget "
+          f"(vs {sum(dt > bound for dt in rows[0.0])} without)")
+    if over:
+        fail.append(('over bound', over))
+    print(f"checked       : {'ok' if not fail else f'{len(fail)} FAILED {fail}'}")
+    return 0 if not fail else 1
+
+# ─────────────────────────────────────────────────────────────
+# BREAKERS
+# Fault injection: Shopify, Sheets and Gemini stop answering (stub
+# latency far past every timeout). Per-message latency and
+# throughput before and during the outage with the circuit breakers
+# disabled and enabled, then recovery through a half-open probe.
+# ─────────────────────────────────────────────────────────────
+
+_OUTAGE = ('shopify', 'sheets', 'gemini')
+
+def _phase(name: str, stubs, n: int, args, rnd: random.Random) -> list:
+    payloads = synth_payloads(n, synth_phones(args.phones, rnd), rnd, _BUDGET_MIX)
+    seed_customers(stubs, payloads)
+    t0   = time.perf_counter()
+    res  = _post_all(payloads, args.concurrency)
+    wall = time.perf_counter() - t0
+    dts  = [dt for _, dt, _ in res]
+    print(f"  {name:<12}: p50 {_pct(dts, .5):5.2f} s  p99 {_pct(dts, .99):5.2f} s  "
+          f"{len(res) / wall:6.1f} msg/s")
+    return dts
+
+def _states() -> str:
+    br = main.app.test_client().get('/health').get_json()['breakers'].get(main.tenant().id, {})
+    return '  '.join(f"{k} {v['state']}" for k, v in br.items() if k in _OUTAGE)
+
+def bench_breakers(args):
+    from stubs import Stubs
+    os.environ['SHOPIFY_SYNC_SECONDS'] = '0'
+    os.environ.setdefault('BREAKER_OPEN_SECONDS', str(args.open))
+    stubs = Stubs().start()
+    _load(stubs)
+    _no_pacing()
+    rnd  = random.Random(args.seed)
+    fail = []
+    min_calls = main.BREAKER_MIN_CALLS
+    for enabled in (False, True):
+        main._breakers.clear()
+        main.BREAKER_MIN_CALLS = min_calls if enabled else 10**9
+        print(f"breakers {'on' if enabled else 'off'}:")
+        for k in _OUTAGE:
+            stubs.all[k].latency = 0.0
+        _phase('healthy', stubs, args.n, args, rnd)
+        for k in _OUTAGE:
+            stubs.all[k].latency = args.hang
+        out = _phase('outage', stubs, args.n, args, rnd)
+        print(f"  {'state':<12}: {_states()}")
+        if not enabled:
+            continue
+        if _pct(out, .5) > 1.0:
+            fail.append(('outage p50', _pct(out, .5)))
+        for k in _OUTAGE:
+            stubs.all[k].latency = 0.0
+        time.sleep(main.BREAKER_OPEN_S)
+        _phase('recovered', stubs, args.n, args, rnd)
+        print(f"  {'state':<12}: {_states()}")
+        fail += [('not closed', k) for k in _OUTAGE if main.breaker(k).state != 'closed']
+    stubs.stop()
+    print(f"checked       : {'ok' if not fail else f'{len(fail)} FAILED {fail}'}")
+    return 0 if not fail else 1
+
+# ─────────────────────────────────────────────────────────────
+# PREFETCH
+# Customers browse section → sub-menu → collection, with skewed
+# (Zipf) favourites at each level and think time between taps. A
+# learning phase fills the transition counts, then the same traffic
+# runs three ways: no product cache (PRODUCTS_TTL 0), cache only
+# (PREFETCH_TOP_K 0), cache + prefetch. Measured: the tap that opens
+# a collection, and Graph product fetches per open.
+# ─────────────────────────────────────────────────────────────
+
+_SECTIONS = {'W_FACE': ['F_EARRINGS', 'F_NOSE', 'F_HEAD', 'F_HAIR'],
+             'W_HAND': ['H_BANGLES', 'H_BRACELETS', 'H_RINGS', 'H_ARMLETS'],
+             'CAT_MEN': ['M_RINGS', 'M_BRACELETS', 'M_CHAINS', 'M_ACCESSORIES'],
+             'CAT_STUDIO': ['S_WATCHES', 'S_ACCSS']}
+
+def _zipf(items: list, rnd: random.Random, s: float = 1.2) -> tuple:
+    items = list(items)
+    rnd.shuffle(items)
+    return items, [1 / (i + 1) ** s for i in range(len(items))]
+
+def _browse_model(rnd: random.Random) -> dict:
+    """menu id → (next ids, weights); a sub-menu's next ids are its collections' C_ ids."""
+    model = {'': _zipf(_SECTIONS, rnd)}
+    for sec, subs in _SECTIONS.items():
+        model[sec] = _zipf(subs, rnd)
+        for mid in subs:
+            cids = [cid for _, d in main._catalog['menus'][mid][2] for cid in d.values()]
+            model[mid] = _zipf([f"C_{c}" for c in cids], rnd)
+    return model
+
+def _tap(phone: str, rid: str) -> float:
+    m  = {'from': phone, 'id': f"wamid.BENCH{next(_ids):010d}", 'timestamp': str(int(time.time())),
+          'type': 'interactive', 'interactive': {'type': 'list_reply', 'list_reply': {'id': rid, 'title': rid}}}
+    t0 = time.perf_counter()
+    main.app.test_client().post('/webhook', json=envelope([m]))
+    return time.perf_counter() - t0
+
+def _browse(phones: list, sessions: int, model: dict, think: float, concurrency: int, seed: int) -> list:
+    """Run the sessions, phones in parallel; returns the latency of every collection-opening tap."""
+    per = defaultdict(list)
+    for i in range(sessions):
+        per[phones[i % len(phones)]].append(i)
+    def one(phone):
+        rnd, out = random.Random(f"{seed}:{phone}"), []
+        for _ in per[phone]:
+            node = ''
+            while node in model:
+                ids, w = model[node]
+                node   = rnd.choices(ids, w)[0]
+                dt     = _tap(phone, node)
+                if node.startswith('C_') or main._single_collection(node):
+                    out.append(dt)
+                time.sleep(think * rnd.uniform(.5, 1.5))
+        return out
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        return [dt for res in ex.map(one, list(per)) for dt in res]
+
+def _fetches() -> int:
+    st = main._metrics.get(('call', 'collection_products'))
+    return st[0] if st else 0
+
+def bench_prefetch(args):
+    from stubs import Stubs
+    stubs = Stubs(latency={'graph': args.graph}).start()
+    _load(stubs)
+    _no_pacing()
+    rnd    = random.Random(args.seed)
+    phones = synth_phones(args.phones, rnd)
+    stubs.shopify.seed(set(phones))
+    model  = _browse_model(rnd)
+    ttl, top_k = main.PRODUCTS_TTL_S, main.PREFETCH_TOP_K
+    cache_s    = args.ttl if args.ttl is not None else ttl
+    print(f"graph latency : {args.graph * 1000:.0f} ms (×0.5–1.5)   think {args.think:.1f} s   "
+          f"{args.phones} phones   top-k {top_k}   product TTL {cache_s:.0f} s")
+
+    main.PREFETCH_TOP_K = 0
+    _browse(phones, args.learn, model, args.think, args.concurrency, -1)
+    print(f"learned       : {sum(sum(c.values()) for c in main._transitions.values())} transitions "
+          f"from {len(main._transitions)} menus")
+
+    rows = {}
+    for name, ttl_s, k in (('no cache', 0.0, 0), ('cache only', cache_s, 0), ('prefetch', cache_s, top_k)):
+        main.PRODUCTS_TTL_S, main.PREFETCH_TOP_K = ttl_s, k
+        main._products.clear()
+        main._counts = {key: v for key, v in main._counts.items() if key[0] != 'prefetch'}
+        f0   = _fetches()
+        dts  = _browse(phones, args.sessions, model, args.think, args.concurrency, args.seed)
+        rows[name] = dts
+        st   = main.prefetch_stats()
+        line = (f"{name:<14}: open p50 {_pct(dts, .5) * 1000:4.0f} ms  p95 {_pct(dts, .95) * 1000:4.0f} ms  "
+                f"fetches/open {(_fetches() - f0) / len(dts):.2f}")
+        if k:
+            unused = sum(e.wasted for e in list(main._products.values()))
+            issued = st['issued']
+            line  += (f"  hit rate {st['hit_rate'] or 0:.0%}  issued {issued}  "
+                      f"wasted {st['wasted'] + unused} ({(st['wasted'] + unused) / max(issued, 1):.0%})")
+        print(line)
+    stubs.stop()
+    main.PRODUCTS_TTL_S, main.PREFETCH_TOP_K = ttl, top_k
+    return 0 if _pct(rows['prefetch'], .5) < _pct(rows['no cache'], .5) else 1
+
+# ─────────────────────────────────────────────────────────────
+# CLUSTER
+# Several gunicorn nodes on local ports, one set of stubs. Every
+# message goes to a random node, as a load balancer would send it.
+# Without clustering a phone's conversation is split over nodes
+# (more sessions than phones); with it every phone has exactly one
+# session. Then: the cost of the forwarding hop, a graceful leave
+# (sessions handed over), a crash (detected by heartbeat) and a join
+# (ranges rebalanced, sessions handed to the new node).
+# ─────────────────────────────────────────────────────────────
+
+_CLUSTER_SECRET = 'bench-cluster'
+
+def _http_json(url: str, body: dict = None, timeout: float = 10) -> tuple:
+    import urllib.request
+    req = urllib.request.Request(url, data=json.dumps(body).encode() if body is not None else None,
+                                 headers={'Content-Type': 'application/json'})
+    t0 = time.perf_counter()
+    with urllib.request.urlopen(req, timeout=timeout) as r:
+        out = json.loads(r.read() or b'null')
+    return out, time.perf_counter() - t0
+
+class _Node:
+    def __init__(self, stubs, tmp: str, seed: str = None, cluster: bool = True, opts: list = None):
+        import subprocess
+        self.port = _free_port()
+        self.url  = f"http://127.0.0.1:{self.port}"
+        env = {**os.environ, **stubs.env(), 'TENANT_SEND_RATE': '0',
+               'ANALYTICS_DIR': os.path.join(tmp, str(self.port)),
+               'ORDERS_DB': os.path.join(tmp, f"{self.port}.db")}
+        if cluster:
+            env.update(CLUSTER_SELF_URL=self.url, CLUSTER_NODES=seed or '', CLUSTER_SECRET=_CLUSTER_SECRET,
+                       CLUSTER_HEARTBEAT_SECONDS='0.5', CLUSTER_DEAD_SECONDS='2')
+        self.proc = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', 'main:app', *(['-w', '1', '--threads', '16'] if opts is None else opts),
+             '-b', f"127.0.0.1:{self.port}", '--log-level', 'warning', '--graceful-timeout', '10'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env, start_new_session=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if _wait_200(f"{self.url}/health", 30) is None:
+            raise RuntimeError(f"node {self.url} did not start")
+
+    def health(self) -> dict:
+        return _http_json(f"{self.url}/health", timeout=120)[0]    # a sync worker may still be draining
+
+    def sessions(self) -> int:
+        return self.health()['sessions']
+
+    def ring(self) -> set:
+        return set((self.health().get('cluster') or {}).get('nodes', []))
+
+    def stop(self, sig=None):
+        """SIGTERM: gunicorn's graceful shutdown. SIGKILL: master and worker die at once."""
+        import signal
+        if sig == signal.SIGKILL:
+            os.killpg(self.proc.pid, sig)
+        else:
+            self.proc.send_signal(signal.SIGTERM)
+        self.proc.wait()
+
+def _converge(nodes: list, timeout: float = 30) -> float | None:
+    """Seconds until every node's ring is exactly these nodes."""
+    want, t0 = {n.url for n in nodes}, time.perf_counter()
+    while time.perf_counter() - t0 < timeout:
+        if all(n.ring() == want for n in nodes):
+            return time.perf_counter() - t0
+        time.sleep(0.1)
+    return None
+
+def _cluster_traffic(nodes: list, phones: list, rounds: int, rnd: random.Random, concurrency: int) -> list:
+    """Each phone: 'english please', then `rounds` more texts, each POSTed to a random node."""
+    def one(phone):
+        r, dts = random.Random(f"{rnd.random()}:{phone}"), []
+        for text in ['english please'] + [r.choice(['timing kya hai', 'about your studio', 'track my order'])
+                                          for _ in range(rounds)]:
+            m = {'from': phone, 'id': f"wamid.BENCH{next(_ids):010d}", 'timestamp': str(int(time.time())),
+                 'type': 'text', 'text': {'body': text}}
+            dts.append(_http_json(f"{r.choice(nodes).url}/webhook", envelope([m]), 30)[1])
+        return dts
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        return [dt for dts in ex.map(one, phones) for dt in dts]
+
+def _hop(src, phone: str, n: int) -> list:
+    """Latency of status-only deliveries for `phone` POSTed to `src`."""
+    out = []
+    for i in range(n):
+        st = {'id': f"wamid.UNKNOWN{i}", 'status': 'delivered', 'timestamp': str(int(time.time())),
+              'recipient_id': phone}
+        body = {'object': 'whatsapp_business_account', 'entry': [{'id': 'WABA', 'changes': [{
+            'field': 'messages', 'value': {'messaging_product': 'whatsapp',
+                                           'metadata': {'phone_number_id': PHONE_ID}, 'statuses': [st]}}]}]}
+        out.append(_http_json(f"{src.url}/webhook", body)[1])
+    return out
+
+def bench_cluster(args):
+    import signal
+    from stubs import Stubs
+    stubs  = Stubs().start()
+    _load(stubs)
+    rnd    = random.Random(args.seed)
+    phones = synth_phones(args.phones, rnd)
+    stubs.shopify.seed(set(phones))
+    tmp    = tempfile.mkdtemp(prefix='bench-cluster-')
+    fail   = []
+    total  = lambda ns: sum(n.sessions() for n in ns)
+
+    nodes = [_Node(stubs, tmp, cluster=False) for _ in range(args.nodes)]
+    _cluster_traffic(nodes, phones, args.rounds, rnd, args.concurrency)
+    print(f"no cluster    : {args.nodes} nodes, {len(phones)} phones → {total(nodes)} sessions "
+          f"(a conversation split over nodes)")
+    for n in nodes:
+        n.stop()
+
+    t0    = time.perf_counter()
+    nodes = [_Node(stubs, tmp)]
+    nodes += [_Node(stubs, tmp, seed=nodes[0].url) for _ in range(args.nodes - 1)]
+    conv  = _converge(nodes)
+    print(f"cluster up    : {args.nodes} nodes, ring agreed {conv:.1f} s after the last node started "
+          f"({time.perf_counter() - t0:.1f} s total)" if conv is not None else "cluster up    : NO AGREEMENT")
+    dts = _cluster_traffic(nodes, phones, args.rounds, rnd, args.concurrency)
+    per = [n.sessions() for n in nodes]
+    print(f"cluster       : {len(phones)} phones → {sum(per)} sessions, per node {per}   "
+          f"message p50 {_pct(dts, .5) * 1000:.0f} ms")
+    if sum(per) != len(phones):
+        fail.append(('sessions', sum(per)))
+
+    ring  = main.HashRing([n.url for n in nodes])
+    mine  = next(p for p in phones if ring.owner(main.canon_phone(p)) == nodes[0].url)
+    local, hop = _hop(nodes[0], mine, args.hops), _hop(nodes[1], mine, args.hops)
+    print(f"forward hop   : status delivery p50 {_pct(local, .5) * 1000:.1f} ms on its owner, "
+          f"{_pct(hop, .5) * 1000:.1f} ms via another node (+{(_pct(hop, .5) - _pct(local, .5)) * 1000:.1f} ms)")
+
+    before = total(nodes)
+    gone   = nodes.pop()
+    gone.stop()
+    conv   = _converge(nodes)
+    after  = total(nodes)
+    print(f"leave         : ring agreed in {conv:.1f} s, sessions {before} → {after} (handed over on shutdown)"
+          if conv is not None else "leave         : NO AGREEMENT")
+    if after != before:
+        fail.append(('leave handoff', after))
+
+    if len(nodes) > 1:
+        dead = nodes.pop()
+        lost = dead.sessions()
+        t0   = time.perf_counter()
+        dead.stop(signal.SIGKILL)
+        conv = _converge(nodes)
+        print(f"crash         : SIGKILL, off the ring after {time.perf_counter() - t0:.1f} s; "
+              f"its {lost} sessions are lost")
+
+    before = total(nodes)
+    t0     = time.perf_counter()
+    nodes.append(_Node(stubs, tmp, seed=nodes[0].url))
+    conv   = _converge(nodes)
+    time.sleep(1)                                   # let the handoff land
+    per    = [n.sessions() for n in nodes]
+    print(f"join          : ring agreed {time.perf_counter() - t0:.1f} s after start, sessions {before} → "
+          f"{sum(per)}, per node {per}")
+    if sum(per) != before or not per[-1]:
+        fail.append(('join handoff', per))
+    _cluster_traffic(nodes, phones, 1, rnd, args.concurrency)
+    per = [n.sessions() for n in nodes]
+    print(f"after join    : {len(phones)} phones → {sum(per)} sessions, per node {per}")
+    if sum(per) != len(phones):
+        fail.append(('sessions after join', sum(per)))
+
+    for n in nodes:
+        n.stop()
+    stubs.stop()
+    print(f"checked       : {'ok' if not fail else f'{len(fail)} FAILED {fail}'}")
+    return 0 if not fail else 1
+
+# ─────────────────────────────────────────────────────────────
+# WORKERS
+# One gunicorn node per worker setup, same stubs and upstream
+# latencies. --clients closed-loop senders post the replay mix for
+# --seconds; replies keep their pacing sleeps, as in production.
+# Then two races on the threaded node: one phone's messages arriving
+# in parallel requests (all handled, one session), and one message
+# re-delivered in parallel (handled once).
+# ─────────────────────────────────────────────────────────────
+
+_WORKER_SETUPS = {
+    'sync':         ['-k', 'sync', '-w', '1', '--threads', '1'],
+    'sync ×4':      ['-k', 'sync', '-w', '4', '--threads', '1'],
+    'gthread ×64':  ['--threads', '64'],
+    'gthread':      [],                              # gunicorn.conf.py: 1 process × 256 threads
+}
+
+def _load_loop(url: str, payloads: list, clients: int, seconds: float) -> tuple:
+    import urllib.request
+    stop, res, lock = time.perf_counter() + seconds, [], __import__('threading').Lock()
+    feed = itertools.cycle(payloads)
+    def client(_):
+        out = []
+        while time.perf_counter() < stop:
+            with lock:
+                body = _reid(next(feed), str(next(_ids)))
+            req = urllib.request.Request(f"{url}/webhook", data=json.dumps(body).encode(),
+                                         headers={'Content-Type': 'application/json'})
+            t0 = time.perf_counter()
+            try:
+                with urllib.request.urlopen(req, timeout=30) as r:
+                    r.read()
+                    ok = r.status == 200
+            except Exception:
+                ok = False
+            out.append((time.perf_counter() - t0, ok))
+        return out
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as ex:
+        for out in ex.map(client, range(clients)):
+            res += out
+    return res, time.perf_counter() - t0
+
+def _storm(url: str, stubs, phone: str, texts: list) -> int:
+    """POST one delivery per text, all at once; returns the messages the phone got back."""
+    before = stubs.graph.recipients[phone]
+    msgs   = [{'from': phone, 'id': mid, 'timestamp': str(int(time.time())), 'type': 'text',
+               'text': {'body': text}} for mid, text in texts]
+    with ThreadPoolExecutor(max_workers=len(msgs)) as ex:
+        list(ex.map(lambda m: _http_json(f"{url}/webhook", envelope([m]), 60), msgs))
+    time.sleep(0.5)
+    return stubs.graph.recipients[phone] - before
+
+def bench_workers(args):
+    from stubs import Stubs
+    lat    = {'graph': args.graph, 'shopify': 0.1, 'sheets': 0.1, 'gemini': args.gemini, 'razorpay': 0.2}
+    stubs  = Stubs(latency=lat).start()
+    _load(stubs)
+    rnd    = random.Random(args.seed)
+    phones = synth_phones(args.phones, rnd)
+    stubs.shopify.seed(set(phones))
+    payloads = synth_payloads(2000, phones, rnd)
+    tmp    = tempfile.mkdtemp(prefix='bench-workers-')
+    fail   = []
+    print("upstreams     : " + '  '.join(f"{k} {v * 1000:.0f} ms" for k, v in lat.items())
+          + f"   {args.clients} clients × {args.seconds:.0f} s, replay mix, pacing on")
+    for name in args.setups.split(','):
+        node = _Node(stubs, tmp, cluster=False, opts=_WORKER_SETUPS[name])
+        _load_loop(node.url, payloads[:20], 4, 2)                # import the SDKs, open connections
+        res, wall = _load_loop(node.url, payloads, args.clients, args.seconds)
+        dts  = [dt for dt, ok in res if ok]
+        errs = sum(not ok for _, ok in res)
+        sess = node.sessions()
+        print(f"{name:<14}: {len(dts) / wall:6.1f} msg/s  p50 {_pct(dts, .5):5.2f} s  p99 {_pct(dts, .99):5.2f} s  "
+              f"errors {errs}  sessions {sess}{'' if '×4' not in name else ' (of one worker)'}")
+        if name.startswith('gthread'):
+            phone = phones[0]
+            one   = _storm(node.url, stubs, phone, [(f"wamid.ONE.{name}", 'about your studio')])
+            got   = _storm(node.url, stubs, phone, [(f"wamid.STORM{i}.{name}", 'about your studio')
+                                                    for i in range(args.storm)])
+            dup   = _storm(node.url, stubs, phone, [(f"wamid.DUP.{name}", 'about your studio')] * args.storm)
+            print(f"{'':<14}  one phone, {args.storm} messages in parallel requests: {got // max(one, 1)} handled   "
+                  f"one message delivered ×{args.storm}: {dup // max(one, 1)} handled")
+            if got != args.storm * one or dup != one:
+                fail.append((name, one, got, dup))
+        node.stop()
+    stubs.stop()
+    print(f"checked       : {'ok' if not fail else f'{len(fail)} FAILED {fail}'}")
+    return 0 if not fail else 1
+
+# ─────────────────────────────────────────────────────────────
+# OVERLOAD
+# One gunicorn node with --threads threads, offered --rate webhooks/s
+# open loop (arrivals don't wait for answers, as with Meta) for
+# --seconds, well past what the node can serve. Each request carries
+# X-Request-Start like a proxy would. Admission control off vs on:
+# answered (200), deferred (503 → Meta redelivers later) and timed out
+# (Meta retries a delivery it already sent), per message class.
+# ─────────────────────────────────────────────────────────────
+
+_OVERLOAD_MIX = {'text': 45, 'list_reply': 20, 'button_reply': 10, 'image': 10, 'order': 15}
+
+def _open_loop(url: str, payloads: list, rate: float, seconds: float, timeout: float) -> list:
+    """[(kind, seconds, HTTP status or 0 for a timeout/reset)]"""
+    import urllib.request, urllib.error, threading
+    res, lock = [], threading.Lock()
+    def one(body, kind):
+        t0  = time.time()
+        req = urllib.request.Request(f"{url}/webhook", data=json.dumps(body).encode(),
+                                     headers={'Content-Type': 'application/json',
+                                              'X-Request-Start': f"t={int(t0 * 1000)}"})
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as r:
+                r.read()
+                code = r.status
+        except urllib.error.HTTPError as e:
+            code = e.code
+        except Exception:
+            code = 0
+        with lock:
+            res.append((kind, time.time() - t0, code))
+    n = int(rate * seconds)
+    with ThreadPoolExecutor(max_workers=min(n, int(rate * (timeout + 2)) + 16)) as ex:
+        start = time.perf_counter()
+        for i, body in enumerate(itertools.islice(itertools.cycle(payloads), n)):
+            wait = start + i / rate - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            ex.submit(one, _reid(body, str(next(_ids))), payload_kind(body))
+    return res
+
+def _overload_row(res: list, kinds) -> str:
+    out = []
+    for label, ks in kinds:
+        rows = [r for r in res if r[0] in ks]
+        ok   = [dt for _, dt, code in rows if code == 200]
+        out.append(f"{label} {len(ok) / max(len(rows), 1):4.0%} ok p95 {_pct(ok, .95) if ok else 0:4.1f} s")
+    return '   '.join(out)
+
+def bench_overload(args):
+    from stubs import Stubs
+    lat    = {'graph': args.graph, 'shopify': 0.1, 'sheets': 0.1, 'gemini': args.gemini, 'razorpay': 0.2}
+    stubs  = Stubs(latency=lat).start()
+    _load(stubs)
+    rnd    = random.Random(args.seed)
+    phones = synth_phones(args.phones, rnd)
+    stubs.shopify.seed(set(phones))
+    payloads = synth_payloads(4000, phones, rnd, _OVERLOAD_MIX)
+    tmp    = tempfile.mkdtemp(prefix='bench-overload-')
+    soft, hard = args.soft or args.threads * 3 // 8, args.max or args.threads * 3 // 4
+    kinds  = (('orders', {'order'}), ('menus', {'list_reply', 'button_reply'}), ('text+image', {'text', 'image'}))
+    print("upstreams     : " + '  '.join(f"{k} {v * 1000:.0f} ms" for k, v in lat.items())
+          + f"   {args.threads} threads   offered {args.rate:.0f}/s × {args.seconds:.0f} s open loop, "
+          f"client timeout {args.timeout:.0f} s")
+    fail, rows = [], {}
+    for name, limits in (('off', {'ADMIT_MAX_INFLIGHT': '0'}),
+                         ('on', {'ADMIT_SOFT_INFLIGHT': str(soft), 'ADMIT_MAX_INFLIGHT': str(hard)})):
+        os.environ.update(limits)
+        node = _Node(stubs, tmp, cluster=False, opts=['--threads', str(args.threads), '--timeout', '120'])
+        _load_loop(node.url, payloads[:20], 4, 2)                # import the SDKs, open connections
+        res  = _open_loop(node.url, payloads, args.rate, args.seconds, args.timeout)
+        adm  = node.health().get('admission', {})
+        node.stop()
+        codes = Counter(code for _, _, code in res)
+        rows[name] = res
+        print(f"{name:<14}: answered {codes[200] / len(res):4.0%}  deferred (503) {codes[503] / len(res):4.0%}  "
+              f"timed out {codes[0] / len(res):4.0%}   " + _overload_row(res, kinds))
+        if name == 'on':
+            print(f"{'':<14}  limits soft {soft} / max {hard} in flight   shed: "
+                  + '  '.join(f"{k} {v}" for k, v in sorted(adm.get('shed', {}).items())))
+    stubs.stop()
+
+    def served(name, ks):
+        rs = [r for r in rows[name] if r[0] in ks]
+        return sum(code == 200 for _, _, code in rs) / max(len(rs), 1)
+    if served('on', {'order'}) < 0.99 or served('on', {'order'}) < served('off', {'order'}):
+        fail.append(('orders not protected', served('off', {'order'}), served('on', {'order'})))
+    if sum(code == 0 for _, _, code in rows['on']) > sum(code == 0 for _, _, code in rows['off']):
+        fail.append('more timeouts with admission control')
+    print(f"checked       : {'ok' if not fail else f'{len(fail)} FAILED {fail}'}")
+    return 0 if not fail else 1
+
+# ─────────────────────────────────────────────────────────────
+# PROFILE
+# /admin/profile on a gunicorn node under the replay mix: throughput
+# with the profiler idle vs while it samples at each --hz, the
+# collapsed output checked line by line, and where the time went —
+# each stack charged to its deepest main.py frame, CPU and wait apart.
+# ─────────────────────────────────────────────────────────────
+
+_COLLAPSED = re.compile(r'^(cpu|wait|unknown);\S.* \d+$')
+
+def _profile_get(url: str, token: str, seconds: float, hz: int) -> tuple:
+    """(status, collapsed text, stats)"""
+    import urllib.request, urllib.error
+    req = urllib.request.Request(f"{url}/admin/profile?seconds={seconds}&hz={hz}",
+                                 headers={'Authorization': f"Bearer {token}"} if token else {})
+    try:
+        with urllib.request.urlopen(req, timeout=seconds + 30) as r:
+            return r.status, r.read().decode(), json.loads(r.headers.get('X-Profile-Stats') or '{}')
+    except urllib.error.HTTPError as e:
+        return e.code, '', {}
+
+def _by_app_frame(text: str) -> dict:
+    """kind → Counter(deepest main.py frame → µs)"""
+    out = defaultdict(Counter)
+    for line in text.splitlines():
+        stack, n = line.rsplit(' ', 1)
+        frames = stack.split(';')
+        own = next((f for f in reversed(frames) if f.endswith('(main.py)')), None)
+        if own:
+            out[frames[0]][own.split(' ')[0]] += int(n)
+    return out
+
+def bench_profile(args):
+    from stubs import Stubs
+    token  = 'bench-admin'
+    os.environ['ADMIN_TOKEN'] = token
+    lat    = {'graph': args.graph, 'shopify': 0.1, 'sheets': 0.1, 'razorpay': 0.2}
+    stubs  = Stubs(latency=lat).start()
+    _load(stubs)
+    rnd    = random.Random(args.seed)
+    phones = synth_phones(args.phones, rnd)
+    stubs.shopify.seed(set(phones))
+    payloads = synth_payloads(2000, phones, rnd)
+    tmp    = tempfile.mkdtemp(prefix='bench-profile-')
+    node   = _Node(stubs, tmp, cluster=False, opts=['--threads', str(args.threads)])
+    fail   = []
+    print("upstreams     : " + '  '.join(f"{k} {v * 1000:.0f} ms" for k, v in lat.items())
+          + f"   {args.clients} clients × {args.seconds:.0f} s per phase, {args.threads} threads")
+    _load_loop(node.url, payloads[:20], 4, 2)
+
+    res, wall = _load_loop(node.url, payloads, args.clients, args.seconds)
+    base = sum(ok for _, ok in res) / wall
+    print(f"{'idle':<14}: {base:6.1f} msg/s  p50 {_pct([dt for dt, ok in res if ok], .5) * 1000:4.0f} ms")
+    text = ''
+    for hz in args.hz:
+        with ThreadPoolExecutor(max_workers=1) as ex:
+            prof = ex.submit(_profile_get, node.url, token, args.seconds, hz)
+            res, wall = _load_loop(node.url, payloads, args.clients, args.seconds)
+            code, out, st = prof.result()
+        rate = sum(ok for _, ok in res) / wall
+        bad  = [l for l in out.splitlines() if not _COLLAPSED.match(l)]
+        print(f"{f'profiling {hz} Hz':<14}: {rate:6.1f} msg/s  p50 {_pct([dt for dt, ok in res if ok], .5) * 1000:4.0f} ms"
+              f"  ({rate / base - 1:+.1%})   {st.get('samples', 0)} samples, {len(out.splitlines())} stacks, "
+              f"cpu {st.get('cpu_ms', 0)} ms  wait {st.get('wait_ms', 0)} ms, sampler {st.get('overhead', 0):.1%} of a core")
+        if code != 200 or bad or not out:
+            fail.append((hz, code, bad[:2]))
+        text = text or out
+
+    # Access: no token, wrong token, a second profile at the same time
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        first = ex.submit(_profile_get, node.url, token, 2, 10)
+        time.sleep(0.5)
+        codes = (_profile_get(node.url, '', 1, 10)[0], _profile_get(node.url, 'wrong', 1, 10)[0],
+                 _profile_get(node.url, token, 1, 10)[0], first.result()[0])
+    print(f"access        : no token {codes[0]}  wrong token {codes[1]}  while one runs {codes[2]}  first {codes[3]}")
+    if codes != (404, 404, 409, 200):
+        fail.append(('access', codes))
+    node.stop()
+    stubs.stop()
+
+    by = _by_app_frame(text)
+    for kind in ('cpu', 'wait'):
+        tot = sum(by[kind].values()) or 1
+        print(f"{kind:<14}: " + '  '.join(f"{fn} {us / tot:.0%}" for fn, us in by[kind].most_common(args.top)))
+    if not by['cpu'] or not by['wait']:
+        fail.append('cpu and wait not both seen')
+    pacing = by['wait']['_p'], by['cpu']['_p']
+    print(f"_p (sleeps)   : {pacing[0] / 1e6:.1f} s waiting, {pacing[1] / 1e6:.2f} s on CPU")
+    if pacing[0] < 100 * pacing[1]:
+        fail.append(('reply pacing sleeps not charged to wait', pacing))
+    print(f"checked       : {'ok' if not fail else f'{len(fail)} FAILED {fail}'}")
+    return 0 if not fail else 1
+
+# ─────────────────────────────────────────────────────────────
+# ORDERS
+# Order ledger at --orders rows: record_order() cost on the request
+# path, writer drain rate, reference lookups at 10k vs full size,
+# then end to end — an order message, its AJS reference answered
+# from the ledger, a signed Razorpay payment_link.paid webhook.
+# ─────────────────────────────────────────────────────────────
+
+def _bench_ref(i: int, phones: list) -> tuple:
+    ph = phones[i % len(phones)]
+    return f"AJS-{ph[-4:]}-{1700000000 + i}", ph
+
+def _rzp_hook(event: str, ref: str, tid: str, secret: str, sign: bool = True) -> int:
+    import hmac, hashlib
+    raw = json.dumps({'event': event, 'payload': {'payment_link': {'entity': {
+        'id': 'plink_bench', 'status': event.split('.')[-1],
+        'notes': {'order_ref': ref, 'tenant': tid}}}}}).encode()
+    sig = hmac.new(secret.encode(), raw, hashlib.sha256).hexdigest() if sign else 'bad'
+    return main.app.test_client().post('/razorpay/webhook', data=raw,
+                                       headers={'X-Razorpay-Signature': sig}).status_code
+
+def _text_to(phone: str, text: str) -> dict:
+    m = synth_message('text', phone, random.Random())
+    m['text'] = {'body': text}
+    return envelope([m])
+
+def bench_orders(args):
+    from stubs import Stubs
+    os.environ['RAZORPAY_WEBHOOK_SECRET'] = 'bench-secret'
+    stubs = Stubs().start()
+    _load(stubs)
+    _no_pacing()
+    rnd    = random.Random(args.seed)
+    phones = synth_phones(args.phones, rnd)
+    fail   = []
+    items  = [{'product_retailer_id': f"SKU{i}", 'quantity': 1 + i % 2, 'item_price': 1499 + 500 * i,
+               'currency': 'INR'} for i in range(3)]
+
+    # Bulk load through the async writer
+    enq, drain, small = [], 0.0, None
+    for start in range(0, args.orders, args.chunk):
+        n  = min(args.chunk, args.orders - start)
+        t0 = time.perf_counter()
+        for i in range(start, start + n):
+            ref, ph = _bench_ref(i, phones)
+            main.record_order(ref, ph, 'Bench', 'cart', items, 749700, f"https://rzp.io/i/b{i}")
+        enq.append((time.perf_counter() - t0) / n)
+        t0 = time.perf_counter()
+        main.flush_orders()
+        drain += time.perf_counter() - t0
+        if small is None and start + n >= 10000:
+            small = _time(lambda: main.find_order(_bench_ref(rnd.randrange(start + n), phones)[0]), args.lookups)
+    size = sum(os.path.getsize(p) for p in (main.ORDERS_DB, main.ORDERS_DB + '-wal') if os.path.exists(p))
+    print(f"record_order  : {statistics.mean(enq) * 1e6:.1f} µs per order on the request path")
+    print(f"writer        : {args.orders} orders committed in {drain:.1f} s "
+          f"({args.orders / drain:,.0f}/s), {size / 2**20:.0f} MiB on disk")
+
+    # Lookups: hits, misses, small vs full ledger
+    full = _time(lambda: main.find_order(_bench_ref(rnd.randrange(args.orders), phones)[0]), args.lookups)
+    miss = _time(lambda: main.find_order(f"AJS-0000-{rnd.randrange(10**9)}"), args.lookups)
+    print(f"find_order    : p50 {_pct(small or full, .5) * 1e6:.1f} µs @ 10k | p50 {_pct(full, .5) * 1e6:.1f} µs "
+          f"p99 {_pct(full, .99) * 1e6:.1f} µs @ {args.orders:,} | miss p50 {_pct(miss, .5) * 1e6:.1f} µs")
+    for i in rnd.sample(range(args.orders), 1000):
+        ref, ph = _bench_ref(i, phones)
+        o = main.find_order(ref)
+        if not o or o['phone'] != main.wa_key(ph) or o['link'] != f"https://rzp.io/i/b{i}":
+            fail.append(('lookup', ref, o))
+
+    # References: unique within a second; a taken one is never overwritten
+    refs = []
+    for _ in range(500):
+        refs.append(main.order_ref(phones[0]))
+        main.record_order(refs[-1], phones[0], 'Bench', 'custom')
+    if len(set(refs)) != len(refs):
+        fail.append(('order_ref collided', len(refs) - len(set(refs))))
+    ref, ph = _bench_ref(0, phones)
+    main.record_order(ref, phones[1], 'Intruder', 'custom')
+    main.flush_orders()
+    if main.find_order(ref)['name'] != 'Bench' or len({main.find_order(r)['ref'] for r in refs}) != len(refs):
+        fail.append(('duplicate ref', main.find_order(ref), main.find_order(refs[0])))
+
+    # End to end: order → reference → payment webhook → reference
+    phone = synth_phones(1, rnd)[0]
+    order = synth_message('order', phone, rnd)
+    seed_customers(stubs, [envelope([order])])
+    main.app.test_client().post('/webhook', json=envelope([order]))
+    t    = main.tenant()
+    sent = re.search(r'AJS-\d{4}-\d+', json.dumps(stubs.graph.last.get(phone, {})))
+    ref  = sent.group(0) if sent else ''
+    row  = main.find_order(ref)
+    if not row or row['status'] != 'pending' or not row['link']:
+        fail.append(('order message', ref, row))
+    e2e = []
+    for status, want in (('pending', 'Payment baaki'), ('paid', 'Payment mil gaya')):   # Hinglish default
+        if status == 'paid':
+            codes = (_rzp_hook('payment_link.paid', ref, t.id, 'bench-secret'),
+                     _rzp_hook('payment_link.paid', ref, t.id, 'bench-secret', sign=False))
+            main.flush_orders()
+            if codes != (200, 401):
+                fail.append(('webhook codes', codes))
+        t0 = time.perf_counter()
+        main.app.test_client().post('/webhook', json=_text_to(phone, ref.lower()))
+        e2e.append(time.perf_counter() - t0)
+        body = json.dumps(stubs.graph.last.get(phone, {}))
+        if want not in body or ref not in body:
+            fail.append(('reply', status, body[:200]))
+    other = synth_phones(1, rnd)[0]
+    seed_customers(stubs, [_text_to(other, ref)])
+    main.app.test_client().post('/webhook', json=_text_to(other, ref))
+    if ref in json.dumps(stubs.graph.last.get(other, {})) and 'Status' in json.dumps(stubs.graph.last.get(other, {})):
+        fail.append(('other phone saw the order', stubs.graph.last.get(other)))
+    n = 2000
+    t0 = time.perf_counter()
+    for i in range(n):
+        _rzp_hook('payment_link.paid', _bench_ref(i, phones)[0], t.id, 'bench-secret')
+    hooks = time.perf_counter() - t0
+    main.flush_orders()
+    fail += [('paid', i) for i in range(0, n, 97) if main.find_order(_bench_ref(i, phones)[0])['status'] != 'paid']
+    print(f"end to end    : reference answered in {e2e[0] * 1000:.1f} ms (pending, PAY NOW) / "
+          f"{e2e[1] * 1000:.1f} ms (paid); {n / hooks:,.0f} payment webhooks/s")
+
+    stubs.stop()
+    print(f"checked       : {'all agree' if not fail else f'{len(fail)} FAILED'}")
+    for f in fail[:10]:
+        print(f"  {f}")
+    return 0 if not fail else 1
+
+# ─────────────────────────────────────────────────────────────
+# CAMPAIGN
+# manage.py campaign runs as a subprocess against the Graph stub.
+# The first run is SIGKILLed part-way (a crash: no cleanup, no final
+# journal sync); the rerun must finish the list without messaging
+# anyone twice beyond the sends that were in flight at the kill.
+# ─────────────────────────────────────────────────────────────
+
+def _campaign_csv(path: str, n: int, rnd: random.Random) -> set:
+    """n unique numbers, ~2 % repeated in another spelling, ~1 % junk. Returns the Graph 'to' values."""
+    digits = [f"98{d:08d}" for d in rnd.sample(range(10**8), n)]
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        f.write('Phone,First_Name\n')
+        for i, d in enumerate(digits):
+            f.write(f"+91{d},Guest{i}\n")
+            if rnd.random() < .02:
+                f.write(f"0{d[:5]} {d[5:]},Guest{i}\n")
+            if rnd.random() < .01:
+                f.write(f"{rnd.choice(['', 'n/a', '12345', 'call me'])},Nobody\n")
+    return {f"91{d}" for d in digits}
+
+def _campaign_run(cmd: list, env: dict, kill_after: float = None) -> tuple:
+    import subprocess, signal
+    t0   = time.perf_counter()
+    proc = subprocess.Popen(cmd, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    lines = []
+    if kill_after:
+        time.sleep(kill_after)
+        proc.send_signal(signal.SIGKILL)
+    for line in proc.stdout:
+        lines.append(line.rstrip())
+        print(f"    | {line.rstrip()}", flush=True)
+    proc.wait()
+    return proc.returncode, time.perf_counter() - t0, lines
+
+def bench_campaign(args):
+    from stubs import Stubs
+    stubs = Stubs(latency={'graph': args.latency}).start()
+    rnd   = random.Random(args.seed)
+    tmp   = tempfile.mkdtemp(prefix='bench-campaign-')
+    src   = os.path.join(tmp, 'recipients.csv')
+    jpath = os.path.join(tmp, 'welcome.journal')
+    want  = _campaign_csv(src, args.recipients, rnd)
+    env   = {**os.environ, **stubs.env(), 'TENANT_SEND_RATE': '0',
+             'ANALYTICS_DIR': tmp, 'ORDERS_DB': os.path.join(tmp, 'orders.db')}
+    cmd   = [sys.executable, 'manage.py', 'campaign', '--csv', src, '--template', 'welcome',
+             '--param', 'first_name:Customer', '--journal', jpath, '--workers', str(args.workers),
+             '--rate', str(args.rate), '--every', str(args.every)]
+    print(f"recipients    : {len(want)} unique in {os.path.getsize(src) / 2**20:.1f} MiB CSV, "
+          f"graph latency {args.latency * 1000:.0f} ms, {args.workers} workers")
+
+    print(f"run 1 (SIGKILL after {args.kill_after:.0f} s)")
+    code1, wall1, _ = _campaign_run(cmd, env, args.kill_after)
+    before = sum(stubs.graph.recipients.values())
+    print("run 2 (resume)")
+    code2, wall2, out = _campaign_run(cmd, env)
+    stubs.stop()
+
+    got    = stubs.graph.recipients
+    total  = sum(got.values())
+    twice  = sum(1 for c in got.values() if c > 1)
+    stray  = set(got) - want          # e.g. a request cut off by the kill
+    tpl    = next(iter(stubs.graph.last.values()), {}).get('template', {})
+    print(f"run 1         : {before} sent in {wall1:.1f} s (exit {code1})")
+    print(f"run 2         : {total - before} sent in {wall2:.1f} s (exit {code2})")
+    print(f"distinct sent : {len(want & set(got))} of {len(want)}   strays: {sorted(stray)[:3]}   "
+          f"messaged twice: {twice} "
+          f"(≤ in flight at the kill: {args.workers})")
+    print(f"throughput    : {total / (wall1 + wall2):,.0f} msg/s overall   "
+          f"sequential at this latency ≈ {1 / args.latency:,.0f} msg/s")
+    print(f"last template : {json.dumps(tpl)}")
+    ok = want <= set(got) and not stray - {''} and twice <= args.workers and code2 == 0
+    print("OK" if ok else "FAILED")
+    return 0 if ok else 1
+
+# ─────────────────────────────────────────────────────────────
+# MEDIA
+# Custom-order reference images from --messages phones, drawn from
+# --images distinct pictures. "inline" is the old request path: Graph
+# media URL resolved and the admin email sent before the webhook
+# returns. "pipeline" is the MEDIA STORE: the webhook only queues the
+# image; download, SHA-256 filing, thumbnail and email happen in the
+# background. Then the store is checked: one file and one thumbnail
+# per distinct image, every email carrying a link that serves it.
+# ─────────────────────────────────────────────────────────────
+
+def _inline_custom_image(media_id, ref, first_name, phone, b2b):
+    """The image branch before the media store, minus its pacing sleep."""
+    main.tx(phone, 'Analyzing the design, please wait.')
+    url = main.media_url(media_id)
+    main.admin_email(subject=f"Custom Order (Image) — {first_name} — {phone}",
+                     body=f"Ref      : {ref}\nImage URL: {url or 'See WhatsApp chat'}")
+
+def _image_orders(phones: list, rnd: random.Random, concurrency: int) -> list:
+    """One custom-order image per phone; webhook seconds per message."""
+    def one(phone):
+        main.get_session(phone)['custom_step'] = 'awaiting_description'
+        body = envelope([synth_message('image', phone, rnd)])
+        t0   = time.perf_counter()
+        main.app.test_client().post('/webhook', json=body)
+        return time.perf_counter() - t0
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        return list(ex.map(one, phones))
+
+def _drain_media(timeout: float = 300) -> float:
+    t0 = time.perf_counter()
+    while main._media_pending and time.perf_counter() - t0 < timeout:
+        time.sleep(0.01)
+    return time.perf_counter() - t0
+
+def bench_media(args):
+    from stubs import Stubs
+    import hashlib
+    from PIL import Image
+    store = tempfile.mkdtemp(prefix='bench-media-')
+    os.environ.update(MEDIA_DIR=store, MEDIA_BASE_URL='http://bot.local', MEDIA_SECRET='bench-media')
+    stubs = Stubs(latency={'graph': args.graph, 'smtp': args.smtp},
+                  graph={'images': args.images, 'image_px': args.px}).start()
+    _load(stubs)
+    _no_pacing()
+    rnd    = random.Random(args.seed)
+    phones = synth_phones(2 * args.messages, rnd)
+    stubs.shopify.seed(set(phones))
+    sizes  = sorted(len(img) for img in stubs.graph._imgs)
+    print(f"images        : {args.messages} messages per phase over {args.images} distinct "
+          f"{args.px}px JPEGs (median {sizes[len(sizes) // 2] / 1024:.0f} KiB)   graph {args.graph * 1000:.0f} ms   "
+          f"smtp {args.smtp * 1000:.0f} ms   concurrency {args.concurrency}")
+    fail, pipeline = [], main.custom_image
+
+    rows = {}
+    for name, fn, batch in (('inline', _inline_custom_image, phones[:args.messages]),
+                            ('pipeline', pipeline, phones[args.messages:])):
+        main.custom_image = fn
+        mails, dl = stubs.smtp.mails, stubs.graph.hits['media_dl']
+        t0   = time.perf_counter()
+        dts  = _image_orders(batch, rnd, args.concurrency)
+        wall = time.perf_counter() - t0
+        done = wall + _drain_media()
+        rows[name] = dts
+        print(f"{name:<14}: webhook p50 {_pct(dts, .5) * 1000:5.0f} ms  p95 {_pct(dts, .95) * 1000:5.0f} ms   "
+              f"all answered in {wall:.1f} s, all mailed in {done:.1f} s   "
+              f"downloads {stubs.graph.hits['media_dl'] - dl}")
+        if stubs.smtp.mails - mails != args.messages * len(list(filter(None, main.tenant().admins))):
+            fail.append((name, 'mails', stubs.smtp.mails - mails))
+    main.custom_image = pipeline
+
+    # The store: one original + one thumbnail per distinct image
+    files  = [os.path.join(d, f) for d, _, fs in os.walk(store) for f in fs]
+    thumbs = [f for f in files if f.endswith('.thumb.jpg')]
+    orig   = [f for f in files if f not in thumbs]
+    with main._mlock:
+        c = {label: n for (k, label), n in main._counts.items() if k == 'media'}
+    seen = c.get('stored', 0)
+    print(f"store         : {len(orig)} originals + {len(thumbs)} thumbnails, "
+          f"{sum(map(os.path.getsize, orig)) / 2**20:.1f} MiB on disk for "
+          f"{args.messages} images received ({c.get('duplicate', 0)} duplicates kept once, "
+          f"{c.get('failed', 0)} failed)")
+    if len(orig) != seen or len(thumbs) != seen or seen > args.images or c.get('failed'):
+        fail.append(('store', len(orig), len(thumbs), c))
+    for f in orig:
+        with open(f, 'rb') as fh:
+            if hashlib.sha256(fh.read()).hexdigest() != os.path.basename(f).split('.')[0]:
+                fail.append(('hash', f))
+    for f in thumbs:
+        with Image.open(f) as im:
+            if max(im.size) > main.MEDIA_THUMB_PX:
+                fail.append(('thumb size', f, im.size))
+    st = main._stat('call', 'thumbnail')
+    print(f"thumbnail     : {c.get('thumbnail', 0)} made, {st[3] / max(st[0], 1) * 1000:.1f} ms mean per "
+          f"email incl. reuse ({main.MEDIA_THUMB_PX}px)")
+
+    # The last email: stable reference, thumbnail attached, link that serves the file
+    mail = stubs.smtp.last
+    link = re.search(r'http://bot\.local(/media/\S+)', mail)
+    sha  = re.search(r'SHA-256  : ([0-9a-f]{64})', mail)
+    if not (link and sha and 'Content-Type: image/jpeg' in mail):
+        fail.append(('email', mail[:300]))
+    else:
+        c  = main.app.test_client()
+        ok = c.get(link.group(1))
+        bad = c.get(link.group(1)[:-4] + '0000')
+        print(f"email         : SHA-256 {sha.group(1)[:12]}…, thumbnail attached, "
+              f"link → {ok.status_code} ({len(ok.data) / 1024:.0f} KiB), bad signature → {bad.status_code}")
+        if ok.status_code != 200 or hashlib.sha256(ok.data).hexdigest() != sha.group(1) or bad.status_code != 404:
+            fail.append(('link', ok.status_code, bad.status_code))
+
+    stubs.stop()
+    speedup = _pct(rows['inline'], .5) / max(_pct(rows['pipeline'], .5), 1e-9)
+    print(f"webhook p50   : {speedup:.1f}× faster off the response path")
+    print(f"checked       : {'all agree' if not fail else f'{len(fail)} FAILED'}")
+    for f in fail[:10]:
+        print(f"  {f}")
+    return 0 if not fail else 1
+
+# ─────────────────────────────────────────────────────────────
+# STARTUP
+# Time from spawning a gunicorn worker to the first 200 on /health.
+# --app-dir points at another checkout (e.g. a git worktree of an
+# older commit) to compare.
+# ─────────────────────────────────────────────────────────────
+
+def _free_port() -> int:
+    import socket
+    with socket.socket() as sk:
+        sk.bind(('127.0.0.1', 0))
+        return sk.getsockname()[1]
+
+def _wait_200(url: str, timeout: float) -> float | None:
+    import urllib.request
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < timeout:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as r:
+                if r.status == 200:
+                    return time.perf_counter() - t0
+        except Exception:
+            time.sleep(0.005)
+    return None
+
+def bench_startup(args):
+    import subprocess
+    app_dir = os.path.abspath(args.app_dir or os.path.dirname(os.path.abspath(__file__)))
+    env     = {**os.environ, 'PYTHONDONTWRITEBYTECODE': '1'}
+    times   = []
+    for _ in range(args.repeat):
+        port = _free_port()
+        t0   = time.perf_counter()
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', 'main:app', '-w', '1',
+             '-b', f"127.0.0.1:{port}", '--log-level', 'warning'],
+            cwd=app_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            ok = _wait_200(f"http://127.0.0.1:{port}/health", args.timeout)
+            if ok is not None:
+                times.append(time.perf_counter() - t0)
+        finally:
+            proc.terminate()
+            proc.wait()
+    print(f"app dir       : {app_dir}")
+    if not times:
+        print("no 200 within timeout")
+        return 1
+    print(f"first 200     : p50 {_pct(times, .5) * 1000:.0f} ms  "
+          f"min {min(times) * 1000:.0f} ms  max {max(times) * 1000:.0f} ms  ({len(times)} runs)")
+    return 0
+
+# ─────────────────────────────────────────────────────────────
+# ENTRY
+# ─────────────────────────────────────────────────────────────
+
+def main_cli(argv=None) -> int:
+    ap  = argparse.ArgumentParser(description='A Jewel Studio benchmarks')
+    sub = ap.add_subparsers(dest='bench', required=True)
+
+    p = sub.add_parser('overhead', help='metrics timing layer cost')
+    p.add_argument('-n', type=int, default=20000)
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(fn=bench_overhead)
+
+    p = sub.add_parser('replay', help='replay webhooks against local stubs')
+    p.add_argument('-n', type=int, default=500, help='messages to replay')
+    p.add_argument('--payloads', help='recorded webhook bodies, one JSON per line')
+    p.add_argument('--phones', type=int, default=200, help='distinct synthetic senders')
+    p.add_argument('--concurrency', type=int, default=8)
+    p.add_argument('--warmup', type=int, default=20)
+    p.add_argument('--latency', default='', help='per-upstream seconds, e.g. graph=0.05,shopify=0.3')
+    p.add_argument('--errors', default='', help='per-upstream error rate, e.g. gemini=0.2')
+    p.add_argument('--pace', action='store_true', help='keep the _p() sleeps between sends')
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--json', help='write the report here')
+    p.add_argument('--baseline', help='compare against a previous --json report')
+    p.set_defaults(fn=bench_replay)
+
+    p = sub.add_parser('batch', help='multi-entry deliveries, serial vs parallel')
+    p.add_argument('--size', type=int, default=100, help='messages per delivery')
+    p.add_argument('--senders', type=int, default=25, help='distinct phones per delivery')
+    p.add_argument('--deliveries', type=int, default=10)
+    p.add_argument('--workers', type=int, default=8)
+    p.add_argument('--latency', default='graph=0.02,shopify=0.08,sheets=0.05,gemini=0.3')
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(fn=bench_batch)
+
+    p = sub.add_parser('statuses', help='status callback throughput')
+    p.add_argument('--messages', type=int, default=5000)
+    p.add_argument('--per-post', type=int, default=10)
+    p.add_argument('--fail', type=float, default=0.02)
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(fn=bench_statuses)
+
+    p = sub.add_parser('catalog', help='catalog load and hot reload')
+    p.add_argument('--collections', type=int, default=10000)
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(fn=bench_catalog)
+
+    p = sub.add_parser('startup', help='time to first 200 under gunicorn')
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--timeout', type=float, default=30)
+    p.add_argument('--app-dir', help='checkout to start (default: this one)')
+    p.set_defaults(fn=bench_startup)
+
+    p = sub.add_parser('text', help='language/keyword/design analysis per message')
+    p.add_argument('--corpus', default=_CORPUS)
+    p.add_argument('--rounds', type=int, default=200)
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--show', type=int, default=20, help='differences to list')
+    p.set_defaults(fn=bench_text)
+
+    p = sub.add_parser('search', help='fuzzy_search precision / recall / Aru fall-through per scorer and threshold')
+    p.add_argument('--corpus', default=_SEARCH_CORPUS)
+    p.add_argument('--scorers', type=lambda v: v.split(','), default=['token_sort_ratio', 'token_set_ratio', 'WRatio',
+                   'partial_ratio', 'partial_token_sort_ratio', 'QRatio', 'ratio'])
+    p.add_argument('--lo', type=int, default=40)
+    p.add_argument('--hi', type=int, default=90)
+    p.add_argument('--step', type=int, default=5)
+    p.add_argument('--sweep', action='store_true', help='every threshold for the current scorer')
+    p.add_argument('--aru-ms', type=float, default=1500, help='cost of one Aru (Gemini) answer, ms')
+    p.add_argument('--repeat', type=int, default=20, help='timings per query (best kept)')
+    p.add_argument('--show', type=int, default=15, help='misses listed for the current setting')
+    p.set_defaults(fn=bench_search)
+
+    p = sub.add_parser('analytics', help='analytics emit cost and backpressure')
+    p.add_argument('-n', type=int, default=200000, help='events in the burst')
+    p.add_argument('--queue', type=int, default=20000)
+    p.add_argument('--batch', type=int, default=5000)
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(fn=bench_analytics)
+
+    p = sub.add_parser('tenants', help='memory per tenant vs per deployment')
+    p.add_argument('-n', type=int, default=50, help='extra tenants')
+    p.add_argument('--messages', type=int, default=40, help='messages per tenant')
+    p.add_argument('--phones', type=int, default=20, help='senders per tenant')
+    p.add_argument('--concurrency', type=int, default=8)
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--trace', action='store_true', help='tracemalloc the tenants (slower, inflates RSS)')
+    p.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    p.set_defaults(fn=bench_tenants)
+
+    p = sub.add_parser('customers', help='Shopify customer index at 200k customers')
+    p.add_argument('--customers', type=int, default=200000)
+    p.add_argument('--check', type=int, default=5000, help='customers sampled for agreement')
+    p.add_argument('--changes', type=int, default=50, help='customers updated + created before a poll')
+    p.add_argument('--live-latency', type=float, default=0.15, help='stub search latency, seconds')
+    p.add_argument('--page-latency', type=float, default=0.02, help='stub customers.json latency, seconds')
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(fn=bench_customers)
+
+    p = sub.add_parser('phones', help='E.164 keys, dedup-sheets, lookup agreement')
+    p.add_argument('--rows', type=int, default=5000, help='distinct numbers in the sheet')
+    p.add_argument('--dups', type=float, default=0.15, help='share of numbers registered twice')
+    p.add_argument('--check', type=int, default=100, help='numbers looked up in every spelling')
+    p.add_argument('--rounds', type=int, default=20)
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(fn=bench_phones)
+
+    p = sub.add_parser('budget', help='tail latency with slow upstreams, budget off vs on')
+    p.add_argument('-n', type=int, default=80, help='messages per run')
+    p.add_argument('--phones', type=int, default=30)
+    p.add_argument('--budget', type=float, default=8.0, help='MESSAGE_BUDGET_SECONDS for the second run')
+    p.add_argument('--gemini', type=float, default=6.0, help='stub latency, seconds')
+    p.add_argument('--shopify', type=float, default=1.5)
+    p.add_argument('--sheets', type=float, default=1.0)
+    p.add_argument('--graph', type=float, default=0.05)
+    p.add_argument('--concurrency', type=int, default=8)
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(fn=bench_budget)
+
+    p = sub.add_parser('breakers', help='fault injection: upstream outage, breakers off vs on')
+    p.add_argument('-n', type=int, default=60, help='messages per phase')
+    p.add_argument('--phones', type=int, default=30)
+    p.add_argument('--hang', type=float, default=30.0, help='stub latency during the outage, seconds')
+    p.add_argument('--open', type=float, default=5.0, help='BREAKER_OPEN_SECONDS')
+    p.add_argument('--concurrency', type=int, default=8)
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(fn=bench_breakers)
+
+    p = sub.add_parser('orders', help='order ledger at 1M orders')
+    p.add_argument('--orders', type=int, default=1000000)
+    p.add_argument('--chunk', type=int, default=50000, help='orders queued before each drain')
+    p.add_argument('--phones', type=int, default=50000)
+    p.add_argument('--lookups', type=int, default=20000)
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(fn=bench_orders)
+
+    p = sub.add_parser('campaign', help='100k template campaign with a crash and resume')
+    p.add_argument('--recipients', type=int, default=100000)
+    p.add_argument('--latency', type=float, default=0.05, help='Graph stub latency, seconds')
+    p.add_argument('--workers', type=int, default=32)
+    p.add_argument('--rate', type=float, default=0, help='campaign --rate (0 = unpaced)')
+    p.add_argument('--kill-after', type=float, default=20.0, help='seconds before SIGKILL of run 1')
+    p.add_argument('--every', type=float, default=10.0)
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(fn=bench_campaign)
+
+    p = sub.add_parser('prefetch', help='collection opens: no cache vs cache vs prefetch')
+    p.add_argument('--sessions', type=int, default=200, help='browsing sessions per phase')
+    p.add_argument('--learn', type=int, default=200, help='sessions before measuring')
+    p.add_argument('--phones', type=int, default=100)
+    p.add_argument('--graph', type=float, default=0.15, help='Graph stub latency, seconds')
+    p.add_argument('--think', type=float, default=0.5, help='seconds between a customer\'s taps')
+    p.add_argument('--ttl', type=float, help='PRODUCTS_TTL_SECONDS while measuring (default: the setting)')
+    p.add_argument('--concurrency', type=int, default=8)
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(fn=bench_prefetch)
+
+    p = sub.add_parser('cluster', help='multi-node: ownership, forwarding, leave/crash/join')
+    p.add_argument('--nodes', type=int, default=3)
+    p.add_argument('--phones', type=int, default=200)
+    p.add_argument('--rounds', type=int, default=3, help='messages per phone after the first')
+    p.add_argument('--hops', type=int, default=200, help='status deliveries timed per path')
+    p.add_argument('--concurrency', type=int, default=16)
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(fn=bench_cluster)
+
+    p = sub.add_parser('workers', help='gunicorn sync vs gthread under concurrent webhooks')
+    p.add_argument('--setups', default=','.join(_WORKER_SETUPS), help=f"comma list of: {', '.join(_WORKER_SETUPS)}")
+    p.add_argument('--clients', type=int, default=200)
+    p.add_argument('--seconds', type=float, default=20)
+    p.add_argument('--phones', type=int, default=2000)
+    p.add_argument('--graph', type=float, default=0.05, help='Graph stub latency, seconds')
+    p.add_argument('--gemini', type=float, default=0.5, help='Gemini stub latency, seconds')
+    p.add_argument('--storm', type=int, default=30, help='parallel requests in the race checks')
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(fn=bench_workers)
+
+    p = sub.add_parser('profile', help='/admin/profile overhead, output and CPU/wait attribution')
+    p.add_argument('--hz', type=lambda v: [int(x) for x in v.split(',')], default=[50, 200],
+                   help='comma list of sampling rates')
+    p.add_argument('--clients', type=int, default=32)
+    p.add_argument('--seconds', type=float, default=15)
+    p.add_argument('--threads', type=int, default=64)
+    p.add_argument('--phones', type=int, default=2000)
+    p.add_argument('--graph', type=float, default=0.05, help='Graph stub latency, seconds')
+    p.add_argument('--top', type=int, default=6, help='main.py frames listed per kind')
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(fn=bench_profile)
+
+    p = sub.add_parser('overload', help='traffic spike past capacity, admission control off vs on')
+    p.add_argument('--threads', type=int, default=16, help='gunicorn threads on the node')
+    p.add_argument('--rate', type=float, default=80, help='webhooks offered per second')
+    p.add_argument('--seconds', type=float, default=40)
+    p.add_argument('--timeout', type=float, default=15, help='client timeout, seconds (Meta gives up and retries)')
+    p.add_argument('--soft', type=int, help='ADMIT_SOFT_INFLIGHT (default 3/8 of threads)')
+    p.add_argument('--max', type=int, help='ADMIT_MAX_INFLIGHT (default 3/4 of threads)')
+    p.add_argument('--phones', type=int, default=2000)
+    p.add_argument('--graph', type=float, default=0.05, help='Graph stub latency, seconds')
+    p.add_argument('--gemini', type=float, default=1.0, help='Gemini stub latency, seconds')
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(fn=bench_overload)
+
+    p = sub.add_parser('media', help='custom-order images: inline vs background media store')
+    p.add_argument('--messages', type=int, default=200, help='image messages per phase')
+    p.add_argument('--images', type=int, default=40, help='distinct images among them')
+    p.add_argument('--px', type=int, default=1600, help='image width')
+    p.add_argument('--graph', type=float, default=0.1, help='Graph stub latency, seconds')
+    p.add_argument('--smtp', type=float, default=0.3, help='SMTP stub latency, seconds')
+    p.add_argument('--concurrency', type=int, default=8)
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(fn=bench_media)
+
+    args = ap.parse_args(argv)
+    return args.fn(args)
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+A JEWEL STUDIO — Gunicorn settings
+
+Read automatically by `gunicorn main:app` (Procfile). Every value can
+be overridden with the GUNICORN_* variables below or on the command line.
+
+One process, many threads. Sessions, dedup, the product cache and the
+order ledger writer live in the process, so a second worker process
+would split conversations. Scale a node up with threads, and out with
+more nodes (see CLUSTER in main.py). The gthread worker parks each
+webhook on a thread while it waits on Graph, Shopify, Sheets or
+Gemini; `python bench.py workers` compares it with the sync worker.
+Keep threads above ADMIT_MAX_INFLIGHT (main.py, ADMISSION CONTROL),
+so that past the limit there are threads left to answer 503 at once.
+
+gevent also runs main:app (GUNICORN_WORKER=gevent, with gevent
+installed). It is not the default. google-generativeai talks gRPC
+unless configured for REST, and gRPC needs its own gevent setup. The
+order ledger's sqlite3 calls block the whole hub. gevent is also not
+in requirements.txt.
+"""
+
+import os
+
+bind               = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class       = os.getenv('GUNICORN_WORKER', 'gthread')
+workers            = int(os.getenv('GUNICORN_WORKERS', '1'))      # >1 splits sessions — see above
+threads            = int(os.getenv('GUNICORN_THREADS', '256'))    # concurrent webhooks per process; > ADMIT_MAX_INFLIGHT
+worker_connections = int(os.getenv('GUNICORN_CONNECTIONS', '500'))  # gevent only
+timeout            = int(os.getenv('GUNICORN_TIMEOUT', '30'))     # > MESSAGE_BUDGET_SECONDS
+graceful_timeout   = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '20'))  # cluster session handoff on stop
+keepalive          = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+backlog            = 2048
+preload_app        = False     # main starts background threads at import; they must start in the worker
+accesslog          = None
+errorlog           = '-'
+loglevel           = os.getenv('GUNICORN_LOG_LEVEL', 'warning')
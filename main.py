@@ -14,17 +14,22 @@ CHANGES
 8. All previous: dedup, 10-row limit, Men scroll list, Aru, fuzzy search
 """
 
-import os, json, logging, time, re, smtplib
+import os, sys, json, logging, time, re, smtplib, threading, functools, random, heapq, gzip, hashlib, hmac, base64, atexit, itertools, sqlite3
+from contextlib import contextmanager
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from logging.handlers import RotatingFileHandler
+from bisect import bisect_left
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
+from email.mime.image import MIMEImage
+from datetime import datetime, timedelta, timezone
+from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
-import requests, gspread
-from google.oauth2.service_account import Credentials
-import razorpay
-import google.generativeai as genai
-from rapidfuzz import fuzz, process
+import requests
+from rapidfuzz import fuzz, process, utils
+# gspread, google-auth, razorpay and google.generativeai are imported lazily — see SDK CLIENTS
+# pyarrow is optional — see ANALYTICS; Pillow is imported on first thumbnail — see MEDIA STORE
 
 # ─────────────────────────────────────────────────────────────
 # APP
@@ -55,336 +60,1517 @@ GMAIL_PASS    = os.getenv('GMAIL_PASSWORD', '')
 ADMIN_1       = os.getenv('ADMIN_EMAIL_1', 'axaysoni90@gmail.com')
 ADMIN_2       = os.getenv('ADMIN_EMAIL_2', 'mahaajanakshay@gmail.com')
 
-WA_API        = f"https://graph.facebook.com/v19.0/{WA_PHONE_ID}/messages"
+TRACE_SAMPLE    = float(os.getenv('TRACE_SAMPLE', '0.05'))   # fraction of messages with spans
+SLOW_TRACE_MS   = float(os.getenv('SLOW_TRACE_MS', '5000'))
+SLOW_TRACE_FILE = os.getenv('SLOW_TRACE_FILE', 'slow_traces.jsonl')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))        # phones handled in parallel per delivery
+HTTP_POOL       = int(os.getenv('HTTP_POOL_SIZE', '256'))         # keep-alive connections per upstream host (≈ gunicorn threads)
+SDK_POOL        = int(os.getenv('SDK_POOL_SIZE', '16'))           # Sheets / Razorpay clients per tenant, each used by one thread at a time
+SHOPIFY_SYNC_S  = float(os.getenv('SHOPIFY_SYNC_SECONDS', '300'))  # customer index poll; 0 = live search per message
+SHEETS_TTL_S    = float(os.getenv('SHEETS_LOOKUP_TTL_SECONDS', '300'))  # Registrations answer for a phone not in the store is reused this long
+SHOPIFY_HOOK_SECRET = os.getenv('SHOPIFY_WEBHOOK_SECRET', '')
+RZP_HOOK_SECRET = os.getenv('RAZORPAY_WEBHOOK_SECRET', '')
+ORDERS_DB       = os.getenv('ORDERS_DB', 'orders.db')               # '' disables the order ledger
+TENANTS_FILE    = os.getenv('TENANTS_FILE', '')                  # extra WhatsApp numbers — see TENANTS
+TENANT_RATE     = float(os.getenv('TENANT_SEND_RATE', '80'))     # sends/second per number (0 = unlimited)
+ANALYTICS_DIR   = os.getenv('ANALYTICS_DIR', 'analytics')         # '' disables the event stream
+ANALYTICS_QUEUE = int(os.getenv('ANALYTICS_QUEUE', '20000'))      # events held in memory before dropping
+ANALYTICS_BATCH = int(os.getenv('ANALYTICS_BATCH', '5000'))       # events per file, at most
+ANALYTICS_FLUSH = float(os.getenv('ANALYTICS_FLUSH_SECONDS', '60'))
+MSG_BUDGET_S    = float(os.getenv('MESSAGE_BUDGET_SECONDS', '8'))    # per-message deadline; 0 = none
+CALL_FLOOR_S    = float(os.getenv('CALL_MIN_TIMEOUT_SECONDS', '1'))  # an overdue call still gets this long
+ARU_MIN_S       = float(os.getenv('ARU_MIN_SECONDS', '3'))           # less left than this → no Gemini call
+PROFILE_MAX_S   = float(os.getenv('PROFILE_TIMEOUT_SECONDS', '2.5')) # live Shopify profile search
+BREAKER_WINDOW     = int(os.getenv('BREAKER_WINDOW_CALLS', '20'))      # latest outcomes a breaker judges on
+BREAKER_MIN_CALLS  = int(os.getenv('BREAKER_MIN_CALLS', '5'))          # fewer calls than this never trip
+BREAKER_ERROR_RATE = float(os.getenv('BREAKER_ERROR_RATE', '0.5'))
+BREAKER_SLOW_SHARE = float(os.getenv('BREAKER_SLOW_SHARE', '0.8'))     # a call taking this share of its timeout counts as slow…
+BREAKER_SLOW_S     = float(os.getenv('BREAKER_SLOW_SECONDS', '8'))     # …or this long, for a call with no timeout of its own…
+BREAKER_SLOW_RATE  = float(os.getenv('BREAKER_SLOW_RATE', '0.5'))      # …and this share of slow calls trips
+BREAKER_FAIR_S     = float(os.getenv('BREAKER_FAIR_SECONDS', '5'))     # a timeout the budget cut below this isn't held against the upstream
+BREAKER_OPEN_S     = float(os.getenv('BREAKER_OPEN_SECONDS', '30'))    # open → one half-open probe after this
+PREFETCH_TOP_K     = int(os.getenv('PREFETCH_TOP_K', '3'))             # collections warmed per menu shown; 0 = off
+PREFETCH_MIN_P     = float(os.getenv('PREFETCH_MIN_PROBABILITY', '0.1'))  # rarer next taps aren't fetched
+PREFETCH_MIN_SEEN  = int(os.getenv('PREFETCH_MIN_TRANSITIONS', '5'))   # taps seen from a menu before predicting
+PREFETCH_PENDING   = int(os.getenv('PREFETCH_MAX_PENDING', '16'))      # background fetches queued or running
+PREFETCH_WAIT_S    = float(os.getenv('PREFETCH_WAIT_SECONDS', '0.5'))  # a tap waits this long on an unfinished prefetch
+PRODUCTS_TTL_S     = float(os.getenv('PRODUCTS_TTL_SECONDS', '300'))   # collection product lists kept this long
+PRODUCTS_MAX       = int(os.getenv('PRODUCTS_CACHE_MAX', '2000'))
+CLUSTER_SELF       = os.getenv('CLUSTER_SELF_URL', '').rstrip('/')      # this node as peers reach it; '' = one node
+CLUSTER_NODES      = [u.strip().rstrip('/') for u in os.getenv('CLUSTER_NODES', '').split(',') if u.strip()]
+CLUSTER_SECRET     = os.getenv('CLUSTER_SECRET', '')                   # signs node-to-node requests
+CLUSTER_VNODES     = int(os.getenv('CLUSTER_VNODES', '128'))           # ring points per node
+CLUSTER_BEAT_S     = float(os.getenv('CLUSTER_HEARTBEAT_SECONDS', '2'))
+CLUSTER_DEAD_S     = float(os.getenv('CLUSTER_DEAD_SECONDS', '6'))     # no heartbeat answer for this long → off the ring
+CLUSTER_FORWARD_S  = float(os.getenv('CLUSTER_FORWARD_SECONDS', '2'))  # owner must accept a forward within this
+MEDIA_DIR          = os.getenv('MEDIA_DIR', 'media')                   # '' = don't keep customer images
+MEDIA_BASE_URL     = os.getenv('MEDIA_BASE_URL', CLUSTER_SELF).rstrip('/')  # this node as admins reach it; '' = no links
+MEDIA_SECRET       = os.getenv('MEDIA_SECRET', '')                     # signs /media links; '' = not served
+MEDIA_MAX_BYTES    = int(os.getenv('MEDIA_MAX_BYTES', str(16 << 20)))  # larger downloads are abandoned
+MEDIA_THUMB_PX     = int(os.getenv('MEDIA_THUMB_PX', '320'))           # longest thumbnail side
+MEDIA_WORKERS      = int(os.getenv('MEDIA_WORKERS', '8'))               # downloads + admin emails in flight
+ADMIT_SOFT         = int(os.getenv('ADMIT_SOFT_INFLIGHT', '96'))       # webhooks in flight before Aru/vision are shed
+ADMIT_MAX          = int(os.getenv('ADMIT_MAX_INFLIGHT', '192'))       # …before all but orders get 503; 0 = no admission control
+ADMIT_QUEUE_S      = float(os.getenv('ADMIT_QUEUE_SECONDS', '0.5'))    # standing queue delay that sheds; twice this refuses
+ADMIT_WINDOW_S     = float(os.getenv('ADMIT_WINDOW_SECONDS', '1'))     # queue delay = smallest wait over this window
+ADMIT_RETRY_S      = int(os.getenv('ADMIT_RETRY_AFTER_SECONDS', '30')) # Retry-After on a 503
+ADMIN_TOKEN        = os.getenv('ADMIN_TOKEN', '')                      # Bearer token for /admin/*; '' = disabled
+PROFILER_HZ        = int(os.getenv('PROFILER_HZ', '50'))               # default samples/second of /admin/profile
+PROFILER_MAX_S     = float(os.getenv('PROFILER_MAX_SECONDS', '60'))
+FUZZY_SCORER       = os.getenv('FUZZY_SCORER', 'token_sort_ratio')     # see FUZZY SEARCH; `bench.py search` compares them
+FUZZY_THRESHOLD    = float(os.getenv('FUZZY_THRESHOLD', '55'))         # best score below this → no collection (Aru)
+FUZZY_NORMALIZE    = os.getenv('FUZZY_NORMALIZE', '0') == '1'          # lowercase + strip punctuation before scoring
+
+# Upstream base URLs — overridable so the bot can run against local stubs (bench.py)
+GRAPH_API     = os.getenv('GRAPH_API_BASE', 'https://graph.facebook.com/v19.0')
+SHOPIFY_API   = os.getenv('SHOPIFY_API_BASE', f"https://{SHOPIFY_STORE}/admin/api/2024-01")
+RZP_API       = os.getenv('RAZORPAY_API_BASE', '')
+SMTP_HOST     = os.getenv('SMTP_HOST', 'smtp.gmail.com')
+SMTP_PORT     = int(os.getenv('SMTP_PORT', '465'))
+SMTP_SSL      = os.getenv('SMTP_SSL', '1') == '1'
+
 CONTACT_WA    = "https://wa.me/918141356990"
 CONTACT_PHONE = "+91 81413 56990"
 CONTACT_EMAIL = "ajewelstudio@gmail.com"
 
 # ─────────────────────────────────────────────────────────────
-# GEMINI
+# METRICS
+# Latency histograms, call/error counts and in-flight gauges for
+# the hot path. Rendered in Prometheus text format on /metrics.
+# ─────────────────────────────────────────────────────────────
+
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_metrics: dict = {}     # (family, label) → [count, errors, inflight, sum, buckets]
+_mlock   = threading.Lock()
+
+def _stat(family: str, label: str) -> list:
+    st = _metrics.get((family, label))
+    if st is None:
+        with _mlock:
+            st = _metrics.setdefault(
+                (family, label), [0, 0, 0, 0.0, [0] * (len(_BUCKETS) + 1)])
+    return st
+
+def _call(family: str, label: str, fn, args=(), kwargs=None, ok=None):
+    """
+    Run fn and record it under (family, label).
+    A call is an error if it raises, or if ok(result) is falsy.
+    """
+    st = _stat(family, label)
+    with _mlock:
+        st[2] += 1
+    tr = _tls.trace
+    if tr is not None and tr['spans'] is not None:
+        tr['depth'] += 1
+    t0, err = time.perf_counter(), True
+    try:
+        res = fn(*args, **(kwargs or {}))
+        err = ok is not None and not ok(res)
+        return res
+    finally:
+        dt = time.perf_counter() - t0
+        i  = bisect_left(_BUCKETS, dt)
+        with _mlock:
+            st[0] += 1
+            st[1] += err
+            st[2] -= 1
+            st[3] += dt
+            st[4][i] += 1
+        if tr is not None and tr['spans'] is not None:
+            tr['depth'] -= 1
+            tr['spans'].append({
+                'name':  label if family == 'call' else f"{family}.{label}",
+                'depth': tr['depth'],
+                'at_ms': round((t0 - tr['t0']) * 1000, 2),
+                'ms':    round(dt * 1000, 2),
+                'error': bool(err),
+            })
+
+def _not_failed(res) -> bool:
+    return res is not False
+
+def timed(name: str, ok=None):
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return _call('call', name, fn, args, kwargs, ok)
+        return wrapper
+    return deco
+
+def observe(family: str, label: str, seconds: float, err: bool = False):
+    """Record a duration that wasn't measured by _call (e.g. delivery latency)."""
+    st = _stat(family, label)
+    i  = bisect_left(_BUCKETS, seconds)
+    with _mlock:
+        st[0] += 1
+        st[1] += err
+        st[3] += seconds
+        st[4][i] += 1
+
+_counts: dict = {}     # (name, label) → int
+
+def count(name: str, label: str = '', n: int = 1):
+    with _mlock:
+        _counts[(name, label)] = _counts.get((name, label), 0) + n
+
+_FAMILIES = {
+    'call':     ('bot_call',     'fn',     'External / hot-path function calls'),
+    'handle':   ('bot_handle',   'type',   'handle() per WhatsApp message type'),
+    'delivery': ('bot_delivery', 'stage',  'WhatsApp send → delivered/read latency'),
+    'route':    ('bot_route',    'route',  'Routed replies and keyword intents'),
+    'init':     ('bot_init',     'client', 'Lazy SDK client construction'),
+}
+_COUNTERS = {
+    'statuses': ('bot_statuses_total', 'status', 'Delivery status callbacks received'),
+    'retries':  ('bot_retries_total',  'result', 'Failed sends re-queued / retried / given up'),
+    'routes':   ('bot_routes_total',   'result', 'Reply IDs / phone_number_ids with no route'),
+    'route_cache': ('bot_route_cache_total', 'result', 'Cacheable routes replayed from the reply cache (hit) or run (miss)'),
+    'analytics': ('bot_analytics_events_total', 'result', 'Analytics events queued / dropped / written / failed'),
+    'customers': ('bot_customer_lookups_total', 'result', 'customer_status() from the index (hit/miss), or live search (before the index loads, or confirming a miss); sheets_cached: Registrations answer reused'),
+    'degraded':  ('bot_degraded_total', 'step', 'Steps skipped or served from cache to stay inside the message budget'),
+    'breakers':  ('bot_breaker_events_total', 'event', 'Circuit breaker trips, recoveries, rejected calls and budget-cut timeouts per tenant:upstream'),
+    'orders':    ('bot_orders_total', 'event', 'Order ledger writes, reference lookups and payment webhooks'),
+    'cluster':   ('bot_cluster_total', 'event', 'Webhook parts forwarded / received / handled here after a failed forward / left to a slow owner, ring changes, sessions handed over'),
+    'prefetch':  ('bot_prefetch_total', 'result', 'Collection opens served by a prefetch (hit) or not (miss); opens that outwaited their prefetch (late); prefetches issued, skipped, wasted'),
+    'media':     ('bot_media_total', 'result', 'Customer images stored, already stored (duplicate), failed; thumbnails made'),
+    'shed':      ('bot_shed_total', 'step', 'Optional steps skipped under load (aru, vision, pacing) and messages refused with 503 (refused)'),
+}
+_gauges: list = []     # callables returning {metric_name: value}
+
+def render_metrics() -> str:
+    with _mlock:
+        snap = sorted((k, [st[0], st[1], st[2], st[3], list(st[4])])
+                      for k, st in _metrics.items())
+    out = []
+    for family, (name, lbl, doc) in _FAMILIES.items():
+        rows = [(label, st) for (fam, label), st in snap if fam == family]
+        if not rows:
+            continue
+        out += [f"# HELP {name}_seconds {doc}.",
+                f"# TYPE {name}_seconds histogram"]
+        for label, (count, _, _, total, buckets) in rows:
+            acc = 0
+            for le, n in zip(_BUCKETS + ('+Inf',), buckets):
+                acc += n
+                out.append(f'{name}_seconds_bucket{{{lbl}="{label}",le="{le}"}} {acc}')
+            out.append(f'{name}_seconds_sum{{{lbl}="{label}"}} {total:.6f}')
+            out.append(f'{name}_seconds_count{{{lbl}="{label}"}} {count}')
+        out.append(f"# TYPE {name}_errors_total counter")
+        out += [f'{name}_errors_total{{{lbl}="{label}"}} {st[1]}' for label, st in rows]
+        out.append(f"# TYPE {name}_inflight gauge")
+        out += [f'{name}_inflight{{{lbl}="{label}"}} {st[2]}' for label, st in rows]
+    with _mlock:
+        counts = sorted(_counts.items())
+    for key, (name, lbl, doc) in _COUNTERS.items():
+        rows = [(label, n) for (k, label), n in counts if k == key]
+        if rows:
+            out += [f"# HELP {name} {doc}.", f"# TYPE {name} counter"]
+            out += [f'{name}{{{lbl}="{label}"}} {n}' for label, n in rows]
+    gauges = {'bot_sessions': all_sessions()}
+    for fn in _gauges:
+        gauges.update(fn())
+    for name, v in gauges.items():
+        out += [f"# TYPE {name} gauge", f"{name} {v}"]
+    return '\n'.join(out) + '\n'
+
+# ─────────────────────────────────────────────────────────────
+# TRACING
+# One trace per webhook message. Sampled traces collect a span for
+# every timed call made inside handle(); any message slower than
+# SLOW_TRACE_MS is written as one JSON line to SLOW_TRACE_FILE.
+# ─────────────────────────────────────────────────────────────
+
+class _Local(threading.local):
+    trace    = None
+    tenant   = None
+    deadline = None     # perf_counter() the current message must finish by
+    degraded = None     # steps degraded for it — see TIME BUDGET
+    cut      = None     # last call_timeout() if the budget made it shorter than asked
+    cap      = None     # what that call_timeout() asked for
+    capture  = None     # payloads sent by the route being cached — see REPLY CACHE
+
+_tls      = _Local()
+_slow_log = logging.getLogger('slow_trace')
+_slow_log.propagate = False
+
+def _slow_handler():
+    if not _slow_log.handlers:
+        h = RotatingFileHandler(SLOW_TRACE_FILE, maxBytes=10 * 1024 * 1024,
+                                backupCount=5, encoding='utf-8')
+        h.setFormatter(logging.Formatter('%(message)s'))
+        _slow_log.addHandler(h)
+        _slow_log.setLevel(logging.INFO)
+    return _slow_log
+
+def trace_begin(msg: dict) -> dict:
+    tr = {
+        'trace_id': os.urandom(8).hex(),
+        'msg_id':   msg.get('id', ''),
+        'type':     msg.get('type') or 'unknown',
+        'start':    time.time(),
+        't0':       time.perf_counter(),
+        'depth':    0,
+        'spans':    [] if random.random() < TRACE_SAMPLE else None,
+        'event':    {} if ANALYTICS_DIR else None,
+    }
+    _tls.trace = tr
+    return tr
+
+def trace_end(tr: dict, phone: str, error: str | None = None):
+    _tls.trace = None
+    total_ms = (time.perf_counter() - tr['t0']) * 1000
+    ev = tr['event']
+    if ev is not None:
+        ev.update(ts=tr['start'], tenant=tenant().name, user=user_key(phone), type=tr['type'],
+                  ms=round(total_ms, 1), error=error, degraded=','.join(_tls.degraded or ()) or None)
+        emit(ev)
+    if total_ms < SLOW_TRACE_MS:
+        return
+    try:
+        spans = tr['spans']
+        _slow_handler().info(json.dumps({
+            'trace_id': tr['trace_id'],
+            'msg_id':   tr['msg_id'],
+            'phone':    f"…{phone[-4:]}",
+            'type':     tr['type'],
+            'start':    datetime.fromtimestamp(tr['start']).isoformat(),
+            'total_ms': round(total_ms, 1),
+            'sampled':  spans is not None,
+            'error':    error,
+            'degraded': _tls.degraded or None,
+            'spans':    sorted(spans, key=lambda sp: (sp['at_ms'], sp['depth'])) if spans is not None else None,
+        }, ensure_ascii=False))
+        log.warning(f"Slow message {tr['trace_id']} ({tr['type']}): {total_ms:.0f} ms")
+    except Exception as e:
+        log.error(f"Slow trace: {e}")
+
+# ─────────────────────────────────────────────────────────────
+# TIME BUDGET
+# Each message must finish within MESSAGE_BUDGET_SECONDS of its
+# delivery being picked up (the first message of a delivery also
+# pays for the profile lookup). Integration calls use the remaining
+# slice as their timeout — never less than CALL_MIN_TIMEOUT_SECONDS,
+# so a late reply is still sent — and optional steps degrade when
+# the budget runs low: Aru is skipped for the static menu, the
+# profile comes from the session, pacing sleeps are dropped. Every
+# degradation is counted and recorded on the message's event.
+# ─────────────────────────────────────────────────────────────
+
+def budget_begin():
+    _tls.deadline = time.perf_counter() + MSG_BUDGET_S if MSG_BUDGET_S > 0 else None
+    _tls.degraded = []
+
+def budget_end():
+    _tls.deadline = _tls.degraded = None
+
+def remaining() -> float:
+    """Seconds left for the message being handled (inf outside one)."""
+    dl = _tls.deadline
+    return float('inf') if dl is None else dl - time.perf_counter()
+
+def call_timeout(cap: float) -> float:
+    t = min(cap, max(remaining(), CALL_FLOOR_S))
+    _tls.cut = t if t < cap else None
+    _tls.cap = cap
+    return t
+
+def degrade(step: str):
+    count('degraded', step)
+    d = _tls.degraded
+    if d is not None and step not in d:
+        d.append(step)
+
+def afford(step: str, seconds: float) -> bool:
+    """True if `seconds` are left; otherwise records `step` as degraded."""
+    if shed(step):
+        return False
+    if remaining() >= seconds:
+        return True
+    degrade(step)
+    return False
+
+# ─────────────────────────────────────────────────────────────
+# CIRCUIT BREAKERS
+# One per tenant and upstream — tenants have their own stores, sheets
+# and keys, so one tenant's outage doesn't cut off the others.
+# Closed: calls go through and the outcomes of the last
+# BREAKER_WINDOW_CALLS are kept. Once the window holds
+# BREAKER_MIN_CALLS and too many failed or were slow, it opens.
+# Slow is judged against the call's own timeout: BREAKER_SLOW_SHARE
+# of what it asked call_timeout() for, or of MESSAGE_BUDGET_SECONDS
+# if that is shorter — Gemini taking 6 s of its 10 is working. Open:
+# calls raise BreakerOpen at once, which the integration's own
+# `except` turns into its usual fallback. After BREAKER_OPEN_SECONDS
+# one call is let through half-open — success closes the breaker,
+# failure opens it again. A call that ran out because the message
+# budget cut its timeout below BREAKER_FAIR_SECONDS isn't held
+# against the upstream: it never had a fair chance to answer. State
+# is on /health.
+#
+#     with breaker('shopify').call():
+#         r = t.http.get(...)
 # ─────────────────────────────────────────────────────────────
 
-if GEMINI_KEY:
+class BreakerOpen(Exception):
+    pass
+
+def slow_after(cap: float = None) -> float:
+    """Seconds past which a call asking call_timeout(cap) counts as slow."""
+    if not cap:
+        return BREAKER_SLOW_S
+    return BREAKER_SLOW_SHARE * (min(cap, MSG_BUDGET_S) if MSG_BUDGET_S else cap)
+
+class Breaker:
+    def __init__(self, name: str, tid: str = ''):
+        self.name    = name
+        self.label   = f"{tid}:{name}" if tid else name
+        self.state   = 'closed'
+        self.opened  = 0.0          # time.time() of the last trip
+        self.trips   = 0
+        self.window  = deque(maxlen=BREAKER_WINDOW)   # (failed, slow)
+        self.probing = False
+        self._lock   = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.time() - self.opened >= BREAKER_OPEN_S:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self.probing:
+                self.probing = True
+                return True
+        count('breakers', f"{self.label}:rejected")
+        return False
+
+    def record(self, failed: bool, seconds: float, cap: float = None):
+        slow = seconds >= slow_after(cap)
+        with self._lock:
+            if self.state == 'half_open':
+                self.probing = False
+                if failed or slow:
+                    self._open()
+                else:
+                    self.state = 'closed'
+                    self.window.clear()
+                    count('breakers', f"{self.label}:closed")
+                    log.info(f"Breaker {self.label} closed")
+                return
+            self.window.append((failed, slow))
+            n = len(self.window)
+            if self.state == 'closed' and n >= BREAKER_MIN_CALLS and (
+                    sum(w[0] for w in self.window) >= n * BREAKER_ERROR_RATE or
+                    sum(w[1] for w in self.window) >= n * BREAKER_SLOW_RATE):
+                self._open()
+
+    def _open(self):
+        self.state, self.opened = 'open', time.time()
+        self.trips += 1
+        count('breakers', f"{self.label}:opened")
+        log.warning(f"Breaker {self.label} open for {BREAKER_OPEN_S:.0f} s")
+
+    def release(self):
+        """Record nothing for this call; a half-open probe may be tried again."""
+        with self._lock:
+            self.probing = False
+
+    @contextmanager
+    def call(self):
+        if not self.allow():
+            raise BreakerOpen(f"{self.label} circuit open")
+        _tls.cut = _tls.cap = None
+        t0 = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            dt, cut = time.perf_counter() - t0, _tls.cut
+            if cut is not None and cut < BREAKER_FAIR_S and dt >= cut * 0.9:
+                count('breakers', f"{self.label}:budget")    # our deadline, not their failure
+                self.release()
+            else:
+                self.record(True, dt, _tls.cap)
+            raise
+        self.record(False, time.perf_counter() - t0, _tls.cap)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            out = {'state':  self.state,
+                   'calls':  len(self.window),
+                   'failed': sum(w[0] for w in self.window),
+                   'slow':   sum(w[1] for w in self.window),
+                   'trips':  self.trips}
+            if self.state != 'closed':
+                out['opened']   = datetime.fromtimestamp(self.opened).isoformat()
+                out['retry_in'] = round(max(0.0, self.opened + BREAKER_OPEN_S - time.time()), 1)
+        return out
+
+_BREAKER_UPSTREAMS = ('shopify', 'sheets', 'gemini', 'smtp', 'razorpay')
+_breakers: dict    = {}     # (tenant id, upstream) → Breaker
+_breakers_lock     = threading.Lock()
+
+def breaker(name: str) -> Breaker:
+    """The breaker for `name` under the current tenant."""
+    key = (tenant().id, name)
+    b   = _breakers.get(key)
+    if b is None:
+        if name not in _BREAKER_UPSTREAMS:
+            raise KeyError(name)
+        with _breakers_lock:
+            b = _breakers.setdefault(key, Breaker(name, key[0]))
+    return b
+
+def breaker_stats() -> dict:
+    out = {}
+    for (tid, name), b in sorted(list(_breakers.items())):
+        out.setdefault(tid, {})[name] = b.snapshot()
+    return out
+
+def _breaker_gauges() -> dict:
+    return {'bot_breakers_open': sum(b.state != 'closed' for b in list(_breakers.values()))}
+
+_gauges.append(_breaker_gauges)
+
+# ─────────────────────────────────────────────────────────────
+# ANALYTICS
+# One event per handled message: type, route, collection opened,
+# fuzzy score, Aru used, order total. The request path only appends
+# to a bounded deque — when it is full the event is dropped and
+# counted. A background thread writes batches as zstd Parquet files
+# under ANALYTICS_DIR/date=YYYY-MM-DD/ (gzipped JSON lines when
+# pyarrow isn't installed). Query with: python manage.py funnel
+# ─────────────────────────────────────────────────────────────
+
+EVENT_FIELDS = (
+    ('ts',            'timestamp'),
+    ('tenant',        'string'),
+    ('user',          'string'),
+    ('type',          'string'),
+    ('lang',          'string'),
+    ('status',        'string'),
+    ('intent',        'string'),
+    ('route',         'string'),
+    ('reply_id',      'string'),
+    ('collection_id', 'string'),
+    ('collection',    'string'),
+    ('fuzzy_score',   'float'),
+    ('aru',           'bool'),
+    ('order_total',   'float'),
+    ('order_items',   'int'),
+    ('ms',            'float'),
+    ('error',         'string'),
+    ('degraded',      'string'),
+)
+
+_events: deque   = deque()
+_events_wake     = threading.Event()
+_events_flush    = threading.Lock()
+_events_thread   = None
+_part_seq        = itertools.count()
+
+def note(**fields):
+    """Attach fields to the analytics event of the message being handled."""
+    tr = _tls.trace
+    if tr is not None and tr['event'] is not None:
+        tr['event'].update(fields)
+
+def user_key(phone: str) -> str:
+    """Stable pseudonymous id — events never carry the phone number."""
+    return hashlib.blake2b((wa_key(phone) or phone).encode(), digest_size=8).hexdigest()
+
+def emit(ev: dict):
+    global _events_thread
+    if len(_events) >= ANALYTICS_QUEUE:
+        count('analytics', 'dropped')
+        return
+    _events.append(ev)
+    count('analytics', 'queued')
+    if _events_thread is None:
+        with _events_flush:
+            if _events_thread is None:
+                _events_thread = threading.Thread(target=_analytics_writer, name='analytics', daemon=True)
+                _events_thread.start()
+    if len(_events) >= ANALYTICS_BATCH:
+        _events_wake.set()
+
+def _analytics_writer():
+    while True:
+        _events_wake.wait(ANALYTICS_FLUSH)
+        _events_wake.clear()
+        flush_events()
+
+def flush_events() -> int:
+    """Write everything queued so far. Returns the number of events written."""
+    written = 0
+    with _events_flush:
+        while _events:
+            batch = []
+            while _events and len(batch) < ANALYTICS_BATCH:
+                batch.append(_events.popleft())
+            days: dict = {}
+            for ev in batch:
+                days.setdefault(datetime.fromtimestamp(ev['ts']).strftime('%Y-%m-%d'), []).append(ev)
+            for day, rows in days.items():
+                try:
+                    _write_events(day, rows)
+                    count('analytics', 'written', len(rows))
+                    written += len(rows)
+                except Exception as e:
+                    count('analytics', 'failed', len(rows))
+                    log.error(f"Analytics write: {e}")
+    return written
+
+def _arrow_schema():
+    import pyarrow as pa
+    types = {'timestamp': pa.timestamp('ms', tz='UTC'), 'string': pa.string(),
+             'float': pa.float64(), 'bool': pa.bool_(), 'int': pa.int32()}
+    return pa.schema([(name, types[t]) for name, t in EVENT_FIELDS])
+
+def _write_events(day: str, rows: list) -> str:
+    d = os.path.join(ANALYTICS_DIR, f"date={day}")
+    os.makedirs(d, exist_ok=True)
+    name = f"part-{int(time.time() * 1000)}-{os.getpid()}-{next(_part_seq)}"
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        pq = None
+    if pq is None:
+        path = os.path.join(d, name + '.jsonl.gz')
+        with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+            for ev in rows:
+                f.write(json.dumps({k: ev.get(k) for k, _ in EVENT_FIELDS}, ensure_ascii=False) + '\n')
+    else:
+        import pyarrow as pa
+        path  = os.path.join(d, name + '.parquet')
+        cols  = {k: [ev.get(k) for ev in rows] for k, _ in EVENT_FIELDS}
+        cols['ts'] = [datetime.fromtimestamp(t, timezone.utc) for t in cols['ts']]
+        pq.write_table(pa.Table.from_pydict(cols, schema=_arrow_schema()),
+                       path + '.tmp', compression='zstd')
+    os.replace(path + '.tmp', path)
+    return path
+
+def _analytics_gauges() -> dict:
+    return {'bot_analytics_queue': len(_events)}
+
+_gauges.append(_analytics_gauges)
+atexit.register(flush_events)
+
+# ─────────────────────────────────────────────────────────────
+# SDK CLIENTS
+# Gemini, Sheets and Razorpay are imported and built on first use,
+# not at import — importing google.generativeai alone costs ~0.5 s
+# and gspread.authorize() goes over the network. With PREWARM=1 they
+# are built in the background right after the first request is served.
+# The gspread and razorpay clients each drive their own
+# requests.Session, which isn't documented as thread-safe, so each is
+# lent to one thread at a time from a pool of at most SDK_POOL_SIZE
+# (the Sheets credentials, and so the OAuth token, are shared). A
+# thread that finds them all busy waits for one, no longer than a
+# call's own timeout. A Gemini model holds no connection — its
+# transport is the SDK's module-level client — so one is shared.
+# ─────────────────────────────────────────────────────────────
+
+PREWARM = os.getenv('PREWARM', '1') == '1'
+
+class _Lazy:
+    """Thread-safe build-once holder. A failed build is retried after 60 s."""
+
+    def __init__(self, name: str, factory):
+        self.name    = name
+        self.factory = factory
+        self._lock   = threading.Lock()
+        self._built  = False
+        self._value  = None
+        self._retry  = 0.0
+
+    def get(self):
+        if self._built or time.monotonic() < self._retry:
+            return self._value
+        with self._lock:
+            if not self._built and time.monotonic() >= self._retry:
+                try:
+                    self._value = _call('init', self.name, self.factory)
+                    self._built = True
+                except Exception as e:
+                    log.error(f"{self.name} init: {e}")
+                    self._retry = time.monotonic() + 60
+        return self._value
+
+    def set(self, value):
+        with self._lock:
+            self._value, self._built = value, True
+
+    def peek(self):
+        """The value if already built — never builds."""
+        return self._value
+
+class _Pool(_Lazy):
+    """Like _Lazy, but up to `size` values, each lent to one thread at a time by use().
+    set() — or a factory that returns None (not configured) — shares one value with all."""
+
+    def __init__(self, name: str, factory, size: int = None):
+        super().__init__(name, factory)
+        self.size  = size or SDK_POOL
+        self._idle = []
+        self._made = 0
+        self._free = threading.Condition(self._lock)
+
+    @contextmanager
+    def use(self):
+        """A value no other thread uses until the block ends; None if it can't be built."""
+        if self._built:
+            yield self._value
+            return
+        value = self._take()
+        try:
+            yield value
+        finally:
+            if value is not None:
+                with self._free:
+                    self._idle.append(value)
+                    self._free.notify()
+
+    def get(self):
+        """A value without borrowing it — for prewarm and single-threaded tools (manage.py)."""
+        with self.use() as value:
+            return value
+
+    def _take(self):
+        wait = min(10, max(remaining(), CALL_FLOOR_S))
+        with self._free:
+            if not self._free.wait_for(lambda: self._idle or self._made < self.size or self._built, wait):
+                raise TimeoutError(f"{self.name}: all {self.size} clients busy")
+            if self._built:
+                return self._value
+            if self._idle:
+                return self._idle.pop()
+            if time.monotonic() < self._retry:
+                return None
+            self._made += 1
+        try:
+            value = _call('init', self.name, self.factory)
+        except Exception as e:
+            log.error(f"{self.name} init: {e}")
+            value = None
+            self._retry = time.monotonic() + 60
+        with self._free:
+            if value is None:
+                self._made -= 1
+                self._built = self._built or time.monotonic() >= self._retry    # not configured
+                self._free.notify()
+            else:
+                self._value = self._value or value
+        return value
+
+def _make_genai():
+    if not GEMINI_KEY:
+        return None
+    import google.generativeai as genai
     genai.configure(api_key=GEMINI_KEY)
-    _gm = genai.GenerativeModel('gemini-pro')
-    _gv = genai.GenerativeModel('gemini-pro-vision')
-else:
-    _gm = _gv = None
+    return genai
+
+def _make_model(name: str):
+    if not GEMINI_KEY:
+        return None
+    genai = _genai.get()
+    if genai is None:                   # its build failed: fail this one too, so both retry
+        raise RuntimeError('google.generativeai unavailable')
+    return genai.GenerativeModel(name)
+
+def _make_gc(key: str = None):
+    key = SHEET_KEY if key is None else key
+    if not key:
+        return None
+    import gspread
+    return gspread.authorize(_sheets_creds(key), client_factory=sheets_client_class())
+
+@functools.lru_cache(maxsize=None)
+def _sheets_creds(key: str):
+    from google.oauth2.service_account import Credentials
+    return Credentials.from_service_account_info(
+        json.loads(key),
+        scopes=['https://www.googleapis.com/auth/spreadsheets']
+    )
+
+@functools.lru_cache(maxsize=None)
+def sheets_client_class():
+    """gspread.Client whose requests time out with the message's remaining budget."""
+    import gspread
+
+    class SheetsClient(gspread.Client):
+        timeout = property(lambda self: call_timeout(10), lambda self, value: None)
+
+    return SheetsClient
+
+def _make_rzp(key_id: str = None, key_sec: str = None):
+    key_id  = RZP_KEY_ID if key_id is None else key_id
+    key_sec = RZP_KEY_SEC if key_sec is None else key_sec
+    if not key_id or not key_sec:
+        return None
+    import razorpay
+    opts = {'base_url': RZP_API} if RZP_API else {}
+    return razorpay.Client(auth=(key_id, key_sec), **opts)
+
+_genai = _Lazy('genai',    _make_genai)
+_gm    = _Lazy('gemini',   lambda: _make_model('gemini-pro'))
+_gv    = _Lazy('gemini_vision', lambda: _make_model('gemini-pro-vision'))
+_gc    = _Pool('sheets',   _make_gc)
+_rzp   = _Pool('razorpay', _make_rzp)
+
+_prewarmed = threading.Event()
+
+def prewarm():
+    for client in (_gc, _rzp, _gm, _gv):
+        client.get()
+    for t in list(_tenants.values()):
+        t.gc.get()
+        t.rzp.get()
+    log.info("SDK clients warmed")
+
+# ─────────────────────────────────────────────────────────────
+# TENANTS
+# One process can serve several WhatsApp numbers. Each tenant is
+# keyed by the phone_number_id Meta puts in every webhook's metadata
+# and owns its credentials, HTTP connection pool, Sheets/Razorpay
+# clients, conversation sessions and send rate limit. The catalog
+# registry, Gemini models, dedup and delivery tracking are shared.
+#
+# The env settings above are the default tenant. TENANTS_FILE adds
+# more: a JSON list of {"phone_id", "name", "wa_token", "catalog_id",
+# "shop_domain", "shopify_token", "shopify_api",
+# "shopify_webhook_secret", "sheet_id", "sheet_key",
+# "razorpay_key_id", "razorpay_key_secret",
+# "gmail_user", "gmail_password", "admins": [...]} — any value
+# written as "$NAME" is read from the environment.
+# ─────────────────────────────────────────────────────────────
+
+class _Bucket:
+    """Token bucket. take() reserves a token and sleeps until it is due."""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate   = rate
+        self.burst  = burst or max(rate, 1.0)
+        self.tokens = self.burst
+        self.t      = time.monotonic()
+        self._lock  = threading.Lock()
+
+    def take(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.t) * self.rate) - 1
+            self.t      = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+class Tenant:
+    def __init__(self, cfg: dict):
+        v = lambda k, d='': _env_ref(cfg.get(k, d))
+        self.id            = str(cfg['phone_id'])
+        self.name          = cfg.get('name') or self.id
+        self.wa_token      = v('wa_token')
+        self.catalog_id    = v('catalog_id')
+        self.shop_domain   = v('shop_domain', SHOPIFY_STORE)
+        self.shopify_token = v('shopify_token')
+        self.shopify_api   = v('shopify_api', f"https://{self.shop_domain}/admin/api/2024-01")
+        self.hook_secret   = v('shopify_webhook_secret', SHOPIFY_HOOK_SECRET)
+        self.sheet_id      = v('sheet_id')
+        self.gmail_user    = v('gmail_user', GMAIL_USER)
+        self.gmail_pass    = v('gmail_password', GMAIL_PASS)
+        self.admins        = cfg.get('admins') or [ADMIN_1, ADMIN_2]
+        self.wa_api        = f"{GRAPH_API}/{self.id}/messages"
+        self.sessions: dict = {}
+        self.customers     = _Lazy(f"customers:{self.name}", lambda: CustomerIndex(self))
+        self.limiter       = _Bucket(float(cfg.get('send_rate', TENANT_RATE)))
+        self.http          = requests.Session()
+        self.http.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL))
+        self.http.mount('http://',  requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL))
+        # Tenants sharing credentials share one SDK client.
+        sheet_key = v('sheet_key', SHEET_KEY)
+        rzp_id    = v('razorpay_key_id', RZP_KEY_ID)
+        rzp_sec   = v('razorpay_key_secret', RZP_KEY_SEC)
+        self.gc  = _gc if sheet_key == SHEET_KEY else _Pool(f"sheets:{self.name}", lambda: _make_gc(sheet_key))
+        self.rzp = _rzp if (rzp_id, rzp_sec) == (RZP_KEY_ID, RZP_KEY_SEC) else \
+                   _Pool(f"razorpay:{self.name}", lambda: _make_rzp(rzp_id, rzp_sec))
+
+def _env_ref(value):
+    return os.getenv(value[1:], '') if isinstance(value, str) and value.startswith('$') else value
+
+_default = Tenant({
+    'phone_id': WA_PHONE_ID, 'name': 'default', 'wa_token': WA_TOKEN, 'catalog_id': CATALOG_ID,
+    'shop_domain': SHOPIFY_STORE, 'shopify_token': SHOPIFY_TOKEN, 'shopify_api': SHOPIFY_API,
+    'sheet_id': SHEET_ID,
+})
+_tenants: dict = {_default.id: _default}
+
+def register_tenant(cfg: dict) -> Tenant:
+    t = Tenant(cfg)
+    _tenants[t.id] = t
+    return t
+
+def load_tenants(path: str):
+    try:
+        with open(path, encoding='utf-8') as f:
+            for cfg in json.load(f):
+                register_tenant(cfg)
+        log.info(f"Tenants: {', '.join(t.name for t in _tenants.values())}")
+    except Exception as e:
+        log.error(f"Tenants file {path}: {e}")
+
+if TENANTS_FILE:
+    load_tenants(TENANTS_FILE)
+
+def tenant_for(phone_id: str) -> Tenant | None:
+    """Tenant for a webhook's phone_number_id. A single-tenant process takes everything."""
+    t = _tenants.get(phone_id or '')
+    if t is None and len(_tenants) == 1:
+        return _default
+    return t
+
+def tenant_by_shop(domain: str) -> Tenant | None:
+    return next((t for t in _tenants.values() if t.shop_domain == domain), None)
+
+def tenant() -> Tenant:
+    """The tenant of the message being handled on this thread."""
+    return _tls.tenant or _default
+
+def all_sessions() -> int:
+    return sum(len(t.sessions) for t in _tenants.values())
 
 # ─────────────────────────────────────────────────────────────
 # DEDUPLICATION
 # ─────────────────────────────────────────────────────────────
 
-_processed: list = []
-_DEDUP_MAX = 500
+_processed = OrderedDict()      # wamid → None, oldest first
+_DEDUP_MAX = 5000
+_dedup_lock = threading.Lock()
 
 def _already_seen(msg_id: str) -> bool:
-    if msg_id in _processed:
-        return True
-    _processed.append(msg_id)
-    if len(_processed) > _DEDUP_MAX:
-        _processed.pop(0)
-    return False
+    with _dedup_lock:
+        if msg_id in _processed:
+            return True
+        _processed[msg_id] = None
+        if len(_processed) > _DEDUP_MAX:
+            _processed.popitem(last=False)
+        return False
+
+# ─────────────────────────────────────────────────────────────
+# PHONE NUMBERS
+# Sessions, Sheets rows, Shopify lookups, the customer index and
+# analytics are all keyed by the E.164 form ('+919812345678'),
+# whatever the source wrote: WhatsApp ids ('919812345678'), Shopify
+# ('+91 98123 45678'), hand-typed Sheets rows ('09812345678').
+# A WhatsApp id is already international, so wa_key() only adds the
+# '+'; the national-number guesses in canon_phone() are for numbers
+# people typed (Sheets, CSV imports, the admin CLI) — applied to a
+# wa_id they would turn Singapore's 6591234567 into +916591234567.
+# Replies still go to the bare WhatsApp id.
+# ─────────────────────────────────────────────────────────────
+
+PHONE_CC = os.getenv('PHONE_DEFAULT_COUNTRY_CODE', '91')   # for 10-digit national numbers
+
+@functools.lru_cache(maxsize=65536)
+def canon_phone(raw) -> str:
+    """E.164 key for a phone number; '' if it doesn't look like one."""
+    s      = str(raw or '').strip()
+    digits = re.sub(r'\D', '', s)
+    if s.startswith('+'):
+        pass
+    elif digits.startswith('00'):
+        digits = digits[2:]
+    elif len(digits) == 11 and digits[0] == '0':
+        digits = PHONE_CC + digits[1:]
+    elif len(digits) == 10:
+        digits = PHONE_CC + digits
+    return f"+{digits}" if 8 <= len(digits) <= 15 else ''
+
+@functools.lru_cache(maxsize=65536)
+def wa_key(wa_id) -> str:
+    """E.164 key for a WhatsApp id (country code included); never guesses one."""
+    digits = re.sub(r'\D', '', str(wa_id or ''))
+    return f"+{digits}" if 8 <= len(digits) <= 15 else ''
 
 # ─────────────────────────────────────────────────────────────
 # SESSION
+# Webhook requests run concurrently (gthread workers), and Meta may
+# deliver two messages from one phone in separate requests. Sessions
+# are created with one atomic setdefault, and a phone's messages are
+# handled under its session's lock: one at a time, in the order the
+# requests get it.
 # ─────────────────────────────────────────────────────────────
 
-_sessions: dict = {}
 _TIMEOUT = timedelta(minutes=30)
+_SWEEP_S = 60
+_swept   = time.monotonic()
 
 def get_session(phone: str) -> dict:
     now = datetime.now()
-    if phone not in _sessions:
-        _sessions[phone] = {
-            'created':     now,
-            'last':        now,
-            'first_name':  'Customer',
-            'lang':        'hi',        # DEFAULT = Hinglish
-            'custom_step': None,
-            'welcomed':    False,       # track if welcome already sent
-        }
-    _sessions[phone]['last'] = now
-    return _sessions[phone]
+    s   = tenant().sessions.setdefault(wa_key(phone) or phone, {
+        'created':     now,
+        'last':        now,
+        'first_name':  'Customer',
+        'lang':        'hi',        # DEFAULT = Hinglish
+        'custom_step': None,
+        'welcomed':    False,       # track if welcome already sent
+        'lock':        threading.Lock(),
+    })
+    s['last'] = now
+    return s
 
 def _cleanup():
-    now  = datetime.now()
-    dead = [p for p, s in _sessions.items() if now - s['last'] > _TIMEOUT]
-    for p in dead:
-        del _sessions[p]
+    """Drop expired sessions — a full scan, so at most once every _SWEEP_S."""
+    global _swept
+    if time.monotonic() - _swept < _SWEEP_S:
+        return
+    _swept = time.monotonic()
+    now = datetime.now()
+    for t in list(_tenants.values()):
+        dead = [p for p, s in list(t.sessions.items()) if now - s['last'] > _TIMEOUT]
+        for p in dead:
+            t.sessions.pop(p, None)
 
 # ─────────────────────────────────────────────────────────────
-# CATALOG — 82 COLLECTIONS
+# CATALOG REGISTRY
+# Menus and collections live in CATALOG_FILE (catalog.json):
+#   {"version": N, "menus": {reply id: {"header", "prompt",
+#     "sections": [{"title", "collections": {name: id}}]}}}
+# Menus, the fuzzy index and menu routes are all derived from one
+# immutable snapshot. When the file changes, a new snapshot is built
+# in the background and swapped in with a single assignment;
+# a message already being handled keeps the one it started with
+# (ctx['cat'] — see ROUTER).
 # WhatsApp hard limit: max 10 TOTAL rows across all sections in one list
 # ─────────────────────────────────────────────────────────────
 
-BABY = {
-    'Hair Accessories': '26930579176543121',
-    'Earrings':         '34197166099927645',
-    'Necklace Chains':  '34159752333640697',
-    'Rings':            '27130321023234461',
-    'Anklets':          '26132380466413425',
-    'Bangles':          '25812008941803035',
-}
-FACE_EARRINGS = {
-    'Diamond Studs':      '26648112538119124',
-    'Traditional Jhumka': '26067705569545995',
-    'Chandbali':          '26459908080267418',
-    'Classic Hoops':      '26507559175517690',
-    'Ear Cuffs':          '25904630702480491',
-    'Bridal Kanser':      '24428630293501712',
-    'Bahubali':           '27263060009951006',
-    'Drop Earrings':      '27085758917680509',
-    'Sui Dhaga':          '26527646070152559',
-    'Vintage Chuk':       '26001425306208264',
-}
-FACE_NOSE = {
-    'Bridal Nath':   '26146672631634215',
-    'Nose Pins':     '25816769131325224',
-    'Septum Rings':  '26137405402565188',
-    'Clip On Rings': '25956080384032593',
-}
-FACE_HEAD = {
-    'Maang Tikka':  '34096814326631390',
-    'Matha Patti':  '25972597769065393',
-    'Passa':        '25853734394311094',
-    'Head Kanser':  '26924099463860066',
-    'Sheesh Phool': '25884225787909036',
-}
-FACE_HAIR = {
-    'Hair Clips': '25923141554014968',
-}
-HAND_BANGLES = {
-    'Traditional Bangles': '25990285673976585',
-    'Designer Kada':       '26202123256143866',
-}
-HAND_BRACELETS = {
-    'Classic Bracelets': '26479540271641962',
-    'Chain Bracelets':   '26553938717531086',
-    'Charm Bracelets':   '25889526627383303',
-    'Cuff Bracelets':    '26095567730084970',
-}
-HAND_ARMLETS = {
-    'Baju Band': '25741475325553252',
-}
-HAND_RINGS = {
-    'Designer Rings':   '26458893303705648',
-    'Engagement Rings': '26577195808532633',
-    'Wedding Bands':    '26283285724614486',
-    'Fashion Rings':    '26627787650158306',
-}
-NECK_NECKLACES = {
-    'Traditional Haar':   '34124391790542901',
-    'Modern Chokers':     '34380933844854505',
-    'Princess Necklaces': '27036678569255877',
-    'Matinee Necklaces':  '34810362708554746',
-    'Necklace':           '27022573597332099',
-}
-NECK_PENDANTS = {
-    'Pendants':           '25892524293743018',
-    'Solitaire Pendants': '26345939121667071',
-    'Locket Pendants':    '34949414394649401',
-    'Statement Pendants': '34061823006795079',
-}
-NECK_BRIDAL = {
-    'Bridal Sets': '34181230154825697',
-}
-LOWER = {
-    'Kamarband':     '25970100975978085',
-    'Payal Anklets': '26108970985433226',
-    'Toe Rings':     '26041413228854859',
-}
-MEN_RINGS = {
-    'Wedding Bands':    '35279590828306838',
-    'Engagement Rings': '26205064579128433',
-    'Signet Rings':     '26133044123050259',
-    'Fashion Rings':    '26353107324312966',
-    'Classic Bands':    '26048808064813747',
-    'Gemstone Rings':   '25392189793787605',
-}
-MEN_BRACELETS = {
-    'Chain Bracelets':   '26028399416826135',
-    'Leather Bracelets': '24614722568226121',
-    'Beaded Bracelets':  '26526947026910291',
-    'Cuff Bracelets':    '26224048963949143',
-}
-MEN_CHAINS = {
-    'Gold Chains':   '26614026711549117',
-    'Silver Chains': '35305915439007559',
-    'Rope Chains':   '25364645956543386',
-}
-MEN_ACCESSORIES = {
-    'Classic Cufflinks':  '25956694700651645',
-    'Designer Cufflinks': '25283486371327046',
-    'Tie Pins':           '34056958820614334',
-    'Brooches':           '27093254823609535',
-    'Kada Modern':        '26028780853472858',
-    'Kada Traditional':   '26080348848282889',
-    'Pendant Initial':    '26251311201160440',
-    'Pendant Religious':  '34138553902457530',
-    'Pendant Stone':      '26441867825407906',
-}
-WATCHES = {
-    'Men Timepieces':    '34176915238618497',
-    'Women Timepieces':  '26903528372573194',
-    'Kids Timepieces':   '26311558718468909',
-    'Smart Watches':     '25912162851771673',
-    'Luxury Timepieces': '26667915832816156',
-}
-STUDIO_ACCESSORIES = {
-    'Premium Keychains': '26255788447385252',
-    'Evening Clutches':  '34514139158199452',
-    'Sunglasses':        '25258040713868720',
-    'Designer Belts':    '26176082815414211',
-}
+CATALOG_FILE = os.getenv('CATALOG_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog.json'))
+CATALOG_POLL = float(os.getenv('CATALOG_POLL_SECONDS', '10'))
+
+def build_catalog(raw: dict, mtime: float = 0.0) -> dict:
+    menus, id_to_name, name_to_id = {}, {}, {}
+    for mid, m in raw['menus'].items():
+        secs = [(sec['title'], dict(sec['collections'])) for sec in m['sections']]
+        menus[mid] = (m['header'], m.get('prompt', 'collection'), secs)
+        for _, d in secs:
+            for name, cid in d.items():
+                id_to_name.setdefault(str(cid), name)
+                name_to_id.setdefault(name, str(cid))
+    return {
+        'version':    raw.get('version', 0),
+        'mtime':      mtime,
+        'loaded':     datetime.now().isoformat(),
+        'menus':      menus,
+        'id_to_name': id_to_name,
+        'name_to_id': name_to_id,
+        'all_names':  list(name_to_id),      # fuzzy index
+        'pages':      {},                    # (menu id, lang) → list pages, filled lazily
+        'replies':    {},                    # (tenant id, route, reply id, lang) → payloads — see REPLY CACHE
+    }
 
-# Flat id → name
-ID_TO_NAME: dict = {}
-def _reg(d):
-    for name, cid in d.items():
-        ID_TO_NAME[cid] = name
+def load_catalog(path: str = None) -> dict:
+    path = path or CATALOG_FILE
+    with open(path, encoding='utf-8') as f:
+        raw = json.load(f)
+    return build_catalog(raw, os.path.getmtime(path))
 
-for _d in [BABY, FACE_EARRINGS, FACE_NOSE, FACE_HEAD, FACE_HAIR,
-           HAND_BANGLES, HAND_BRACELETS, HAND_ARMLETS, HAND_RINGS,
-           NECK_NECKLACES, NECK_PENDANTS, NECK_BRIDAL, LOWER,
-           MEN_RINGS, MEN_BRACELETS, MEN_CHAINS, MEN_ACCESSORIES,
-           WATCHES, STUDIO_ACCESSORIES]:
-    _reg(_d)
+_catalog        = load_catalog()
+_catalog_lock   = threading.Lock()
+_catalog_check  = time.monotonic()
+_catalog_seen   = _catalog['mtime']      # last file mtime we tried to load
 
-ALL_NAMES = list(ID_TO_NAME.values())
+def _reload_catalog():
+    global _catalog
+    try:
+        snap = load_catalog()
+        if not snap['menus']:
+            raise ValueError('no menus')
+        _catalog = snap
+        log.info(f"Catalog v{snap['version']} loaded: "
+                 f"{len(snap['menus'])} menus, {len(snap['id_to_name'])} collections")
+    except Exception as e:
+        log.error(f"Catalog reload: {e} — keeping v{_catalog['version']}")
+    finally:
+        _catalog_lock.release()
+
+def catalog_watch():
+    """Cheap per-request check: stat the file every CATALOG_POLL seconds, reload off-thread."""
+    global _catalog_check, _catalog_seen
+    now = time.monotonic()
+    if now - _catalog_check < CATALOG_POLL:
+        return
+    _catalog_check = now
+    try:
+        mtime = os.path.getmtime(CATALOG_FILE)
+    except OSError:
+        return
+    if mtime != _catalog_seen and _catalog_lock.acquire(blocking=False):
+        _catalog_seen = mtime
+        threading.Thread(target=_reload_catalog, name='catalog-reload', daemon=True).start()
 
 # ─────────────────────────────────────────────────────────────
 # HELPERS
 # ─────────────────────────────────────────────────────────────
 
-def _rows(d: dict) -> list:
-    return [{'id': f"C_{cid}", 'title': name[:24]} for name, cid in d.items()]
-
-def _sec(title: str, d: dict) -> dict:
-    return {'title': title[:24], 'rows': _rows(d)}
+def unique_titles(names: list, width: int = 24) -> list:
+    """Fit names into WhatsApp's row title width without producing duplicates."""
+    out, seen = [], set()
+    for name in names:
+        t = name if len(name) <= width else name[:width - 1].rstrip() + '…'
+        if t in seen and len(name) > width and ' ' in name:
+            tail = ' ' + name.rsplit(' ', 1)[1]          # keep the distinguishing last word
+            t    = name[:width - len(tail) - 1].rstrip() + '…' + tail
+        n = 2
+        while t in seen:
+            sfx = f" {n}"
+            t   = name[:width - len(sfx)].rstrip() + sfx
+            n  += 1
+        seen.add(t)
+        out.append(t)
+    return out
+
+# ── PAGING ────────────────────────────────────────────────────
+# WhatsApp lists take at most 10 rows. Bigger menus are split into
+# pages; every page but the last ends with a "More…" row whose id is
+# a stateless page token, P_<menu id>_<page>. Pages are built once
+# per (menu, lang) and cached on the catalog snapshot, so a catalog
+# reload starts with an empty cache.
+_WA_ROWS = 10
+
+def build_pages(mid: str, secs: list, lang: str) -> list:
+    items  = [(title, name, cid) for title, d in secs for name, cid in d.items()]
+    titles = unique_titles([name for _, name, _ in items])
+    rows   = [(sec, {'id': f"C_{cid}", 'title': t})
+              for (sec, _, cid), t in zip(items, titles)]
+    per    = _WA_ROWS if len(rows) <= _WA_ROWS else _WA_ROWS - 1
+    chunks = [rows[i:i + per] for i in range(0, len(rows), per)] or [[]]
+    pages  = []
+    for n, chunk in enumerate(chunks):
+        sections = []
+        for sec, row in chunk:
+            if not sections or sections[-1]['title'] != sec[:24]:
+                sections.append({'title': sec[:24], 'rows': []})
+            sections[-1]['rows'].append(row)
+        if n + 1 < len(chunks):
+            sections.append({'title': _hi('More', 'Aur', lang), 'rows': [{
+                'id':          f"P_{mid}_{n + 1}",
+                'title':       _hi('More…', 'Aur dekhein…', lang),
+                'description': f"{n + 2}/{len(chunks)}",
+            }]})
+        pages.append(sections)
+    return pages
+
+def menu_pages(mid: str, lang: str, cat: dict = None) -> list:
+    cat   = cat or _catalog
+    pages = cat['pages'].get((mid, lang))
+    if pages is None:
+        pages = cat['pages'][(mid, lang)] = build_pages(mid, cat['menus'][mid][2], lang)
+    return pages
+
+def parse_page_token(token: str) -> tuple:
+    mid, _, page = token[2:].rpartition('_')
+    return mid, int(page) if page.isdigit() else 0
 
 # ─────────────────────────────────────────────────────────────
 # EMAIL
 # ─────────────────────────────────────────────────────────────
 
-def admin_email(subject: str, body: str):
+@timed('admin_email', ok=_not_failed)
+def admin_email(subject: str, body: str, images: list = ()):
+    """Mail every admin. images: (filename, JPEG bytes) pairs, attached."""
     try:
-        if not GMAIL_USER or not GMAIL_PASS:
+        t = tenant()
+        if not t.gmail_user or not t.gmail_pass:
             log.warning("Gmail not configured.")
             return
-        for addr in filter(None, [ADMIN_1, ADMIN_2]):
+        for addr in filter(None, t.admins):
             msg = MIMEMultipart()
-            msg['From']    = GMAIL_USER
+            msg['From']    = t.gmail_user
             msg['To']      = addr
             msg['Subject'] = subject
             msg.attach(MIMEText(body, 'plain'))
-            with smtplib.SMTP_SSL('smtp.gmail.com', 465) as srv:
-                srv.login(GMAIL_USER, GMAIL_PASS)
-                srv.sendmail(GMAIL_USER, addr, msg.as_string())
+            for name, data in images:
+                msg.attach(MIMEImage(data, 'jpeg', name=name))
+            smtp = smtplib.SMTP_SSL if SMTP_SSL else smtplib.SMTP
+            with breaker('smtp').call(), smtp(SMTP_HOST, SMTP_PORT, timeout=call_timeout(10)) as srv:
+                srv.login(t.gmail_user, t.gmail_pass)
+                srv.sendmail(t.gmail_user, addr, msg.as_string())
     except Exception as e:
         log.error(f"Email: {e}")
+        return False
 
 # ─────────────────────────────────────────────────────────────
 # GOOGLE SHEETS
 # ─────────────────────────────────────────────────────────────
 
-def _make_gc():
-    try:
-        if not SHEET_KEY:
-            return None
-        creds = Credentials.from_service_account_info(
-            json.loads(SHEET_KEY),
-            scopes=['https://www.googleapis.com/auth/spreadsheets']
-        )
-        return gspread.authorize(creds)
-    except Exception as e:
-        log.error(f"Sheets init: {e}")
-        return None
-
-_gc = _make_gc()
-
+@timed('sheets_lookup')
 def sheets_lookup(phone: str) -> dict:
     try:
-        if not _gc or not SHEET_ID:
-            return {'exists': False}
-        ws     = _gc.open_by_key(SHEET_ID).worksheet('Registrations')
-        phones = ws.col_values(1)
-        for i, p in enumerate(phones, 1):
-            if p == phone:
-                row = ws.row_values(i)
-                return {'exists': True,
-                        'first_name': row[1] if len(row) > 1 else ''}
+        t = tenant()
+        with t.gc.use() as gc:
+            if not gc or not t.sheet_id:
+                return {'exists': False}
+            with breaker('sheets').call():
+                ws     = gc.open_by_key(t.sheet_id).worksheet('Registrations')
+                phones = ws.col_values(1)
+                key    = wa_key(phone) or phone
+                for i, p in enumerate(phones, 1):
+                    if (canon_phone(p) or p) == key:
+                        row = ws.row_values(i)
+                        return {'exists': True,
+                                'first_name': row[1] if len(row) > 1 else ''}
         return {'exists': False}
     except Exception as e:
         log.error(f"Sheets lookup: {e}")
-        return {'exists': False}
+        return {'exists': False, 'failed': True}
 
+@timed('sheets_log', ok=_not_failed)
 def sheets_log(phone: str):
     try:
-        if not _gc or not SHEET_ID:
-            return
-        _gc.open_by_key(SHEET_ID).worksheet('Registrations').append_row(
-            [phone, '', '', datetime.now().isoformat()]
-        )
+        t = tenant()
+        with t.gc.use() as gc:
+            if not gc or not t.sheet_id:
+                return
+            with breaker('sheets').call():
+                gc.open_by_key(t.sheet_id).worksheet('Registrations').append_row(
+                    [wa_key(phone) or phone, '', '', datetime.now().isoformat()]
+                )
     except Exception as e:
         log.error(f"Sheets log: {e}")
+        return False
 
 # ─────────────────────────────────────────────────────────────
 # SHOPIFY
 # ─────────────────────────────────────────────────────────────
 
+@timed('shopify_lookup')
 def shopify_lookup(phone: str) -> dict:
     try:
-        if not SHOPIFY_TOKEN:
+        t = tenant()
+        if not t.shopify_token:
             return {'exists': False}
-        r = requests.get(
-            f"https://{SHOPIFY_STORE}/admin/api/2024-01/customers/search.json",
-            headers={'X-Shopify-Access-Token': SHOPIFY_TOKEN},
-            params={'query': f'phone:{phone}'},
-            timeout=10
-        )
-        if r.ok:
-            custs = r.json().get('customers', [])
-            if custs:
-                c    = custs[0]
-                tags = {t.strip() for t in c.get('tags', '').split(',')}
-                return {
-                    'exists':     True,
-                    'first_name': c.get('first_name', '') or '',
-                    'b2b':        bool(tags & {'B2B', 'Wholesale', 'b2b', 'wholesale'}),
-                }
+        with breaker('shopify').call():
+            r = t.http.get(
+                f"{t.shopify_api}/customers/search.json",
+                headers={'X-Shopify-Access-Token': t.shopify_token},
+                params={'query': f'phone:{wa_key(phone) or phone}'},
+                timeout=call_timeout(PROFILE_MAX_S)
+            )
+            if not r.ok:
+                raise RuntimeError(f"{r.status_code}: {r.text[:300]}")
+        custs = r.json().get('customers', [])
+        if custs:
+            c = custs[0]
+            return {
+                'exists':     True,
+                'first_name': c.get('first_name', '') or '',
+                'b2b':        is_b2b(c.get('tags')),
+            }
         return {'exists': False}
     except Exception as e:
         log.error(f"Shopify: {e}")
-        return {'exists': False}
+        return {'exists': False, 'failed': True}
+
+_B2B_TAGS = {'b2b', 'wholesale'}
+
+def is_b2b(tags: str | None) -> bool:
+    return any(t.strip().lower() in _B2B_TAGS for t in (tags or '').split(','))
+
+def phone_key(phone: str | None, canon=canon_phone) -> int | None:
+    """canon_phone() (or wa_key()) as an int — a third of the memory as a dict key."""
+    key = canon(phone)
+    return int(key[1:]) if key else None
+
+# ── CUSTOMER INDEX ────────────────────────────────────────────
+# phone → first name + B2B flag for a tenant's whole store, so
+# customer_status() is a dict lookup instead of a search call.
+# Bulk-loaded once through paginated customers.json, then kept
+# fresh by polling updated_at_min every SHOPIFY_SYNC_SECONDS and
+# by the customers/* webhooks on /shopify/webhook. Until the bulk
+# load finishes, lookups fall back to live search. After that a miss
+# (a customer created since the last poll, a lost webhook) is still
+# confirmed by live search, at most once per phone per
+# SHOPIFY_SYNC_SECONDS — by then the poll has caught up. The
+# Registrations sheet answer for such a phone is kept for
+# SHEETS_LOOKUP_TTL_SECONDS, so an unknown number doesn't read the
+# sheet on every message. Customers sharing a phone (a family, a
+# shop's front desk): the phone is B2B if any of them is, carries the
+# name of whichever changed last, and is dropped with the last of
+# them.
+
+_CUSTOMER_FIELDS = 'id,phone,first_name,tags,updated_at'
+_RECHECK_MAX     = 65536     # phones remembered for the live-search rate limit
+
+class CustomerIndex:
+    def __init__(self, t: Tenant):
+        self.t      = t
+        self.names: dict  = {}     # phone key → first name
+        self.b2b: set     = set()  # phone keys tagged B2B / Wholesale
+        self.phones: dict = {}     # customer id → phone key (phone changes, deletes)
+        self.owners: dict = {}     # phone key → customer id, or a set of them when shared
+        self.b2b_ids: set = set()  # customer ids tagged B2B / Wholesale
+        self.rechecked = OrderedDict()   # phone key → monotonic of its last live search on a miss
+        self.sheets    = OrderedDict()   # phone key → (monotonic, sheets_lookup()) for phones not in the store
+        self.cursor = None         # newest updated_at applied
+        self.ready  = False
+        self.synced = 0.0
+        self._lock  = threading.Lock()
+        self._wake  = threading.Event()
+        threading.Thread(target=self._run, name=f"customers:{t.name}", daemon=True).start()
+
+    def lookup(self, phone: str) -> dict | None:
+        """None while the bulk load is still running."""
+        if not self.ready:
+            return None
+        k    = phone_key(phone, wa_key)
+        name = self.names.get(k)
+        if name is None:
+            return {'exists': False}
+        return {'exists': True, 'first_name': name, 'b2b': k in self.b2b}
+
+    def recheck(self, phone: str) -> bool:
+        """True if a miss for this phone may be confirmed by live search now."""
+        k, now = phone_key(phone, wa_key), time.monotonic()
+        with self._lock:
+            if now - self.rechecked.get(k, -SHOPIFY_SYNC_S) < SHOPIFY_SYNC_S:
+                return False
+            self.rechecked[k] = now
+            self.rechecked.move_to_end(k)
+            if len(self.rechecked) > _RECHECK_MAX:
+                self.rechecked.popitem(last=False)
+        return True
+
+    def learn(self, phone: str, s: dict):
+        """Keep what a live search found until the poll brings the customer's record."""
+        k = phone_key(phone, wa_key)
+        with self._lock:
+            self.names[k] = sys.intern(s['first_name'] or '')
+            if s['b2b']:
+                self.b2b.add(k)
+
+    def registration(self, phone: str) -> dict:
+        """sheets_lookup() for a phone the store doesn't have, reused for SHEETS_LOOKUP_TTL_SECONDS."""
+        k, now = phone_key(phone, wa_key), time.monotonic()
+        with self._lock:
+            hit = self.sheets.get(k)
+        if hit and now - hit[0] < SHEETS_TTL_S:
+            count('customers', 'sheets_cached')
+            return hit[1]
+        sh = sheets_lookup(phone)
+        if not sh.get('failed'):
+            self.registered(phone, sh)
+        return sh
+
+    def registered(self, phone: str, sh: dict):
+        k = phone_key(phone, wa_key)
+        with self._lock:
+            self.sheets[k] = (time.monotonic(), sh)
+            self.sheets.move_to_end(k)
+            if len(self.sheets) > _RECHECK_MAX:
+                self.sheets.popitem(last=False)
+
+    def _flag(self, k: int):
+        """B2B if any customer with phone key k is (caller holds the lock)."""
+        o = self.owners.get(k)
+        if any(c in self.b2b_ids for c in (o if isinstance(o, set) else (o,))):
+            self.b2b.add(k)
+        else:
+            self.b2b.discard(k)
+
+    def _claim(self, k: int, cid: int):
+        o = self.owners.get(k)
+        if o is None:
+            self.owners[k] = cid
+        elif isinstance(o, set):
+            o.add(cid)
+        elif o != cid:
+            self.owners[k] = {o, cid}
+
+    def _release(self, k: int, cid: int):
+        """Customer cid no longer has phone key k; forget k with its last customer (caller holds the lock)."""
+        o = self.owners.get(k)
+        if isinstance(o, set):
+            o.discard(cid)
+            if len(o) == 1:
+                self.owners[k] = o.pop()
+            self._flag(k)
+            return
+        self.owners.pop(k, None)
+        self.names.pop(k, None)
+        self.b2b.discard(k)
+
+    def apply(self, c: dict):
+        cid, k = c.get('id'), phone_key(c.get('phone'))
+        with self._lock:
+            if is_b2b(c.get('tags')):
+                self.b2b_ids.add(cid)
+            else:
+                self.b2b_ids.discard(cid)
+            old = self.phones.pop(cid, None)
+            if old is not None and old != k:
+                self._release(old, cid)
+            if k is None:
+                return
+            self.phones[cid] = k
+            self._claim(k, cid)
+            self.names[k] = sys.intern(c.get('first_name') or '')
+            self._flag(k)
+            ts = _parse_ts(c.get('updated_at'))
+            if ts and (self.cursor is None or ts > self.cursor):
+                self.cursor = ts
+
+    def remove(self, cid: int):
+        with self._lock:
+            self.b2b_ids.discard(cid)
+            k = self.phones.pop(cid, None)
+            if k is not None:
+                self._release(k, cid)
+
+    def _pages(self, params: dict):
+        url = f"{self.t.shopify_api}/customers.json"
+        while url:
+            r = self.t.http.get(url, params=params, timeout=30,
+                                headers={'X-Shopify-Access-Token': self.t.shopify_token})
+            if r.status_code == 429:
+                time.sleep(float(r.headers.get('Retry-After', 2)))
+                continue
+            r.raise_for_status()
+            yield r.json().get('customers', [])
+            used, _, cap = r.headers.get('X-Shopify-Shop-Api-Call-Limit', '0/1').partition('/')
+            if cap and int(used) >= int(cap) * 0.8:
+                time.sleep(1.0)                      # let the leaky bucket drain
+            url    = r.links.get('next', {}).get('url')
+            params = None                            # page_info URLs carry everything
+
+    def load(self) -> int:
+        started = datetime.now(timezone.utc)
+        n = 0
+        for page in self._pages({'limit': 250, 'fields': _CUSTOMER_FIELDS}):
+            for c in page:
+                self.apply(c)
+            n += len(page)
+        with self._lock:
+            # Anything that changed while we paged is picked up by the next poll.
+            self.cursor = min(self.cursor or started, started)
+        self.ready, self.synced = True, time.time()
+        log.info(f"Customer index {self.t.name}: {len(self.names)} phones from {n} customers")
+        return n
+
+    def poll(self) -> int:
+        since = (self.cursor or datetime.now(timezone.utc)).isoformat()
+        n = 0
+        for page in self._pages({'limit': 250, 'fields': _CUSTOMER_FIELDS, 'updated_at_min': since}):
+            for c in page:
+                self.apply(c)
+            n += len(page)
+        self.synced = time.time()
+        return n
+
+    def _run(self):
+        while not self.ready:
+            try:
+                _call('call', 'customer_index_load', self.load)
+            except Exception as e:
+                log.error(f"Customer index {self.t.name} load: {e}")
+                time.sleep(60)
+        while True:
+            self._wake.wait(SHOPIFY_SYNC_S)
+            self._wake.clear()
+            try:
+                _call('call', 'customer_index_poll', self.poll)
+            except Exception as e:
+                log.error(f"Customer index {self.t.name} poll: {e}")
+
+def _parse_ts(value: str | None) -> datetime | None:
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+def customer_index(t: Tenant = None) -> CustomerIndex | None:
+    t = t or tenant()
+    if SHOPIFY_SYNC_S <= 0 or not t.shopify_token:
+        return None
+    return t.customers.get()
+
+def _customer_gauges() -> dict:
+    idx = [t.customers.peek() for t in list(_tenants.values()) if t.customers.peek()]
+    return {'bot_customer_index_phones': sum(len(i.names) for i in idx)}
+
+_gauges.append(_customer_gauges)
 
+@timed('customer_status')
 def customer_status(phone: str) -> dict:
-    s = shopify_lookup(phone)
+    idx = customer_index()
+    s   = idx.lookup(phone) if idx else None
+    if s is None:
+        count('customers', 'live')
+        s = shopify_lookup(phone)
+    elif not s['exists'] and idx.recheck(phone):
+        count('customers', 'miss_live')
+        live = shopify_lookup(phone)
+        s    = s if live.get('failed') else live
+        if s['exists']:
+            idx.learn(phone, s)
+    else:
+        count('customers', 'hit' if s['exists'] else 'miss')
     if s['exists']:
         return {
             'status':     'b2b' if s['b2b'] else 'retail',
             'first_name': s['first_name'] or 'Customer',
         }
-    sh = sheets_lookup(phone)
+    cached = cached_status(phone) if s.get('failed') else None
+    if cached:
+        degrade('profile')
+        return cached
+    sh = idx.registration(phone) if idx else sheets_lookup(phone)
     if sh['exists']:
         return {'status': 'incomplete', 'first_name': sh['first_name'] or 'Customer'}
-    sheets_log(phone)
+    if s.get('failed') or sh.get('failed'):
+        # Unknown rather than new — don't append a Registrations row for them.
+        degrade('profile')
+        return cached_status(phone) or {'status': 'new', 'first_name': 'Customer'}
+    if sheets_log(phone) is not False and idx:
+        idx.registered(phone, {'exists': True, 'first_name': ''})
     return {'status': 'new', 'first_name': 'Customer'}
 
+def cached_status(phone: str) -> dict | None:
+    """The status handle() last saw for this phone, while its session lives."""
+    s = tenant().sessions.get(wa_key(phone) or phone)
+    if s and s.get('status'):
+        return {'status': s['status'], 'first_name': s['first_name']}
+    return None
+
 # ─────────────────────────────────────────────────────────────
 # FUZZY SEARCH
+# Free text → the closest collection name. Below the threshold the
+# message falls through to Aru (a Gemini call). Scorer and threshold
+# are measured against corpus/search.tsv by `python bench.py search`.
 # ─────────────────────────────────────────────────────────────
 
-def fuzzy_search(query: str) -> dict:
+FUZZY_SCORERS = {
+    'ratio':                    fuzz.ratio,
+    'partial_ratio':            fuzz.partial_ratio,
+    'token_sort_ratio':         fuzz.token_sort_ratio,
+    'token_set_ratio':          fuzz.token_set_ratio,
+    'partial_token_sort_ratio': fuzz.partial_token_sort_ratio,
+    'QRatio':                   fuzz.QRatio,
+    'WRatio':                   fuzz.WRatio,
+}
+
+@timed('fuzzy_search')
+def fuzzy_search(query: str, scorer: str = None, threshold: float = None, normalize: bool = None) -> dict:
     try:
         if not query:
             return {'found': False}
-        match = process.extractOne(query, ALL_NAMES, scorer=fuzz.token_sort_ratio)
-        if match and match[1] >= 55:
-            for cid, name in ID_TO_NAME.items():
-                if name == match[0]:
-                    return {'found': True, 'id': cid, 'name': name}
-        return {'found': False}
+        cat   = _catalog
+        cut   = FUZZY_THRESHOLD if threshold is None else threshold
+        norm  = FUZZY_NORMALIZE if normalize is None else normalize
+        match = process.extractOne(query, cat['all_names'], scorer=FUZZY_SCORERS[scorer or FUZZY_SCORER],
+                                   processor=utils.default_process if norm else None)
+        if match and match[1] >= cut:
+            return {'found': True, 'id': cat['name_to_id'][match[0]], 'name': match[0], 'score': match[1]}
+        return {'found': False, 'score': match[1] if match else 0.0}
     except Exception as e:
         log.error(f"Fuzzy: {e}")
         return {'found': False}
@@ -393,26 +1579,200 @@ def fuzzy_search(query: str) -> dict:
 # RAZORPAY
 # ─────────────────────────────────────────────────────────────
 
+@timed('rzp_link', ok=bool)
 def rzp_link(amount_paise: int, name: str, phone: str, ref: str):
     try:
-        if not RZP_KEY_ID or not RZP_KEY_SEC:
-            return None
-        client = razorpay.Client(auth=(RZP_KEY_ID, RZP_KEY_SEC))
-        link   = client.payment_link.create({
-            'amount':          amount_paise,
-            'currency':        'INR',
-            'accept_partial':  False,
-            'description':     f'A Jewel Studio - Order {ref}',
-            'customer':        {'name': name, 'contact': f'+{phone}'},
-            'notify':          {'sms': False, 'email': False},
-            'reminder_enable': False,
-            'notes':           {'order_ref': ref},
-        })
+        with tenant().rzp.use() as client:
+            if not client:
+                return None
+            with breaker('razorpay').call():
+                link = client.payment_link.create({
+                    'amount':          amount_paise,
+                    'currency':        'INR',
+                    'accept_partial':  False,
+                    'description':     f'A Jewel Studio - Order {ref}',
+                    'customer':        {'name': name, 'contact': f'+{phone}'},
+                    'notify':          {'sms': False, 'email': False},
+                    'reminder_enable': False,
+                    'notes':           {'order_ref': ref, 'tenant': tenant().id},
+                })
         return link.get('short_url')
     except Exception as e:
         log.error(f"Razorpay: {e}")
         return None
 
+# ─────────────────────────────────────────────────────────────
+# ORDER LEDGER
+# Every order and custom-order reference in a local SQLite file
+# (ORDERS_DB), keyed by (tenant, ref): items, total, payment link
+# and status. The request path only queues the write. A background
+# thread commits queued writes in one transaction, and until then
+# find_order() answers from the queue. Payment status comes from
+# Razorpay's payment_link.* webhooks on /razorpay/webhook.
+# ─────────────────────────────────────────────────────────────
+
+_ORDERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    tenant  TEXT NOT NULL,
+    ref     TEXT NOT NULL,
+    phone   TEXT NOT NULL,
+    name    TEXT,
+    kind    TEXT NOT NULL,      -- cart | custom
+    items   TEXT,               -- JSON product_items
+    total   INTEGER,            -- paise
+    link    TEXT,
+    status  TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (tenant, ref)
+) WITHOUT ROWID
+"""
+_ORDER_COLS = ('tenant', 'ref', 'phone', 'name', 'kind', 'items', 'total', 'link', 'status', 'created', 'updated')
+_ORDER_PUT  = f"INSERT INTO orders ({', '.join(_ORDER_COLS)}) VALUES ({', '.join('?' * len(_ORDER_COLS))})"
+_ORDER_SET  = "UPDATE orders SET status = ?, updated = ? WHERE tenant = ? AND ref = ?"
+_ORDER_GET  = f"SELECT {', '.join(_ORDER_COLS)} FROM orders WHERE tenant = ? AND ref = ?"
+
+_orders_q: deque     = deque()   # ('put', row) | ('set', (status, ts, tenant, ref))
+_orders_pending: dict = {}       # (tenant, ref) → row not committed yet
+_orders_lock   = threading.Lock()
+_orders_wake   = threading.Event()
+_orders_flush  = threading.Lock()
+_orders_thread = None
+
+def _open_orders_db() -> sqlite3.Connection:
+    """WAL: lookups never wait for the writer. Lent to one thread at a time — see _Pool."""
+    db = sqlite3.connect(ORDERS_DB, timeout=10, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute(_ORDERS_SCHEMA)
+    return db
+
+_orders_dbs = _Pool('orders_db', _open_orders_db, 4)    # the writer's and a few lookups'
+
+@contextmanager
+def _orders_db():
+    with _orders_dbs.use() as db:
+        if db is None:
+            raise sqlite3.OperationalError(f"can't open {ORDERS_DB}")
+        yield db
+
+def _orders_enqueue(op: tuple):
+    global _orders_thread
+    _orders_q.append(op)
+    if _orders_thread is None:
+        _orders_thread = threading.Thread(target=_orders_writer, name='orders', daemon=True)
+        _orders_thread.start()
+    _orders_wake.set()
+
+def order_ref(phone: str) -> str:
+    """AJS-<last 4 digits>-<epoch s><3 random digits>, not already in the ledger."""
+    while True:
+        ref = f"AJS-{phone[-4:]}-{int(datetime.now().timestamp())}{random.randrange(1000):03d}"
+        if find_order(ref) is None:
+            return ref
+
+def record_order(ref: str, phone: str, name: str, kind: str, items: list = None,
+                 total: int = None, link: str = None, status: str = 'pending'):
+    if not ORDERS_DB:
+        return
+    now = time.time()
+    row = {'tenant': tenant().id, 'ref': ref, 'phone': wa_key(phone) or phone, 'name': name,
+           'kind': kind, 'items': json.dumps(items, ensure_ascii=False) if items is not None else None,
+           'total': total, 'link': link, 'status': status, 'created': now, 'updated': now}
+    with _orders_lock:
+        _orders_pending[(row['tenant'], ref)] = row
+        _orders_enqueue(('put', row))
+    count('orders', 'recorded')
+
+def set_order_status(tid: str, ref: str, status: str):
+    now = time.time()
+    with _orders_lock:
+        row = _orders_pending.get((tid, ref))
+        if row is not None:
+            row['status'], row['updated'] = status, now
+        _orders_enqueue(('set', (status, now, tid, ref)))
+
+def find_order(ref: str, tid: str = None) -> dict | None:
+    if not ORDERS_DB:
+        return None
+    key = (tid or tenant().id, ref)
+    with _orders_lock:
+        row = _orders_pending.get(key)
+    if row is not None:
+        return dict(row)
+    # Rows leave _orders_pending only after their commit, so a miss there is final here.
+    with _orders_db() as db:
+        r = db.execute(_ORDER_GET, key).fetchone()
+    return dict(zip(_ORDER_COLS, r)) if r else None
+
+def _orders_writer():
+    while True:
+        _orders_wake.wait(5 if _orders_q else None)    # retry a failed commit
+        _orders_wake.clear()
+        flush_orders()
+
+def flush_orders() -> int:
+    """Commit everything queued so far. Returns the number of writes."""
+    written = 0
+    with _orders_flush:
+        while _orders_q:
+            batch = []
+            while _orders_q and len(batch) < 5000:
+                batch.append(_orders_q.popleft())
+            try:
+                with _orders_db() as db:
+                    try:
+                        with db:
+                            for kind, ops in itertools.groupby(batch, key=lambda op: op[0]):
+                                if kind == 'put':
+                                    db.executemany(_ORDER_PUT, [tuple(op[1][c] for c in _ORDER_COLS) for op in ops])
+                                else:
+                                    db.executemany(_ORDER_SET, [op[1] for op in ops])
+                    except sqlite3.IntegrityError:
+                        _orders_each(db, batch)
+            except Exception as e:
+                log.error(f"Order ledger write: {e}")
+                count('orders', 'write_failed', len(batch))
+                _orders_q.extendleft(reversed(batch))
+                break
+            with _orders_lock:
+                for op in batch:
+                    if op[0] == 'put':
+                        key = (op[1]['tenant'], op[1]['ref'])
+                        if _orders_pending.get(key) is op[1]:
+                            del _orders_pending[key]
+            count('orders', 'written', len(batch))
+            written += len(batch)
+    return written
+
+def _orders_each(db: sqlite3.Connection, batch: list):
+    """A batch holding a reference that is already taken: commit the rest one by one."""
+    with db:
+        for kind, data in batch:
+            try:
+                if kind == 'put':
+                    db.execute(_ORDER_PUT, tuple(data[c] for c in _ORDER_COLS))
+                else:
+                    db.execute(_ORDER_SET, data)
+            except sqlite3.IntegrityError:
+                log.error(f"Order ledger: {data['ref']} already recorded for tenant {data['tenant']} — "
+                          f"order for {data['phone']} not written")
+                count('orders', 'duplicate')
+
+atexit.register(flush_orders)
+
+def _orders_gauges() -> dict:
+    return {'bot_orders_queue': len(_orders_q)}
+
+_gauges.append(_orders_gauges)
+
+_RZP_EVENTS = {
+    'payment_link.paid':           'paid',
+    'payment_link.partially_paid': 'partially_paid',
+    'payment_link.cancelled':      'cancelled',
+    'payment_link.expired':        'expired',
+}
+
 # ─────────────────────────────────────────────────────────────
 # REFERRAL
 # ─────────────────────────────────────────────────────────────
@@ -445,13 +1805,9 @@ def update_lang(text: str, session: dict) -> str:
     - Hinglish/Hindi words → set 'hi'
     - Otherwise keep current
     """
-    tl = text.lower()
-    if any(phrase in tl for phrase in _EN_REQUEST):
-        session['lang'] = 'en'
-    elif set(tl.split()) & _HI_WORDS:
-        session['lang'] = 'hi'
-    elif len(re.findall(r'[\u0900-\u097F]', text)) > 0:
-        session['lang'] = 'hi'
+    lang = analyse_text(text)['lang']
+    if lang:
+        session['lang'] = lang
     return session['lang']
 
 # ─────────────────────────────────────────────────────────────
@@ -467,9 +1823,11 @@ Rules:
 - If unsure about price or stock, say the team will confirm.
 """
 
+@timed('ask_aru', ok=bool)
 def ask_aru(question: str, lang: str, first_name: str, context: str = '') -> str | None:
     try:
-        if not _gm:
+        gm = _gm.get()
+        if not gm:
             return None
         lang_note = (
             "Respond in English only."
@@ -481,59 +1839,77 @@ def ask_aru(question: str, lang: str, first_name: str, context: str = '') -> str
             f"Context: {context}\n\nCustomer says: {question}\n\n"
             "Reply as Aru — max 2 sentences, no emojis."
         )
-        return _gm.generate_content(prompt).text.strip()
+        with breaker('gemini').call():
+            reply = gm.generate_content(prompt, request_options={'timeout': call_timeout(10)}).text.strip()
+        note(aru=True)
+        return reply
     except Exception as e:
         log.error(f"Aru: {e}")
+        degrade('aru')
         return None
 
+_DESIGN_WORDS = {
+    'ring', 'necklace', 'bracelet', 'earring', 'bangle', 'kada', 'chain',
+    'pendant', 'anklet', 'choker', 'gold', 'silver', 'diamond', 'stone',
+    'bridal', 'wedding', 'engagement', 'design', 'material', 'occasion',
+    'budget', 'style', 'type', 'weight', 'gram', 'sona', 'chandi',
+    'haar', 'payal', 'jhumka', 'kangan', 'angoothi', 'shaadi', 'dulhan',
+}
+
 def is_design_desc(text: str) -> bool:
-    words = set(re.findall(r'\w+', text.lower()))
-    design_words = {
-        'ring', 'necklace', 'bracelet', 'earring', 'bangle', 'kada', 'chain',
-        'pendant', 'anklet', 'choker', 'gold', 'silver', 'diamond', 'stone',
-        'bridal', 'wedding', 'engagement', 'design', 'material', 'occasion',
-        'budget', 'style', 'type', 'weight', 'gram', 'sona', 'chandi',
-        'haar', 'payal', 'jhumka', 'kangan', 'angoothi', 'shaadi', 'dulhan',
-    }
-    return bool(words & design_words)
+    return analyse_text(text)['design']
 
+@timed('aru_vision', ok=bool)
 def aru_vision(image_url: str) -> dict | None:
     try:
-        if not _gv:
+        gv = _gv.get()
+        if not gv:
             return None
-        img = requests.get(image_url, timeout=10)
+        img = tenant().http.get(image_url, timeout=call_timeout(10))
         if not img.ok:
             return None
-        resp = _gv.generate_content([
-            "Identify jewelry type and style in this image. One sentence.",
-            {'mime_type': 'image/jpeg', 'data': img.content}
-        ])
+        with breaker('gemini').call():
+            resp = gv.generate_content([
+                "Identify jewelry type and style in this image. One sentence.",
+                {'mime_type': 'image/jpeg', 'data': img.content}
+            ], request_options={'timeout': call_timeout(10)})
         al = resp.text.strip().lower()
         kw = [t for t in ['earring', 'jhumka', 'necklace', 'ring', 'bracelet',
                            'bangle', 'kada', 'chain', 'pendant', 'anklet',
                            'traditional', 'modern', 'bridal'] if t in al]
+        note(aru=True)
         return {'query': ' '.join(kw[:3]) or 'jewelry'}
     except Exception as e:
         log.error(f"Vision: {e}")
+        degrade('vision')
         return None
 
 # ─────────────────────────────────────────────────────────────
 # WHATSAPP SENDERS
 # ─────────────────────────────────────────────────────────────
 
-def _post(payload: dict) -> bool:
+@timed('_post', ok=bool)
+def _post(payload: dict, attempt: int = 0) -> bool:
+    if _tls.capture is not None:
+        _tls.capture.append(payload)
     try:
-        r = requests.post(
-            WA_API,
-            headers={'Authorization': f'Bearer {WA_TOKEN}',
+        t = tenant()
+        t.limiter.take()
+        r = t.http.post(
+            t.wa_api,
+            headers={'Authorization': f'Bearer {t.wa_token}',
                      'Content-Type':  'application/json'},
-            json=payload, timeout=10
+            json=payload, timeout=call_timeout(10)
         )
         if not r.ok:
             log.error(f"WA {r.status_code}: {r.text[:300]}")
-        return r.ok
+            nocache()
+            return False
+        _remember_sent(r.json(), payload, attempt)
+        return True
     except Exception as e:
         log.error(f"WA post: {e}")
+        nocache()
         return False
 
 def tx(to: str, text: str) -> bool:
@@ -587,40 +1963,212 @@ def cta(to: str, body: str, label: str, url: str) -> bool:
         }
     })
 
+def template(to: str, name: str, lang_code: str, params: list = ()) -> bool:
+    """An approved template — the only kind of message allowed outside the 24 h window."""
+    tpl = {'name': name, 'language': {'code': lang_code}}
+    if params:
+        tpl['components'] = [{'type': 'body',
+                              'parameters': [{'type': 'text', 'text': str(p)} for p in params]}]
+    return _post({'messaging_product': 'whatsapp', 'to': to, 'type': 'template', 'template': tpl})
+
+@timed('open_catalog', ok=bool)
 def open_catalog(to: str, cid: str, cname: str) -> bool:
+    nocache()                           # product lists change under the same reply id
     try:
-        r = requests.get(
-            f"https://graph.facebook.com/v19.0/{cid}/products",
-            params={'fields': 'retailer_id', 'access_token': WA_TOKEN, 'limit': 30},
-            timeout=10
-        )
-        if r.ok:
-            rids = [p['retailer_id'] for p in r.json().get('data', []) if 'retailer_id' in p]
-            if rids:
-                return _post({
-                    'messaging_product': 'whatsapp', 'to': to, 'type': 'interactive',
-                    'interactive': {
-                        'type':   'product_list',
-                        'header': {'type': 'text', 'text': 'A Jewel Studio'},
-                        'body':   {'text': cname},
-                        'footer': {'text': 'Add to cart, then tap Place Order.'},
-                        'action': {
-                            'catalog_id': CATALOG_ID,
-                            'sections': [{
-                                'title': cname[:24],
-                                'product_items': [{'product_retailer_id': rid} for rid in rids[:30]]
-                            }]
-                        }
+        t    = tenant()
+        rids = collection_products(cid)
+        if rids:
+            return _post({
+                'messaging_product': 'whatsapp', 'to': to, 'type': 'interactive',
+                'interactive': {
+                    'type':   'product_list',
+                    'header': {'type': 'text', 'text': 'A Jewel Studio'},
+                    'body':   {'text': cname},
+                    'footer': {'text': 'Add to cart, then tap Place Order.'},
+                    'action': {
+                        'catalog_id': t.catalog_id,
+                        'sections': [{
+                            'title': cname[:24],
+                            'product_items': [{'product_retailer_id': rid} for rid in rids[:30]]
+                        }]
                     }
-                })
+                }
+            })
         log.warning(f"No products: {cid}")
         return False
     except Exception as e:
         log.error(f"open_catalog: {e}")
         return False
 
+@timed('media_url', ok=bool)
+def media_url(media_id: str) -> str | None:
+    try:
+        t = tenant()
+        r = t.http.get(
+            f"{GRAPH_API}/{media_id}",
+            headers={'Authorization': f'Bearer {t.wa_token}'}, timeout=call_timeout(10)
+        )
+        return r.json().get('url', '') if r.ok else None
+    except Exception as e:
+        log.error(f"Media URL: {e}")
+        return None
+
+@timed('_p')
 def _p(t: float = 0.4):
-    time.sleep(t)
+    if afford('pacing', t + CALL_FLOOR_S):
+        time.sleep(t)
+
+# ─────────────────────────────────────────────────────────────
+# MEDIA STORE
+# A custom order's reference image is kept by the bot, off the
+# customer's response path. A MEDIA_WORKERS pool resolves the media
+# id, streams the download to a temp file while hashing it, and files
+# it as MEDIA_DIR/<sha256[:2]>/<sha256>.<ext> — an image sent twice is
+# stored once. A JPEG thumbnail, <sha256>.thumb.jpg, sits next to it.
+# The admin email goes out from the pool afterwards: the SHA-256 as
+# the stable reference, the thumbnail attached, and signed
+# /media/<name> links when MEDIA_BASE_URL and MEDIA_SECRET are set.
+# Graph's own media URLs expire and need the WhatsApp token.
+# A file lives in the MEDIA_DIR of the node that stored it, so in a
+# cluster a link must reach that node: MEDIA_BASE_URL is per node and
+# defaults to CLUSTER_SELF_URL. One MEDIA_BASE_URL behind a load
+# balancer only works when every node mounts the same MEDIA_DIR
+# (shared storage).
+# ─────────────────────────────────────────────────────────────
+
+_MEDIA_NAME = re.compile(r'[0-9a-f]{64}(\.thumb)?\.\w+')
+_MEDIA_EXT  = {'image/jpeg': 'jpg', 'image/png': 'png', 'image/webp': 'webp'}
+_media_pool    = ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix='media')
+_media_pending = 0
+_media_lock    = threading.Lock()
+
+def media_path(name: str) -> str:
+    return os.path.join(MEDIA_DIR, name[:2], name)
+
+def media_sig(name: str) -> str:
+    return hmac.new(MEDIA_SECRET.encode(), name.encode(), hashlib.sha256).hexdigest()[:32]
+
+def media_link(name: str) -> str | None:
+    """Signed URL of a stored file; None if links aren't configured."""
+    if not (MEDIA_BASE_URL and MEDIA_SECRET):
+        return None
+    return f"{MEDIA_BASE_URL}/media/{name}?sig={media_sig(name)}"
+
+def _unlink(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+@timed('store_media', ok=lambda r: r is not None)
+def store_media(media_id: str) -> tuple | None:
+    """Download a WhatsApp media id into MEDIA_DIR → (sha256, file name, bytes, already stored)."""
+    t   = tenant()
+    url = media_url(media_id)
+    if not url:
+        return None
+    tmp = os.path.join(MEDIA_DIR, f".{media_id}.{threading.get_ident()}.part")
+    try:
+        os.makedirs(MEDIA_DIR, exist_ok=True)
+        h, size = hashlib.sha256(), 0
+        with t.http.get(url, headers={'Authorization': f'Bearer {t.wa_token}'},
+                        stream=True, timeout=call_timeout(30)) as r:
+            if not r.ok:
+                log.warning(f"Media {media_id}: HTTP {r.status_code}")
+                return None
+            ext = _MEDIA_EXT.get(r.headers.get('Content-Type', '').split(';')[0].strip(), 'bin')
+            with open(tmp, 'wb') as f:
+                for chunk in r.iter_content(1 << 16):
+                    size += len(chunk)
+                    if size > MEDIA_MAX_BYTES:
+                        log.warning(f"Media {media_id}: larger than {MEDIA_MAX_BYTES} bytes")
+                        return None
+                    h.update(chunk)
+                    f.write(chunk)
+        sha  = h.hexdigest()
+        name = f"{sha}.{ext}"
+        path = media_path(name)
+        if os.path.exists(path):
+            return sha, name, size, True
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp, path)
+        return sha, name, size, False
+    except Exception as e:
+        log.error(f"Media {media_id}: {e}")
+        return None
+    finally:
+        _unlink(tmp)
+
+@timed('thumbnail', ok=lambda r: r is not None)
+def thumbnail(sha: str, name: str) -> bytes | None:
+    """JPEG thumbnail of a stored image, made on first use."""
+    path = media_path(f"{sha}.thumb.jpg")
+    try:
+        if not os.path.exists(path):
+            from PIL import Image
+            tmp = f"{path}.{threading.get_ident()}.part"
+            with Image.open(media_path(name)) as im:
+                im.draft('RGB', (MEDIA_THUMB_PX, MEDIA_THUMB_PX))    # JPEGs decode at reduced scale
+                im.thumbnail((MEDIA_THUMB_PX, MEDIA_THUMB_PX))
+                im.convert('RGB').save(tmp, 'JPEG', quality=80)
+            os.replace(tmp, path)
+            count('media', 'thumbnail')
+        with open(path, 'rb') as f:
+            return f.read()
+    except Exception as e:
+        log.error(f"Thumbnail {sha[:12]}: {e}")
+        return None
+
+def _custom_image(t, media_id: str, ref: str, first_name: str, phone: str, b2b: bool):
+    global _media_pending
+    _tls.tenant = t
+    try:
+        stored = store_media(media_id) if MEDIA_DIR and media_id else None
+        images = []
+        if stored:
+            sha, name, size, dup = stored
+            count('media', 'duplicate' if dup else 'stored')
+            thumb = thumbnail(sha, name)
+            if thumb:
+                images.append((f"{ref}.jpg", thumb))
+            image = (f"Image    : {media_link(name) or media_path(name)}\n"
+                     f"SHA-256  : {sha} ({size // 1024} KiB{', sent before' if dup else ''})")
+        else:
+            if MEDIA_DIR and media_id:
+                count('media', 'failed')
+            url   = media_url(media_id) if media_id and not MEDIA_DIR else None
+            image = f"Image URL: {url or 'See WhatsApp chat'}"
+        admin_email(
+            subject=f"Custom Order (Image) — {first_name} — {phone}",
+            body=(
+                f"Custom order with image reference received.\n\n"
+                f"Customer : {first_name}\n"
+                f"Phone    : {phone}\n"
+                f"Ref      : {ref}\n"
+                f"Type     : {'B2B' if b2b else 'Retail'}\n\n"
+                f"Customer uploaded a reference image.\n"
+                f"{image}"
+            ),
+            images=images
+        )
+    except Exception as e:
+        log.error(f"Custom image {ref}: {e}")
+    finally:
+        _tls.tenant = None
+        with _media_lock:
+            _media_pending -= 1
+
+def custom_image(media_id: str, ref: str, first_name: str, phone: str, b2b: bool):
+    """Store the reference image and mail the admins, in the background."""
+    global _media_pending
+    with _media_lock:
+        _media_pending += 1
+    _media_pool.submit(_custom_image, tenant(), media_id, ref, first_name, phone, b2b)
+
+def _media_gauges() -> dict:
+    return {'bot_media_pending': _media_pending}
+
+_gauges.append(_media_gauges)
 
 # ─────────────────────────────────────────────────────────────
 # FLOWS
@@ -641,7 +2189,7 @@ def flow_new_customer(to: str, lang: str):
             lang
         ),
         "JOIN US",
-        f"https://{SHOPIFY_STORE}/pages/join-us?wa={to}"
+        f"https://{tenant().shop_domain}/pages/join-us?wa={to}"
     )
 
 # ── INCOMPLETE REGISTRATION ───────────────────────────────────
@@ -653,7 +2201,7 @@ def flow_incomplete(to: str, lang: str):
             lang
         ),
         "COMPLETE REGISTRATION",
-        f"https://{SHOPIFY_STORE}/pages/join-us?wa={to}"
+        f"https://{tenant().shop_domain}/pages/join-us?wa={to}"
     )
 
 # ── WELCOME = DIRECT LIST ─────────────────────────────────────
@@ -694,11 +2242,27 @@ def flow_catalogs(to: str, lang: str):
         ]}]
     )
 
-# ── BABY ──────────────────────────────────────────────────────
-def flow_baby(to: str, lang: str):
-    scroll(to, 'Baby Jewelry',
-        _hi('Select a collection.', 'Collection select karein.', lang),
-        'SELECT', [_sec('Baby Jewelry', BABY)])
+# ── COLLECTION MENUS ──────────────────────────────────────────
+# Rendered from the catalog registry; a menu with a single
+# collection opens its catalog directly.
+_PROMPTS = {
+    'collection': ('Select a collection.', 'Collection select karein.'),
+    'style':      ('Select a style.',      'Ek style select karein.'),
+    'category':   ('Select a category.',   'Ek category select karein.'),
+}
+
+def flow_menu(to: str, mid: str, lang: str, page: int = 0, cat: dict = None):
+    cat = cat or _catalog
+    header, prompt, secs = cat['menus'][mid]
+    items = [(cid, name) for _, d in secs for name, cid in d.items()]
+    if len(items) == 1:
+        flow_open_collection(to, items[0][0], items[0][1], lang)
+        return
+    pages = menu_pages(mid, lang, cat)
+    page  = min(max(page, 0), len(pages) - 1)
+    if len(pages) > 1:
+        header = f"{header} ({page + 1}/{len(pages)})"
+    scroll(to, header, _hi(*_PROMPTS[prompt], lang), 'SELECT', pages[page])
 
 # ── WOMEN ─────────────────────────────────────────────────────
 def flow_women_body(to: str, lang: str):
@@ -729,24 +2293,6 @@ def flow_face_menu(to: str, lang: str):
         _hi('Or explore Hair Accessories.', 'Ya Hair Accessories dekhein.', lang),
         'F_HAIR', 'HAIR ACCESSORIES')
 
-def flow_face_earrings(to: str, lang: str):
-    scroll(to, 'Earrings',
-        _hi('Select a collection.', 'Collection select karein.', lang),
-        'SELECT', [_sec('Earrings', FACE_EARRINGS)])
-
-def flow_face_nose(to: str, lang: str):
-    scroll(to, 'Nose Jewelry',
-        _hi('Select a collection.', 'Collection select karein.', lang),
-        'SELECT', [_sec('Nose Jewelry', FACE_NOSE)])
-
-def flow_face_head(to: str, lang: str):
-    scroll(to, 'Head Jewelry',
-        _hi('Select a collection.', 'Collection select karein.', lang),
-        'SELECT', [_sec('Head Jewelry', FACE_HEAD)])
-
-def flow_face_hair(to: str, lang: str):
-    flow_open_collection(to, FACE_HAIR['Hair Clips'], 'Hair Clips', lang)
-
 def flow_hand_menu(to: str, lang: str):
     btns(to,
         _hi('Select a category.', 'Ek category select karein.', lang),
@@ -760,40 +2306,7 @@ def flow_hand_menu(to: str, lang: str):
     btn1(to, _hi('Or explore Armlets.', 'Ya Armlets dekhein.', lang),
          'H_ARMLETS', 'ARMLETS')
 
-def flow_hand_bangles(to: str, lang: str):
-    scroll(to, 'Bangles and Kada',
-        _hi('Select a collection.', 'Collection select karein.', lang),
-        'SELECT', [_sec('Bangles and Kada', HAND_BANGLES)])
-
-def flow_hand_bracelets(to: str, lang: str):
-    scroll(to, 'Bracelets',
-        _hi('Select a collection.', 'Collection select karein.', lang),
-        'SELECT', [_sec('Bracelets', HAND_BRACELETS)])
-
-def flow_hand_armlets(to: str, lang: str):
-    flow_open_collection(to, HAND_ARMLETS['Baju Band'], 'Baju Band', lang)
-
-def flow_hand_rings(to: str, lang: str):
-    scroll(to, 'Rings',
-        _hi('Select a collection.', 'Collection select karein.', lang),
-        'SELECT', [_sec('Rings', HAND_RINGS)])
-
-def flow_neck_menu(to: str, lang: str):
-    scroll(to, 'Neck Jewelry',
-        _hi('Select a style.', 'Ek style select karein.', lang),
-        'SELECT',
-        [
-            _sec('Necklaces',   NECK_NECKLACES),   # 5
-            _sec('Pendants',    NECK_PENDANTS),     # 4
-            _sec('Bridal Sets', NECK_BRIDAL),       # 1
-        ]   # total = 10
-    )
-
-def flow_lower(to: str, lang: str):
-    scroll(to, 'Lower Body Jewelry',
-        _hi('Select a collection.', 'Collection select karein.', lang),
-        'SELECT', [_sec('Lower Body', LOWER)])
-
+# ── MEN ───────────────────────────────────────────────────────
 def flow_men_menu(to: str, lang: str):
     scroll(to, 'Men Jewelry',
         _hi('Select a category.', 'Ek category select karein.', lang),
@@ -806,44 +2319,16 @@ def flow_men_menu(to: str, lang: str):
         ]}]
     )
 
-def flow_men_rings(to: str, lang: str):
-    scroll(to, 'Men Rings',
-        _hi('Select a collection.', 'Collection select karein.', lang),
-        'SELECT', [_sec('Rings', MEN_RINGS)])
-
-def flow_men_bracelets(to: str, lang: str):
-    scroll(to, 'Men Bracelets',
-        _hi('Select a collection.', 'Collection select karein.', lang),
-        'SELECT', [_sec('Bracelets', MEN_BRACELETS)])
-
-def flow_men_chains(to: str, lang: str):
-    scroll(to, 'Men Chains',
-        _hi('Select a collection.', 'Collection select karein.', lang),
-        'SELECT', [_sec('Chains', MEN_CHAINS)])
-
-def flow_men_accessories(to: str, lang: str):
-    scroll(to, 'Men Accessories',
-        _hi('Select a collection.', 'Collection select karein.', lang),
-        'SELECT', [_sec('Accessories', MEN_ACCESSORIES)])
-
+# ── STUDIO ────────────────────────────────────────────────────
 def flow_studio_menu(to: str, lang: str):
     btns(to, _hi('Select a category.', 'Ek category select karein.', lang), [
         {'id': 'S_WATCHES', 'title': 'WATCHES'},
         {'id': 'S_ACCSS',   'title': 'ACCESSORIES'},
     ])
 
-def flow_watches(to: str, lang: str):
-    scroll(to, 'Watches',
-        _hi('Select a collection.', 'Collection select karein.', lang),
-        'SELECT', [_sec('Watches', WATCHES)])
-
-def flow_studio_acc(to: str, lang: str):
-    scroll(to, 'Studio Accessories',
-        _hi('Select a collection.', 'Collection select karein.', lang),
-        'SELECT', [_sec('Studio Accessories', STUDIO_ACCESSORIES)])
-
 # ── CATALOG OPEN ──────────────────────────────────────────────
 def flow_open_collection(to: str, cid: str, cname: str, lang: str):
+    note(collection_id=cid, collection=cname)
     if not open_catalog(to, cid, cname):
         flow_empty_catalog(to, lang)
 
@@ -904,8 +2389,10 @@ def flow_custom_done(to: str, first_name: str, phone: str, desc: str, is_b2b: bo
 # ── ORDER PLACED ──────────────────────────────────────────────
 def flow_order_placed(to: str, phone: str, first_name: str, items: list, lang: str):
     total = sum(int(float(i.get('item_price', 0)) * 100) * i.get('quantity', 1) for i in items)
-    ref   = f"AJS-{phone[-4:]}-{int(datetime.now().timestamp())}"
+    note(order_total=total / 100, order_items=sum(int(i.get('quantity', 1)) for i in items))
+    ref   = order_ref(phone)
     url   = rzp_link(total, first_name, phone, ref)
+    record_order(ref, phone, first_name, 'cart', items, total, url)
     if url:
         cta(to,
             _hi(
@@ -932,6 +2419,33 @@ def flow_order_placed(to: str, phone: str, first_name: str, items: list, lang: s
         body=f"New order.\n\nRef: {ref}\nCustomer: {first_name}\nPhone: {phone}\n\nItems:\n{item_lines}\n\nTotal: Rs.{total/100:.2f}"
     )
 
+# ── ORDER STATUS ──────────────────────────────────────────────
+# Answer to an AJS-… reference, from the order ledger.
+_ORDER_STATUS = {
+    'pending':        ('Awaiting payment', 'Payment baaki hai'),
+    'partially_paid': ('Partially paid', 'Payment aadha mila hai'),
+    'paid':           ('Paid — our team is preparing your order', 'Payment mil gaya — order taiyaar ho raha hai'),
+    'cancelled':      ('Cancelled', 'Cancel ho gaya'),
+    'expired':        ('Payment link expired — our team will share a new one',
+                       'Payment link expire ho gaya — team naya link bhejegi'),
+    'received':       ('Received — our design team will contact you', 'Mil gaya — design team aapse contact karegi'),
+}
+
+def flow_order_status(to: str, order: dict, lang: str):
+    status = _hi(*_ORDER_STATUS.get(order['status'], (order['status'],) * 2), lang)
+    lines  = [f"Order {order['ref']}",
+              f"{_hi('Placed', 'Order date', lang)}: {datetime.fromtimestamp(order['created']).strftime('%d %b %Y')}"]
+    items  = json.loads(order['items']) if order['items'] else []
+    if items:
+        lines.append(f"Items: {sum(int(i.get('quantity', 1)) for i in items)}")
+    if order['total']:
+        lines.append(f"Total: Rs.{order['total'] / 100:,.2f}")
+    lines.append(f"Status: {status}")
+    if order['status'] in ('pending', 'partially_paid') and order['link']:
+        cta(to, '\n'.join(lines), 'PAY NOW', order['link'])
+    else:
+        tx(to, '\n'.join(lines))
+
 # ─────────────────────────────────────────────────────────────
 # KEYWORDS
 # ─────────────────────────────────────────────────────────────
@@ -946,36 +2460,531 @@ _KW = {
 }
 
 def detect_kw(text: str) -> str | None:
-    words = set(text.lower().split())
-    for ktype, kwords in _KW.items():
-        if words & kwords:
-            return ktype
-    return None
+    return analyse_text(text)['intent']
+
+# ── TEXT ANALYSIS ─────────────────────────────────────────────
+# One tokenisation per message. Every word list above (English
+# requests, Hinglish words, design words, keyword intents) is
+# compiled into one token trie: the root is the merged token map,
+# deeper nodes hold multi-word phrases like 'main menu'. A node
+# carries one merged signal: [english, hinglish, intent rank, design].
+# Intent rank follows _KW order, so the first matching type wins
+# exactly as before.
+
+_TOKEN_RE  = re.compile(r'[a-z0-9]+|[\u0900-\u097F]+')
+_NO_INTENT = len(_KW)
+_KW_TYPES  = list(_KW)
+
+def _build_lexicon() -> dict:
+    root = {}
+    def add(phrase: str, en=False, hi=False, rank=_NO_INTENT, design=False):
+        toks = _TOKEN_RE.findall(phrase.lower())
+        if not toks:
+            return
+        level = root
+        for t in toks[:-1]:
+            level = level.setdefault(t, [None, {}])[1]
+        node = level.setdefault(toks[-1], [None, {}])
+        sig  = node[0] or [False, False, _NO_INTENT, False]
+        node[0] = [sig[0] or en, sig[1] or hi, min(sig[2], rank), sig[3] or design]
+    for phrase in _EN_REQUEST:
+        add(phrase, en=True)
+    for w in _HI_WORDS:
+        add(w, hi=True)
+    for w in _DESIGN_WORDS:
+        add(w, design=True)
+    for rank, words in enumerate(_KW.values()):
+        for w in words:
+            add(w, rank=rank)
+    return root
+
+_LEXICON = _build_lexicon()
+
+def analyse_text(text: str) -> dict:
+    """
+    Language, keyword intent and design signal for one message.
+    lang is 'en' on an explicit English request, 'hi' on Hinglish
+    words or Devanagari script, None to keep the current language.
+    """
+    toks = _TOKEN_RE.findall(text.lower())
+    n    = len(toks)
+    en = hi = design = False
+    rank = _NO_INTENT
+    for i, t in enumerate(toks):
+        node = _LEXICON.get(t)
+        if node is None:
+            if t[0] >= '\u0900':
+                hi = True
+            continue
+        j = i
+        while True:
+            sig = node[0]
+            if sig:
+                en     = en or sig[0]
+                hi     = hi or sig[1]
+                design = design or sig[3]
+                if sig[2] < rank:
+                    rank = sig[2]
+            j += 1
+            if j == n or not node[1]:
+                break
+            node = node[1].get(toks[j])
+            if node is None:
+                break
+    return {
+        'lang':   'en' if en else 'hi' if hi else None,
+        'intent': _KW_TYPES[rank] if rank < _NO_INTENT else None,
+        'design': design,
+        'tokens': toks,
+    }
 
 # ─────────────────────────────────────────────────────────────
-# MAIN HANDLER
+# ROUTER
+# Interactive reply IDs and text keyword intents → handlers. Exact
+# IDs and 'X_' prefixes are both single dict lookups. Collection
+# menus come from the catalog registry, not written by hand.
+# Handlers take one ctx dict: phone, lang, first_name, status, s, id,
+# and cat — the catalog snapshot the message started with. Read menus
+# and names through it, so a hot reload mid-message can't resolve an
+# id against one snapshot and show it from another.
+# cache=True marks a handler whose messages depend only on the reply
+# id and language — see REPLY CACHE.
+# ─────────────────────────────────────────────────────────────
+
+_ROUTES: dict   = {}     # reply id → (route name, handler)
+_PREFIXES: dict = {}     # 'C_'     → (route name, handler)
+_INTENTS: dict  = {}     # keyword type → handler
+_CACHEABLE: set = set()  # handlers whose replies may be replayed
+_middleware: list = []   # mw(route name, next, ctx); first = outermost
+
+def route(*ids: str, name: str = None, cache: bool = False):
+    def deco(fn):
+        for rid in ids:
+            _ROUTES[rid] = (name or rid, fn)
+        if cache:
+            _CACHEABLE.add(fn)
+        return fn
+    return deco
+
+def route_prefix(prefix: str, cache: bool = False):
+    def deco(fn):
+        _PREFIXES[prefix] = (prefix, fn)
+        if cache:
+            _CACHEABLE.add(fn)
+        return fn
+    return deco
+
+def intent(kw: str):
+    def deco(fn):
+        _INTENTS[kw] = fn
+        return fn
+    return deco
+
+def resolve(rid: str, cat: dict = None):
+    hit = _ROUTES.get(rid)
+    if hit is None and rid in (cat or _catalog)['menus']:
+        hit = (rid, _show_menu)
+    if hit is None:
+        i = rid.find('_')
+        if i > 0:
+            hit = _PREFIXES.get(rid[:i + 1])
+    return hit
+
+def run_route(name: str, fn, ctx: dict):
+    ctx['route']     = name
+    ctx['cacheable'] = fn in _CACHEABLE
+    note(route=name)
+    def step(i: int, c: dict):
+        if i == len(_middleware):
+            return fn(c)
+        return _middleware[i](name, lambda c2: step(i + 1, c2), c)
+    return step(0, ctx)
+
+def dispatch_id(rid: str, ctx: dict) -> bool:
+    hit = resolve(rid, ctx['cat'])
+    if hit is None:
+        log.warning(f"No route: {rid}")
+        count('routes', 'unmatched')
+        return False
+    ctx['id'] = rid
+    note(reply_id=rid)
+    run_route(hit[0], hit[1], ctx)
+    return True
+
+def _mw_timing(name: str, nxt, ctx: dict):
+    return _call('route', name, nxt, (ctx,))
+
+_middleware.append(_mw_timing)
+
+# ── REPLY ROUTES ──────────────────────────────────────────────
+def _show_menu(ctx: dict):
+    flow_menu(ctx['phone'], ctx['id'], ctx['lang'], cat=ctx['cat'])
+
+def _simple(flow):
+    return lambda ctx: flow(ctx['phone'], ctx['lang'])
+
+for _rid, _flow in {
+    'ACT_CATALOGS': flow_catalogs,
+    'CAT_WOMEN':    flow_women_body,
+    'CAT_MEN':      flow_men_menu,
+    'CAT_STUDIO':   flow_studio_menu,
+    'CAT_SACRED':   flow_empty_catalog,
+    'W_FACE':       flow_face_menu,
+    'W_HAND':       flow_hand_menu,
+}.items():
+    _ROUTES[_rid] = (_rid, _simple(_flow))
+    _CACHEABLE.add(_ROUTES[_rid][1])
+_CACHEABLE.add(_show_menu)
+
+@route('ACT_CUSTOM')
+def _r_custom(ctx: dict):
+    flow_custom_start(ctx['phone'], ctx['first_name'], ctx['phone'],
+                      ctx['status'] == 'b2b', ctx['lang'])
+
+@route('ACT_ORDERS')
+def _r_orders(ctx: dict):
+    tx(ctx['phone'], _hi(
+        f"Please share your Order Reference Number, {ctx['first_name']} (format: AJS-XXXX-XXXXXXXXXXXXX).",
+        f"Order Reference Number share karein, {ctx['first_name']} (format: AJS-XXXX-XXXXXXXXXXXXX).",
+        ctx['lang']
+    ))
+
+@route_prefix('C_')
+def _r_collection(ctx: dict):
+    cid = ctx['id'][2:]
+    flow_open_collection(ctx['phone'], cid, ctx['cat']['id_to_name'].get(cid, 'Collection'), ctx['lang'])
+
+@route_prefix('P_', cache=True)
+def _r_page(ctx: dict):
+    mid, page = parse_page_token(ctx['id'])
+    if mid in ctx['cat']['menus']:
+        flow_menu(ctx['phone'], mid, ctx['lang'], page, ctx['cat'])
+    else:
+        flow_catalogs(ctx['phone'], ctx['lang'])
+
+# ── KEYWORD INTENTS ───────────────────────────────────────────
+@intent('greet')
+def _kw_greet(ctx: dict):
+    # "Hi" / "menu" mid-session — show menu only, no full welcome restart
+    s, phone, lang = ctx['s'], ctx['phone'], ctx['lang']
+    if ctx['text'].lower().strip() in ('menu', 'main menu'):
+        # "menu" always shows the top-level welcome list
+        s['welcomed'] = True
+        flow_welcome(phone, ctx['first_name'], lang)
+    elif s.get('welcomed'):
+        # "hi" mid-session → catalogs only
+        flow_catalogs(phone, lang)
+    else:
+        s['welcomed'] = True
+        flow_welcome(phone, ctx['first_name'], lang)
+
+@intent('tracking')
+def _kw_tracking(ctx: dict):
+    tx(ctx['phone'], _hi(
+        f"Please share your Order Reference (AJS-XXXX-XXXXXXXXXXXXX), {ctx['first_name']}.",
+        f"Order Reference share karein (AJS-XXXX-XXXXXXXXXXXXX), {ctx['first_name']}.",
+        ctx['lang']
+    ))
+
+@intent('referral')
+def _kw_referral(ctx: dict):
+    code = referral_code(ctx['first_name'], ctx['phone'])
+    url  = f"https://{tenant().shop_domain}/pages/join-us?ref={code}"
+    cta(ctx['phone'],
+        _hi(
+            f"Your Referral Code: {code}\n\nShare with friends and family to invite them.",
+            f"Aapka Referral Code: {code}\n\nDoston aur family ke saath share karein.",
+            ctx['lang']
+        ),
+        'SHARE REFERRAL', url)
+
+@intent('custom')
+def _kw_custom(ctx: dict):
+    _r_custom(ctx)
+
+@intent('hours')
+def _kw_hours(ctx: dict):
+    tx(ctx['phone'], _hi(
+        f"A Jewel Studio\nMon–Sat: 10:00 AM – 7:00 PM\nSunday: By Appointment Only",
+        f"A Jewel Studio\nSomvar–Shanivar: Subah 10 – Shaam 7\nItwar: Sirf Appointment par",
+        ctx['lang']
+    ))
+
+@intent('about')
+def _kw_about(ctx: dict):
+    tx(ctx['phone'], _hi(
+        "A Jewel Studio is a premium jewelry brand offering handcrafted pieces for every occasion.",
+        "A Jewel Studio ek premium jewelry brand hai — har occasion ke liye exclusive handcrafted pieces.",
+        ctx['lang']
+    ))
+
+# ─────────────────────────────────────────────────────────────
+# CATALOG PREFETCH
+# Each tapped reply id is counted as a transition from the menu the
+# customer last saw. When a menu is shown, the collections most
+# likely to be opened next — tapped on this menu, or one menu further
+# down — have their product lists fetched in the background into the
+# product cache open_catalog reads, so the tap doesn't wait on Graph.
+# Budget: PREFETCH_TOP_K collections per menu, only above
+# PREFETCH_MIN_PROBABILITY, at most PREFETCH_MAX_PENDING fetches
+# queued. A tap that finds its prefetch still running waits at most
+# PREFETCH_WAIT_SECONDS for it, then fetches the list itself. A
+# prefetched list that expires or is evicted unopened is counted as
+# wasted. Counts are per tenant (menu ids are the tenant's own), live
+# in memory and restart empty. Only ids that name a route, a catalog
+# menu or a catalog collection are counted — reply ids come from the
+# client — and each menu keeps its _NEXT_MAX most-tapped ones.
+# ─────────────────────────────────────────────────────────────
+
+_NEXT_MAX = 32                  # next reply ids kept per menu; the rarest are pruned past twice this
+_transitions: dict = {}         # (tenant id, menu id) → Counter(next reply id)
+_products = OrderedDict()       # (tenant id, collection id) → _Products, oldest first
+_plock    = threading.Lock()
+_prefetch_pool    = ThreadPoolExecutor(max_workers=4, thread_name_prefix='prefetch')
+_prefetch_pending = 0
+
+class _Products:
+    __slots__ = ('fut', 'expires', 'prefetched', 'used')
+
+    def __init__(self, fut: Future, prefetched: bool):
+        self.fut        = fut
+        self.expires    = time.monotonic() + PRODUCTS_TTL_S
+        self.prefetched = prefetched
+        self.used       = False
+
+    @property
+    def wasted(self) -> bool:
+        return self.prefetched and not self.used
+
+@timed('collection_products', ok=lambda r: r is not None)
+def fetch_products(cid: str) -> list | None:
+    """Retailer ids of a collection's first 30 products; None if Graph failed."""
+    try:
+        t = tenant()
+        r = t.http.get(
+            f"{GRAPH_API}/{cid}/products",
+            params={'fields': 'retailer_id', 'access_token': t.wa_token, 'limit': 30},
+            timeout=call_timeout(10)
+        )
+        if not r.ok:
+            log.warning(f"Products {cid}: HTTP {r.status_code}")
+            return None
+        return [p['retailer_id'] for p in r.json().get('data', []) if 'retailer_id' in p]
+    except Exception as e:
+        log.error(f"Products {cid}: {e}")
+        return None
+
+def _cached(key: tuple):
+    """Live cache entry for key, dropping expired entries from the front. Call with _plock held."""
+    now, wasted = time.monotonic(), 0
+    while _products:
+        first = next(iter(_products.values()))
+        if first.expires > now and len(_products) <= PRODUCTS_MAX:
+            break
+        wasted += _products.popitem(last=False)[1].wasted
+    if wasted:
+        count('prefetch', 'wasted', wasted)
+    return _products.get(key)
+
+def _cache(key: tuple, e: _Products):
+    with _plock:
+        old = _products.pop(key, None)
+        _products[key] = e
+        _cached(key)
+    if old is not None and old.wasted:
+        count('prefetch', 'wasted')
+
+def collection_products(cid: str) -> list | None:
+    """A collection's retailer ids — from the product cache when warm (or being warmed)."""
+    key = (tenant().id, cid)
+    with _plock:
+        e = _cached(key)
+    if e is not None:
+        try:
+            rids = e.fut.result(timeout=min(PREFETCH_WAIT_S, call_timeout(10)) if not e.fut.done() else None)
+        except Exception:
+            rids = None                 # prefetch still hanging: fetch it ourselves
+            count('prefetch', 'late')
+        if rids is not None:
+            count('prefetch', 'hit' if e.prefetched and not e.used else 'cached')
+            e.used = True
+            return rids
+    count('prefetch', 'miss')
+    rids = fetch_products(cid)
+    if rids is not None:
+        fut = Future()
+        fut.set_result(rids)
+        _cache(key, _Products(fut, prefetched=False))
+    return rids
+
+def _single_collection(mid: str, cat: dict = None) -> str | None:
+    """A menu with one collection opens it directly — see flow_menu."""
+    menu  = (cat or _catalog)['menus'].get(mid)
+    items = [cid for _, d in menu[2] for cid in d.values()] if menu else ()
+    return items[0] if len(items) == 1 else None
+
+def likely_next(mid: str, k: int = None, cat: dict = None) -> list:
+    """Collection ids most likely opened after menu `mid` is shown, best first."""
+    tid, scores, cat = tenant().id, Counter(), cat or _catalog
+    def walk(src: str, p: float, depth: int):
+        c = _transitions.get((tid, src))
+        n = sum(c.values()) if c else 0
+        if n < PREFETCH_MIN_SEEN:
+            return
+        for rid, hits in list(c.items()):
+            q    = p * hits / n
+            only = None if rid.startswith('C_') else _single_collection(rid, cat)
+            if rid.startswith('C_') or only:
+                scores[only or rid[2:]] += q
+            elif depth:
+                walk(rid, q, depth - 1)
+    walk(mid, 1.0, 1)
+    return [cid for cid, p in scores.most_common(k or PREFETCH_TOP_K) if p >= PREFETCH_MIN_P]
+
+def _prefetch_one(t, cid: str):
+    global _prefetch_pending
+    _tls.tenant = t
+    try:
+        return fetch_products(cid)
+    finally:
+        _tls.tenant = None
+        with _plock:
+            _prefetch_pending -= 1
+
+def prefetch(mid: str, cat: dict = None):
+    """Warm the product lists of the collections likely to be tapped on menu `mid`."""
+    global _prefetch_pending
+    if PREFETCH_TOP_K <= 0:
+        return
+    t = tenant()
+    for cid in likely_next(mid, cat=cat):
+        key = (t.id, cid)
+        with _plock:
+            if _cached(key) is not None:
+                continue
+            full = _prefetch_pending >= PREFETCH_PENDING
+            if not full:
+                _prefetch_pending += 1
+                _products[key] = _Products(_prefetch_pool.submit(_prefetch_one, t, cid), prefetched=True)
+        count('prefetch', 'skipped' if full else 'issued')
+
+def known_id(rid: str, cat: dict) -> bool:
+    """A reply id this tenant's routes or catalog define, not just one a prefix route accepts."""
+    if rid.startswith('C_'):
+        return rid[2:] in cat['id_to_name']
+    return rid in _ROUTES or rid in cat['menus']
+
+def _mw_prefetch(name: str, nxt, ctx: dict):
+    rid, s = ctx.get('id'), ctx['s']
+    if rid is None:
+        return nxt(ctx)
+    page = rid.startswith('P_')
+    prev = s.get('menu')
+    if prev and not page and known_id(rid, ctx['cat']):
+        key = (tenant().id, prev)
+        with _plock:
+            c = _transitions.setdefault(key, Counter())
+            c[rid] += 1
+            if len(c) > 2 * _NEXT_MAX:
+                _transitions[key] = Counter(dict(c.most_common(_NEXT_MAX)))
+    if not rid.startswith('C_'):
+        mid = parse_page_token(rid)[0] if page else rid
+        if mid in _ROUTES or mid in ctx['cat']['menus']:
+            s['menu'] = mid
+            prefetch(mid, ctx['cat'])       # runs while the menu itself is being sent
+    return nxt(ctx)
+
+_middleware.append(_mw_prefetch)
+
+def prefetch_stats() -> dict:
+    with _mlock:
+        c = {label: n for (k, label), n in _counts.items() if k == 'prefetch'}
+    opens = c.get('hit', 0) + c.get('cached', 0) + c.get('miss', 0)
+    return {'cached':   len(_products),
+            'pending':  _prefetch_pending,
+            'hit_rate': round(c.get('hit', 0) / opens, 3) if opens else None,
+            'issued':   c.get('issued', 0),
+            'wasted':   c.get('wasted', 0)}
+
+def _prefetch_gauges() -> dict:
+    return {'bot_products_cached': len(_products), 'bot_prefetch_pending': _prefetch_pending}
+
+_gauges.append(_prefetch_gauges)
+
+# ─────────────────────────────────────────────────────────────
+# REPLY CACHE
+# A cache=True route sends every customer the same messages for a
+# reply id and language: the static menus, catalog menus and their
+# pages. Its first run's payloads are kept on the catalog snapshot
+# (so a catalog reload starts afresh) and replayed to later
+# customers with only 'to' changed, paced like the flow. Innermost
+# middleware: timing and prefetch still run on a hit. A run that
+# failed a send or opened a product list calls nocache() and isn't
+# kept.
 # ─────────────────────────────────────────────────────────────
 
-def handle(phone: str, msg: dict):
-    _cleanup()
+_REPLIES_MAX = 4096     # kept per catalog snapshot; reply ids come from the client
+
+def nocache():
+    """What the route being run sends depends on more than its id — don't keep it."""
+    _tls.capture = None
+
+def _mw_cache(name: str, nxt, ctx: dict):
+    if not ctx.get('cacheable'):
+        return nxt(ctx)
+    replies = ctx['cat']['replies']
+    key     = (tenant().id, name, ctx.get('id'), ctx['lang'])
+    sent    = replies.get(key)
+    if sent is not None:
+        count('route_cache', 'hit')
+        for i, p in enumerate(sent):
+            if i:
+                _p()
+            _post({**p, 'to': ctx['phone']})
+        return None
+    count('route_cache', 'miss')
+    _tls.capture = []
+    try:
+        out, sent = nxt(ctx), _tls.capture
+        if sent and len(replies) < _REPLIES_MAX:
+            replies[key] = [{k: v for k, v in p.items() if k != 'to'} for p in sent]
+        return out
+    finally:
+        _tls.capture = None
+
+_middleware.append(_mw_cache)
+
+# ─────────────────────────────────────────────────────────────
+# MAIN HANDLER
+# ─────────────────────────────────────────────────────────────
 
+def handle(phone: str, msg: dict, cdata: dict = None, s: dict = None):
     mtype  = msg.get('type')
-    cdata  = customer_status(phone)
-    s      = get_session(phone)
+    cdata  = cdata or customer_status(phone)
+    s      = s or get_session(phone)
     s['first_name'] = cdata['first_name']
+    s['status']     = cdata['status']
 
     lang       = s.get('lang', 'hi')
     first_name = s['first_name']
     status     = cdata['status']
 
     # Update language from incoming text
+    ta = None
     if mtype == 'text':
-        raw  = msg.get('text', {}).get('body', '').strip()
-        lang = update_lang(raw, s)
+        raw = msg.get('text', {}).get('body', '').strip()
+        ta  = analyse_text(raw)
+        if ta['lang']:
+            s['lang'] = lang = ta['lang']
+
+    ctx = {'phone': phone, 'lang': lang, 'first_name': first_name,
+           'status': status, 's': s, 'cat': _catalog}
+    note(lang=lang, status=status)
 
     # ── TEXT ──────────────────────────────────────────────────
     if mtype == 'text':
         text = msg.get('text', {}).get('body', '').strip()
+        ctx['text'] = text
 
         if status == 'new':
             flow_new_customer(phone, lang); return
@@ -984,11 +2993,11 @@ def handle(phone: str, msg: dict):
 
         # Custom order description step
         if s.get('custom_step') == 'awaiting_description':
-            if is_design_desc(text):
+            if ta['design']:
                 s['custom_step'] = None
                 flow_custom_done(phone, first_name, phone, text, status == 'b2b', lang)
             else:
-                aru = ask_aru(text, lang, first_name,
+                aru = afford('aru', ARU_MIN_S) and ask_aru(text, lang, first_name,
                     "Customer needs to describe custom jewelry order. "
                     "They seem confused. Gently ask: jewelry type, material, occasion, design.")
                 tx(phone, aru if aru else _hi(
@@ -999,7 +3008,14 @@ def handle(phone: str, msg: dict):
             return
 
         # Order reference
-        if re.match(r'AJS-[A-Z0-9]+-\d+', text.upper()):
+        m = re.match(r'AJS-[A-Z0-9]+-\d+', text.upper())
+        if m:
+            order = find_order(m.group(0))
+            if order and order['phone'] == (wa_key(phone) or phone):
+                count('orders', 'lookup_hit')
+                flow_order_status(phone, order, lang)
+                return
+            count('orders', 'lookup_miss')
             tx(phone, _hi(
                 f"To track order {text.upper()}, please contact our team and they will update you shortly.",
                 f"Order {text.upper()} track karne ke liye hamari team se contact karein.",
@@ -1007,64 +3023,15 @@ def handle(phone: str, msg: dict):
             ))
             return
 
-        kw = detect_kw(text)
-
-        # "Hi" / "menu" mid-session — show menu only, no full welcome restart
-        if kw == 'greet':
-            text_lower = text.lower().strip()
-            if text_lower in ('menu', 'main menu'):
-                # "menu" always shows the top-level welcome list
-                s['welcomed'] = True
-                flow_welcome(phone, first_name, lang)
-            elif s.get('welcomed'):
-                # "hi" mid-session → catalogs only
-                flow_catalogs(phone, lang)
-            else:
-                s['welcomed'] = True
-                flow_welcome(phone, first_name, lang)
-            return
-
-        if kw == 'tracking':
-            tx(phone, _hi(
-                f"Please share your Order Reference (AJS-XXXX-XXXXXXXXXX), {first_name}.",
-                f"Order Reference share karein (AJS-XXXX-XXXXXXXXXX), {first_name}.",
-                lang
-            ))
-            return
-
-        if kw == 'referral':
-            code = referral_code(first_name, phone)
-            url  = f"https://{SHOPIFY_STORE}/pages/join-us?ref={code}"
-            cta(phone,
-                _hi(
-                    f"Your Referral Code: {code}\n\nShare with friends and family to invite them.",
-                    f"Aapka Referral Code: {code}\n\nDoston aur family ke saath share karein.",
-                    lang
-                ),
-                'SHARE REFERRAL', url)
-            return
-
-        if kw == 'custom':
-            flow_custom_start(phone, first_name, phone, status == 'b2b', lang); return
-
-        if kw == 'hours':
-            tx(phone, _hi(
-                f"A Jewel Studio\nMon–Sat: 10:00 AM – 7:00 PM\nSunday: By Appointment Only",
-                f"A Jewel Studio\nSomvar–Shanivar: Subah 10 – Shaam 7\nItwar: Sirf Appointment par",
-                lang
-            ))
-            return
-
-        if kw == 'about':
-            tx(phone, _hi(
-                "A Jewel Studio is a premium jewelry brand offering handcrafted pieces for every occasion.",
-                "A Jewel Studio ek premium jewelry brand hai — har occasion ke liye exclusive handcrafted pieces.",
-                lang
-            ))
+        kw = ta['intent']
+        note(intent=kw)
+        if kw:
+            run_route(f"kw:{kw}", _INTENTS[kw], ctx)
             return
 
         # Fuzzy search
         result = fuzzy_search(text)
+        note(fuzzy_score=result.get('score'))
         if result['found']:
             tx(phone, _hi(
                 "Found a matching collection.",
@@ -1075,9 +3042,9 @@ def handle(phone: str, msg: dict):
             flow_open_collection(phone, result['id'], result['name'], lang)
             return
 
-        # Aru handles everything else
-        aru = ask_aru(text, lang, first_name,
-                      f"Status: {status}. Topics: products, availability, recommendations.")
+        # Aru handles everything else — or, short on time, the static menu below
+        aru = afford('aru', ARU_MIN_S) and ask_aru(
+            text, lang, first_name, f"Status: {status}. Topics: products, availability, recommendations.")
         if aru:
             result2 = fuzzy_search(aru)
             if result2['found']:
@@ -1099,79 +3066,22 @@ def handle(phone: str, msg: dict):
         itype = msg['interactive'].get('type')
         s['welcomed'] = True  # any interaction = welcome done
 
-        if itype == 'button_reply':
-            bid = msg['interactive']['button_reply']['id']
-            log.info(f"Button: {bid}")
-
-            if bid == 'W_FACE':      flow_face_menu(phone, lang)
-            elif bid == 'W_HAND':    flow_hand_menu(phone, lang)
-            elif bid == 'W_NECK':    flow_neck_menu(phone, lang)
-            elif bid == 'W_LOWER':   flow_lower(phone, lang)
-            elif bid == 'F_EARRINGS':flow_face_earrings(phone, lang)
-            elif bid == 'F_NOSE':    flow_face_nose(phone, lang)
-            elif bid == 'F_HEAD':    flow_face_head(phone, lang)
-            elif bid == 'F_HAIR':    flow_face_hair(phone, lang)
-            elif bid == 'H_BANGLES': flow_hand_bangles(phone, lang)
-            elif bid == 'H_BRACELETS':flow_hand_bracelets(phone, lang)
-            elif bid == 'H_ARMLETS': flow_hand_armlets(phone, lang)
-            elif bid == 'H_RINGS':   flow_hand_rings(phone, lang)
-            elif bid == 'S_WATCHES': flow_watches(phone, lang)
-            elif bid == 'S_ACCSS':   flow_studio_acc(phone, lang)
-            elif bid == 'ACT_CUSTOM':
-                flow_custom_start(phone, first_name, phone, status == 'b2b', lang)
-
-        elif itype == 'list_reply':
-            lid = msg['interactive']['list_reply']['id']
-            log.info(f"List: {lid}")
-
-            if lid == 'ACT_CATALOGS':
-                flow_catalogs(phone, lang)
-            elif lid == 'ACT_CUSTOM':
-                flow_custom_start(phone, first_name, phone, status == 'b2b', lang)
-            elif lid == 'ACT_ORDERS':
-                tx(phone, _hi(
-                    f"Please share your Order Reference Number, {first_name} (format: AJS-XXXX-XXXXXXXXXX).",
-                    f"Order Reference Number share karein, {first_name} (format: AJS-XXXX-XXXXXXXXXX).",
-                    lang
-                ))
-            elif lid == 'CAT_BABY':   flow_baby(phone, lang)
-            elif lid == 'CAT_WOMEN':  flow_women_body(phone, lang)
-            elif lid == 'CAT_MEN':    flow_men_menu(phone, lang)
-            elif lid == 'CAT_STUDIO': flow_studio_menu(phone, lang)
-            elif lid == 'CAT_SACRED': flow_empty_catalog(phone, lang)
-            elif lid == 'M_RINGS':       flow_men_rings(phone, lang)
-            elif lid == 'M_BRACELETS':   flow_men_bracelets(phone, lang)
-            elif lid == 'M_CHAINS':      flow_men_chains(phone, lang)
-            elif lid == 'M_ACCESSORIES': flow_men_accessories(phone, lang)
-            elif lid.startswith('C_'):
-                cid   = lid[2:]
-                cname = ID_TO_NAME.get(cid, 'Collection')
-                flow_open_collection(phone, cid, cname, lang)
+        if itype in ('button_reply', 'list_reply'):
+            rid = msg['interactive'][itype]['id']
+            log.info(f"{'Button' if itype == 'button_reply' else 'List'}: {rid}")
+            dispatch_id(rid, ctx)
         return
 
     # ── IMAGE ─────────────────────────────────────────────────
     if mtype == 'image':
         image_id = msg.get('image', {}).get('id')
-        tx(phone, _hi(
-            "Analyzing the design, please wait.",
-            "Design analyze ho raha hai, please wait.",
-            lang
-        ))
-        _p(1)
-
-        image_url = None
-        if image_id:
-            url_r = requests.get(
-                f"https://graph.facebook.com/v19.0/{image_id}",
-                headers={'Authorization': f'Bearer {WA_TOKEN}'}, timeout=10
-            )
-            if url_r.ok:
-                image_url = url_r.json().get('url', '')
 
         # If in custom order step — treat as design reference image
         if s.get('custom_step') == 'awaiting_description':
             s['custom_step'] = None
-            ref = f"AJS-{phone[-4:]}-{int(datetime.now().timestamp())}"
+            ref = order_ref(phone)
+            record_order(ref, phone, first_name, 'custom', status='received')
+            custom_image(image_id, ref, first_name, phone, status == 'b2b')
             tx(phone, _hi(
                 f"Thank you for sharing your design reference.\n\n"
                 f"Your Custom Order Reference: {ref}\n\n"
@@ -1181,22 +3091,19 @@ def handle(phone: str, msg: dict):
                 f"Hamari design team aapki image review karke 24 ghante mein contact karegi.",
                 lang
             ))
-            admin_email(
-                subject=f"Custom Order (Image) — {first_name} — {phone}",
-                body=(
-                    f"Custom order with image reference received.\n\n"
-                    f"Customer : {first_name}\n"
-                    f"Phone    : {phone}\n"
-                    f"Ref      : {ref}\n"
-                    f"Type     : {'B2B' if status == 'b2b' else 'Retail'}\n\n"
-                    f"Customer uploaded a reference image.\n"
-                    f"Image URL: {image_url or 'See WhatsApp chat'}"
-                )
-            )
             return
 
+        tx(phone, _hi(
+            "Analyzing the design, please wait.",
+            "Design analyze ho raha hai, please wait.",
+            lang
+        ))
+        _p(1)
+
+        image_url = media_url(image_id) if image_id else None
+
         # Otherwise — try to find matching collection via Vision AI
-        if image_url:
+        if image_url and afford('vision', ARU_MIN_S):
             vision = aru_vision(image_url)
             if vision:
                 result = fuzzy_search(vision['query'])
@@ -1228,6 +3135,744 @@ def handle(phone: str, msg: dict):
         flow_order_placed(phone, phone, first_name, items, lang)
         return
 
+def handle_traced(phone: str, msg: dict, cdata: dict = None, s: dict = None):
+    if _tls.degraded is None:
+        budget_begin()
+    tr, err = trace_begin(msg), None
+    try:
+        _call('handle', tr['type'], handle, (phone, msg, cdata, s))
+    except Exception as e:
+        err = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        trace_end(tr, phone, err)
+        budget_end()
+
+# ─────────────────────────────────────────────────────────────
+# DELIVERY DISPATCH
+# One webhook POST may batch several entries/changes, each with
+# several messages, possibly for several tenants. Messages are
+# grouped per (tenant, canonical phone): a phone's messages run
+# in order, different phones run in parallel, and the profile
+# lookup + session load happen once per phone per delivery.
+# ─────────────────────────────────────────────────────────────
+
+_pool = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix='phone')
+
+def delivery_messages(data: dict) -> list:
+    """[(tenant, message)] — the tenant comes from each change's metadata.phone_number_id."""
+    out = []
+    for entry in data.get('entry') or []:
+        for change in entry.get('changes') or []:
+            value = change.get('value') or {}
+            msgs  = value.get('messages')
+            if not msgs:
+                continue
+            pid = (value.get('metadata') or {}).get('phone_number_id', '')
+            t   = tenant_for(pid)
+            if t is None:
+                log.warning(f"Unknown phone_number_id {pid} — {len(msgs)} message(s) dropped")
+                count('routes', 'unknown_tenant', len(msgs))
+                continue
+            out += [(t, m) for m in msgs]
+    return out
+
+def group_by_phone(msgs: list) -> dict:
+    groups: dict = {}
+    for t, m in msgs:
+        phone  = m.get('from')
+        msg_id = m.get('id', '')
+        if not phone or not msg_id:
+            continue
+        if _already_seen(msg_id):
+            log.info(f"Duplicate skipped: {msg_id}")
+            continue
+        groups.setdefault((t, wa_key(phone) or phone), []).append(m)
+    return groups
+
+def handle_phone(t: Tenant, phone: str, msgs: list):
+    _tls.tenant = t
+    budget_begin()
+    try:
+        cdata = customer_status(phone)
+        s     = get_session(phone)
+        with s['lock']:
+            for m in msgs:
+                try:
+                    handle_traced(phone, m, cdata, s)
+                except Exception as e:
+                    log.error(f"Handle {m.get('id', '')}: {e}")
+    except Exception as e:
+        log.error(f"Handle phone …{phone[-4:]}: {e}")
+    finally:
+        budget_end()
+        _tls.tenant = None
+
+def dispatch(groups: dict):
+    if len(groups) == 1:
+        (t, _), msgs = next(iter(groups.items()))
+        handle_phone(t, msgs[0]['from'], msgs)
+        return
+    for f in [_pool.submit(handle_phone, t, msgs[0]['from'], msgs) for (t, _), msgs in groups.items()]:
+        f.result()
+
+# ─────────────────────────────────────────────────────────────
+# DELIVERY STATUS
+# Meta's sent/delivered/read/failed callbacks are folded into a
+# bounded per-message table keyed by wamid. Sends that fail with a
+# retryable error are re-posted with backoff by a retry thread.
+# ─────────────────────────────────────────────────────────────
+
+STATUS_TRACK_MAX = int(os.getenv('STATUS_TRACK_MAX', '20000'))
+RETRY_MAX        = int(os.getenv('RETRY_MAX', '3'))
+RETRY_BASE_S     = float(os.getenv('RETRY_BASE_SECONDS', '5'))
+
+# Meta error codes worth retrying: rate limits, generic/temporary failures
+_RETRYABLE = {4, 80007, 130429, 131000, 131016, 131048, 131056}
+
+_delivery: OrderedDict = OrderedDict()   # wamid → {to, payload, tenant, attempt, sent, delivered, read, failed, status}
+_dlock      = threading.Lock()
+_retry_q: list = []                      # heap of (due, seq, payload, attempt, tenant id)
+_retry_cv   = threading.Condition(_dlock)
+_retry_seq  = 0
+_retry_thread = None
+
+def _remember_sent(resp: dict, payload: dict, attempt: int = 0):
+    try:
+        wamid = resp['messages'][0]['id']
+    except (KeyError, IndexError, TypeError):
+        return
+    with _dlock:
+        _delivery[wamid] = {'to': payload.get('to'), 'payload': payload,
+                            'tenant': tenant().id, 'attempt': attempt, 'status': 'accepted',
+                            'sent': None, 'delivered': None, 'read': None, 'failed': None}
+        if len(_delivery) > STATUS_TRACK_MAX:
+            _delivery.popitem(last=False)
+
+def delivery_statuses(data: dict) -> list:
+    return [
+        st
+        for entry  in data.get('entry') or []
+        for change in entry.get('changes') or []
+        for st     in (change.get('value') or {}).get('statuses') or []
+    ]
+
+def record_statuses(statuses: list):
+    retry, gave_up, counts = [], 0, {}
+    with _dlock:
+        for st in statuses:
+            status = st.get('status', '')
+            counts[status] = counts.get(status, 0) + 1
+            d = _delivery.get(st.get('id', ''))
+            if d is None:
+                continue
+            try:
+                ts = float(st.get('timestamp') or time.time())
+            except ValueError:
+                ts = time.time()
+            if status not in ('sent', 'delivered', 'read', 'failed') or d[status] is not None:
+                continue                # redelivered callback: already counted (and retried) once
+            d[status]   = ts
+            d['status'] = status
+            if status == 'delivered' and d['sent'] is not None:
+                observe('delivery', 'delivered', max(0.0, ts - d['sent']))
+            elif status == 'read' and d['sent'] is not None:
+                observe('delivery', 'read', max(0.0, ts - d['sent']))
+            elif status == 'failed':
+                codes = {e.get('code') for e in st.get('errors') or []}
+                if not codes & _RETRYABLE:
+                    continue
+                if d['attempt'] < RETRY_MAX:
+                    retry.append((d['payload'], d['attempt'] + 1, d['tenant']))
+                else:
+                    gave_up += 1
+    for status, n in counts.items():
+        count('statuses', status, n)
+    if gave_up:
+        count('retries', 'gave_up', gave_up)
+    for payload, attempt, tid in retry:
+        _enqueue_retry(payload, attempt, tid)
+
+def _enqueue_retry(payload: dict, attempt: int, tid: str = ''):
+    global _retry_seq, _retry_thread
+    due = time.time() + RETRY_BASE_S * 2 ** (attempt - 1)
+    with _retry_cv:
+        _retry_seq += 1
+        heapq.heappush(_retry_q, (due, _retry_seq, payload, attempt, tid))
+        if _retry_thread is None:
+            _retry_thread = threading.Thread(target=_retry_worker, name='wa-retry', daemon=True)
+            _retry_thread.start()
+        _retry_cv.notify()
+    count('retries', 'queued')
+
+def _retry_worker():
+    while True:
+        with _retry_cv:
+            while not _retry_q or _retry_q[0][0] > time.time():
+                _retry_cv.wait(timeout=(_retry_q[0][0] - time.time()) if _retry_q else None)
+            _, _, payload, attempt, tid = heapq.heappop(_retry_q)
+        _tls.tenant = _tenants.get(tid)
+        ok = _post(payload, attempt)
+        count('retries', 'sent' if ok else 'send_failed')
+
+def delivery_stats() -> dict:
+    with _dlock:
+        states  = [d['status'] for d in _delivery.values()]
+        pending = len(_retry_q)
+    with _mlock:
+        c = {label: n for (k, label), n in _counts.items() if k == 'statuses'}
+        gave_up = _counts.get(('retries', 'gave_up'), 0)
+    done = c.get('failed', 0) + c.get('delivered', 0)
+    return {
+        'tracked':      len(states),
+        'in_flight':    sum(1 for x in states if x in ('accepted', 'sent')),
+        'statuses':     c,
+        'failure_rate': round(c.get('failed', 0) / done, 4) if done else 0.0,
+        'retry_queue':  pending,
+        'gave_up':      gave_up,
+    }
+
+def _delivery_gauges() -> dict:
+    d = delivery_stats()
+    return {'bot_delivery_tracked':      d['tracked'],
+            'bot_delivery_in_flight':    d['in_flight'],
+            'bot_delivery_failure_rate': d['failure_rate'],
+            'bot_retry_queue':           d['retry_queue']}
+
+_gauges.append(_delivery_gauges)
+
+# ─────────────────────────────────────────────────────────────
+# CLUSTER
+# Sessions, dedup, caches and the order ledger live in the process,
+# so with several nodes each phone number must always land on the
+# same one. CLUSTER_SELF_URL turns clustering on: nodes sit on a
+# consistent-hash ring (CLUSTER_VNODES points each) and a phone
+# belongs to the first node clockwise from its hash. A webhook POST
+# is split by owner; other nodes' parts are forwarded to their
+# /webhook over a keep-alive connection, accepted with a 202 and
+# handled there — never forwarded again. If the owner can't be
+# reached, or refuses the part (503 under load), it is handled here
+# rather than lost. An owner that was reached but didn't answer within
+# CLUSTER_FORWARD_SECONDS may already have accepted it, so that part
+# is left to the owner: handling it here too would reply twice. Only a
+# failed connection takes a peer off the ring; heartbeats judge slow
+# ones.
+# Membership: each node heartbeats every node it knows of
+# (CLUSTER_NODES seeds the list, peers share theirs on
+# /cluster/members). A peer stays on the ring while it answers
+# within CLUSTER_DEAD_SECONDS; a stopping node says goodbye. When the
+# ring changes, sessions this node no longer owns are handed to their
+# new owner. One worker process per node, with threads (a node
+# forwards while its peers forward to it).
+# ─────────────────────────────────────────────────────────────
+
+def _ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+class HashRing:
+    def __init__(self, nodes, vnodes: int = None):
+        self.nodes = frozenset(nodes)
+        points = sorted((_ring_hash(f"{n}#{i}"), n)
+                        for n in self.nodes for i in range(vnodes or CLUSTER_VNODES))
+        self._hashes = [h for h, _ in points]
+        self._owners = [n for _, n in points]
+
+    def owner(self, key: str) -> str | None:
+        if not self._hashes:
+            return None
+        return self._owners[bisect_left(self._hashes, _ring_hash(key)) % len(self._hashes)]
+
+_peers: dict = {}       # url → {'ok': monotonic of the last answered heartbeat (0 = never), 'seen': first heard of}
+_left: dict  = {}       # url → monotonic it said goodbye; ignored in gossip for a while
+_ring        = HashRing([CLUSTER_SELF]) if CLUSTER_SELF else None
+_clock       = threading.Lock()
+_cluster_http = requests.Session()
+_cluster_http.mount('http://',  requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL))
+_cluster_http.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL))
+_cluster_pool = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix='cluster')     # outgoing
+_inbox_pool   = ThreadPoolExecutor(max_workers=HTTP_POOL, thread_name_prefix='forwarded')         # accepted parts, as many as request threads
+
+def owner_of(phone: str) -> str | None:
+    """The node that owns this phone's conversation; None when not clustered."""
+    ring = _ring
+    return ring.owner(wa_key(phone) or phone) if ring else None
+
+def cluster_signed() -> bool:
+    sig = hmac.new(CLUSTER_SECRET.encode(), request.get_data(), hashlib.sha256).hexdigest()
+    return bool(CLUSTER_SECRET) and hmac.compare_digest(sig, request.headers.get('X-Cluster-Signature', ''))
+
+def _cluster_post(node: str, path: str, raw: bytes, timeout: float, headers: dict = None):
+    sig = hmac.new(CLUSTER_SECRET.encode(), raw, hashlib.sha256).hexdigest()
+    return _cluster_http.post(f"{node}{path}", data=raw, timeout=timeout, headers={
+        'Content-Type': 'application/json', 'X-Cluster-Node': CLUSTER_SELF,
+        'X-Cluster-Signature': sig, **(headers or {})})
+
+def forward(node: str, path: str, raw: bytes, headers: dict = None) -> bool:
+    """False only when the owner certainly didn't take the part."""
+    try:
+        ok = _cluster_post(node, path, raw, CLUSTER_FORWARD_S, headers).ok
+    except requests.exceptions.ConnectionError as e:      # includes connect timeouts: never reached
+        log.warning(f"Forward to {node}: {e}")
+        _peer_down(node)
+        ok = False
+    except requests.exceptions.Timeout as e:              # reached, answer late: it may be handling it
+        log.warning(f"Forward to {node}: {e} — left to the owner")
+        count('cluster', 'forward_timeout')
+        return True
+    except Exception as e:
+        log.warning(f"Forward to {node}: {e}")
+        ok = False
+    count('cluster', 'forwarded' if ok else 'fallback')
+    return ok
+
+def split_delivery(data: dict) -> dict:
+    """{node: webhook body holding only the messages and statuses of the phones it owns}"""
+    parts = {}
+    for entry in data.get('entry') or []:
+        for change in entry.get('changes') or []:
+            value = change.get('value') or {}
+            by    = {}
+            for key, who in (('messages', 'from'), ('statuses', 'recipient_id')):
+                for item in value.get(key) or []:
+                    by.setdefault(owner_of(item.get(who) or ''), {}).setdefault(key, []).append(item)
+            for node, items in (by or {CLUSTER_SELF: {}}).items():
+                v = {k: x for k, x in value.items() if k not in ('messages', 'statuses', 'contacts')}
+                v.update(items)
+                if value.get('contacts'):
+                    v['contacts'] = [c for c in value['contacts'] if owner_of(c.get('wa_id', '')) == node]
+                parts.setdefault(node, {'object': data.get('object'), 'entry': []})['entry'].append(
+                    {'id': entry.get('id'), 'changes': [{'field': change.get('field'), 'value': v}]})
+    return parts
+
+def cluster_route(data: dict) -> tuple:
+    """(this node's part of a delivery, pending forwards of the rest)."""
+    ring = _ring
+    if ring is None or len(ring.nodes) == 1:
+        return data, ()
+    parts = split_delivery(data)
+    local = parts.pop(CLUSTER_SELF, None)
+    return local, [(part, _cluster_pool.submit(forward, node, '/webhook', json.dumps(part).encode()))
+                   for node, part in parts.items()]
+
+def cluster_fallback(pending) -> list:
+    """Parts whose owner didn't accept them — handled here instead."""
+    return [part for part, f in pending if not f.result()]
+
+def _handle_forwarded(data: dict, arrived: float):
+    queued(time.time() - arrived)                  # the inbox pool is this part's queue
+    try:
+        process_delivery(data)
+    except Exception as e:
+        log.error(f"Forwarded delivery: {e}")
+    finally:
+        inflight(-1)
+
+def accept_forwarded(data: dict, arrived: float):
+    """Queue a part forwarded by a peer; it counts as in flight until handled."""
+    count('cluster', 'received')
+    inflight(1)
+    _inbox_pool.submit(_handle_forwarded, data, arrived)
+
+# ── MEMBERSHIP ────────────────────────────────────────────────
+def members() -> list:
+    now = time.monotonic()
+    with _clock:
+        return [CLUSTER_SELF] + sorted(u for u, p in _peers.items() if now - p['ok'] < CLUSTER_DEAD_S)
+
+def _learn(urls):
+    now = time.monotonic()
+    with _clock:
+        for u in urls:
+            u = (u or '').rstrip('/')
+            if u and u != CLUSTER_SELF and u not in _peers and now - _left.get(u, -1e9) > 2 * CLUSTER_DEAD_S:
+                _peers[u] = {'ok': 0.0, 'seen': now}
+
+def _peer_up(node: str):
+    with _clock:
+        _peers.setdefault(node, {'seen': time.monotonic()})['ok'] = time.monotonic()
+        _left.pop(node, None)
+    _rebalance()
+
+def _peer_down(node: str):
+    with _clock:
+        if node in _peers:
+            _peers[node]['ok'] = 0.0
+    _rebalance()
+
+def _rebalance():
+    global _ring
+    nodes = frozenset(members())
+    with _clock:
+        if _ring is None or nodes == _ring.nodes:
+            return
+        old, _ring = _ring.nodes, HashRing(nodes)
+    log.info(f"Cluster ring: {len(nodes)} node(s)"
+             f"{''.join(f' +{n}' for n in nodes - old)}{''.join(f' -{n}' for n in old - nodes)}")
+    count('cluster', 'ring_change')
+    _cluster_pool.submit(handoff_sessions)
+
+def _session_out(s: dict) -> dict:
+    return {k: v.isoformat() if isinstance(v, datetime) else v for k, v in s.items() if k != 'lock'}
+
+def _session_in(s: dict) -> dict:
+    for k in ('created', 'last'):
+        s[k] = datetime.fromisoformat(s[k]) if s.get(k) else datetime.now()
+    s['lock'] = threading.Lock()
+    return s
+
+def handoff_sessions():
+    """Send every session whose phone now belongs to another node to that node."""
+    moving = {}
+    for t in list(_tenants.values()):
+        for phone, s in list(t.sessions.items()):
+            node = owner_of(phone)
+            if node and node != CLUSTER_SELF:
+                moving.setdefault(node, {}).setdefault(t.id, {})[phone] = s
+    for node, by_tenant in moving.items():
+        raw = json.dumps({tid: {p: _session_out(s) for p, s in ss.items()} for tid, ss in by_tenant.items()},
+                         default=str).encode()
+        try:
+            ok = _cluster_post(node, '/cluster/sessions', raw, 10).ok
+        except Exception as e:
+            log.warning(f"Session handoff to {node}: {e}")
+            ok = False
+        if ok:
+            for tid, ss in by_tenant.items():
+                for p in ss:
+                    _tenants[tid].sessions.pop(p, None)
+            count('cluster', 'sessions_out', sum(map(len, by_tenant.values())))
+
+def take_sessions(data: dict) -> int:
+    n = 0
+    for tid, ss in data.items():
+        t = _tenants.get(tid)
+        if t is None:
+            continue
+        for phone, s in ss.items():
+            s   = _session_in(s)
+            cur = t.sessions.get(phone)
+            if cur is None or cur['last'] < s['last']:
+                t.sessions[phone] = s
+                n += 1
+    count('cluster', 'sessions_in', n)
+    return n
+
+def _heartbeat():
+    while True:
+        with _clock:
+            peers = list(_peers)
+        raw = json.dumps({'node': CLUSTER_SELF, 'members': members()}).encode()
+        for node in peers:
+            try:
+                r = _cluster_post(node, '/cluster/members', raw, CLUSTER_BEAT_S)
+                if r.ok:
+                    _learn(r.json().get('members', []))
+                    _peer_up(node)
+                    continue
+            except Exception:
+                pass
+            with _clock:
+                p = _peers.get(node)
+                if p and node not in CLUSTER_NODES and time.monotonic() - max(p['ok'], p['seen']) > 10 * CLUSTER_DEAD_S:
+                    del _peers[node]            # gone for good; seeds are kept and retried
+        _rebalance()
+        time.sleep(CLUSTER_BEAT_S)
+
+def leave_cluster():
+    """On shutdown: hand every session to the nodes that take over, then say goodbye."""
+    global _ring
+    rest = members()[1:]
+    if not rest:
+        return
+    _ring = HashRing(rest)
+    handoff_sessions()
+    raw = json.dumps({'node': CLUSTER_SELF}).encode()
+    for node in rest:
+        try:
+            _cluster_post(node, '/cluster/leave', raw, 1)
+        except Exception:
+            pass
+
+def cluster_stats() -> dict | None:
+    if _ring is None:
+        return None
+    now = time.monotonic()
+    with _clock:
+        peers = {u: round(now - p['ok'], 1) if p['ok'] else None for u, p in _peers.items()}
+    return {'self': CLUSTER_SELF, 'nodes': sorted(_ring.nodes), 'heartbeat_age': peers}
+
+def _cluster_gauges() -> dict:
+    return {'bot_cluster_nodes': len(_ring.nodes) if _ring else 1}
+
+_gauges.append(_cluster_gauges)
+
+if CLUSTER_SELF and not CLUSTER_SECRET:
+    log.error("CLUSTER_SELF_URL is set without CLUSTER_SECRET — running as a single node")
+    _ring = None
+elif CLUSTER_SELF:
+    _learn(CLUSTER_NODES)
+    threading.Thread(target=_heartbeat, name='cluster', daemon=True).start()
+    atexit.register(leave_cluster)
+
+# ─────────────────────────────────────────────────────────────
+# ADMISSION CONTROL
+# Two load signals. One is webhooks in flight in this process. The
+# other is the standing queue delay: the smallest wait seen over each
+# ADMIT_WINDOW_SECONDS between a request arriving and webhook()
+# starting on it — once per request; for a part forwarded by a peer,
+# until the inbox pool starts on it. Waits inside a delivery (the
+# per-phone pool, a phone's lock) aren't load. Arrival is the proxy's
+# X-Request-Start when there is one, else when webhook() began. A
+# burst that drains within a window never counts; a queue that
+# doesn't drain does.
+# Level 1 (ADMIT_SOFT_INFLIGHT, or ADMIT_QUEUE_SECONDS of delay) sheds
+# optional work — Aru free-text answers, vision, reply pacing — and
+# customers get the static menus instead. Level 2 (ADMIT_MAX_INFLIGHT,
+# or twice the delay) keeps only orders, AJS- references, order and
+# custom-order steps, and answers 503 with Retry-After for the rest of
+# the delivery. Those messages were never marked seen, so Meta's
+# redelivery brings them back after the spike. A part forwarded by a
+# peer goes through the same check and counts as in flight until
+# handled; if any of it would be refused the whole part gets the 503
+# and the sender handles it (cluster_fallback). Payment webhooks
+# (/razorpay/webhook) are never shed.
+# ─────────────────────────────────────────────────────────────
+
+_SHED_STEPS   = ('aru', 'vision', 'pacing')
+_CRITICAL_IDS = {'ACT_ORDERS', 'ACT_CUSTOM'}
+_CRITICAL_KW  = {'tracking', 'custom'}
+_admit_lock   = threading.Lock()
+_inflight     = 0
+_qwin         = [0.0, 0.0, 0.0]     # window start (monotonic), smallest wait in it, in the window before
+
+def request_start() -> float:
+    """Epoch seconds the request reached the front door."""
+    now = time.time()
+    try:
+        ts = float(request.headers.get('X-Request-Start', '').removeprefix('t='))
+    except ValueError:
+        return now
+    while ts > 1e11:                    # milliseconds or microseconds
+        ts /= 1000
+    return ts if 0 <= now - ts < 60 else now
+
+def queued(seconds: float):
+    """Record how long a request waited before webhook() started on it."""
+    now = time.monotonic()
+    with _admit_lock:
+        if now - _qwin[0] < ADMIT_WINDOW_S:
+            _qwin[1] = min(_qwin[1], seconds)
+            return
+        _qwin[2] = _qwin[1] if now - _qwin[0] < 2 * ADMIT_WINDOW_S else 0.0    # idle in between: no queue
+        _qwin[0], _qwin[1] = now, seconds
+
+def queue_delay() -> float:
+    with _admit_lock:
+        return _qwin[2] if time.monotonic() - _qwin[0] < 2 * ADMIT_WINDOW_S else 0.0
+
+def load_level() -> int:
+    """0 normal, 1 optional work shed, 2 only critical messages admitted."""
+    if ADMIT_MAX <= 0:
+        return 0
+    q = queue_delay()
+    if _inflight >= ADMIT_MAX or q >= 2 * ADMIT_QUEUE_S:
+        return 2
+    if _inflight >= ADMIT_SOFT or q >= ADMIT_QUEUE_S:
+        return 1
+    return 0
+
+def shed(step: str) -> bool:
+    """True if optional `step` is to be skipped for load — see afford()."""
+    if step not in _SHED_STEPS or load_level() < 1:
+        return False
+    count('shed', step)
+    d = _tls.degraded
+    if d is not None and step not in d:
+        d.append(step)
+    return True
+
+def critical(t: Tenant, m: dict) -> bool:
+    """Orders, order lookups and custom orders keep their capacity under load."""
+    mtype = m.get('type')
+    if mtype == 'order':
+        return True
+    if mtype == 'interactive':
+        it = m.get('interactive') or {}
+        return (it.get(it.get('type')) or {}).get('id') in _CRITICAL_IDS
+    phone = m.get('from', '')
+    s = t.sessions.get(wa_key(phone) or phone)
+    if s and s.get('custom_step'):
+        return True
+    if mtype == 'text':
+        text = (m.get('text') or {}).get('body', '')
+        return bool(re.search(r'AJS-[A-Z0-9]+-\d+', text.upper())) or analyse_text(text)['intent'] in _CRITICAL_KW
+    return False
+
+def admit(data: dict) -> tuple:
+    """(delivery to handle, messages refused). Status callbacks always pass."""
+    if load_level() < 2:
+        return data, 0
+    refused = 0
+    for entry in data.get('entry') or []:
+        for change in entry.get('changes') or []:
+            value = change.get('value') or {}
+            msgs  = value.get('messages')
+            if not msgs:
+                continue
+            t    = tenant_for((value.get('metadata') or {}).get('phone_number_id', ''))
+            keep = [m for m in msgs if t is None or critical(t, m)]
+            refused += len(msgs) - len(keep)
+            value['messages'] = keep
+    if refused:
+        count('shed', 'refused', refused)
+    return data, refused
+
+def inflight(n: int):
+    global _inflight
+    with _admit_lock:
+        _inflight += n
+
+@contextmanager
+def admitted():
+    inflight(1)
+    try:
+        yield
+    finally:
+        inflight(-1)
+
+def admission_stats() -> dict:
+    with _mlock:
+        c = {label: n for (k, label), n in _counts.items() if k == 'shed'}
+    return {'level': load_level(), 'inflight': _inflight,
+            'queue_ms': round(queue_delay() * 1000, 1), 'shed': c}
+
+def _admission_gauges() -> dict:
+    return {'bot_webhooks_inflight': _inflight, 'bot_queue_delay_seconds': round(queue_delay(), 4),
+            'bot_load_level': load_level()}
+
+_gauges.append(_admission_gauges)
+
+# ─────────────────────────────────────────────────────────────
+# PROFILER
+# GET /admin/profile?seconds=N samples every thread's Python stack
+# `hz` times a second for N seconds, on this worker, and returns
+# collapsed stacks (flamegraph.pl, speedscope, inferno). Nothing runs
+# between requests. Each sample is split into on-CPU and off-CPU
+# time by the thread's CPU clock from /proc (Linux schedstat), and
+# the stack is rooted at "cpu" or "wait" and then the thread pool
+# name. Wait covers network and disk I/O, sleeps, locks and waiting
+# for the GIL. Counts are microseconds. Threads with no frame in
+# this app (idle pool workers, gunicorn's loop) are left out unless
+# idle=1. One profile runs at a time.
+# ─────────────────────────────────────────────────────────────
+
+_APP_DIR      = os.path.dirname(os.path.abspath(__file__)) + os.sep
+_CLK_TCK      = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+_profile_lock = threading.Lock()
+
+def admin_authorized() -> bool:
+    auth = request.headers.get('Authorization', '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(auth.encode(), f"Bearer {ADMIN_TOKEN}".encode())
+
+class _CpuClocks:
+    """Per-thread CPU time from /proc (schedstat, else stat ticks), files kept open while sampling."""
+
+    def __init__(self):
+        self.fds: dict = {}               # native id → (fd, from schedstat) | None
+
+    def ns(self, nid: int) -> int | None:
+        src = self.fds.get(nid, False)
+        if src is False:
+            src = self.fds[nid] = self._open(nid)
+        if src is None:
+            return None
+        fd, sched = src
+        try:
+            raw = os.pread(fd, 512, 0)
+            if sched:
+                return int(raw.split()[0])
+            utime, stime = raw[raw.rindex(b')') + 2:].split()[11:13]
+            return (int(utime) + int(stime)) * 1_000_000_000 // _CLK_TCK
+        except (OSError, ValueError, IndexError):
+            return None
+
+    @staticmethod
+    def _open(nid: int):
+        for name, sched in (('schedstat', True), ('stat', False)):
+            try:
+                return os.open(f"/proc/self/task/{nid}/{name}", os.O_RDONLY), sched
+            except (OSError, AttributeError):
+                pass
+        return None
+
+    def close(self):
+        for src in self.fds.values():
+            if src:
+                os.close(src[0])
+        self.fds.clear()
+
+def sample_stacks(seconds: float, hz: int, idle: bool = False) -> tuple:
+    """(Counter 'cpu|wait;thread;frame;…' → µs, stats) for `seconds` of this process."""
+    me, period = threading.get_ident(), 1.0 / hz
+    stacks, last = Counter(), {}          # last: thread ident → (cpu ns, perf_counter ns)
+    threads, samples, unknown = {}, 0, 0  # threads: ident → (pool name, native id)
+    codes, clocks = {}, _CpuClocks()      # codes: code object → (frame label, in this app)
+    cpu0, t0 = time.thread_time(), time.perf_counter()
+    due = t0
+    try:
+        while due < t0 + seconds:
+            now_ns = time.perf_counter_ns()
+            frames = sys._current_frames()
+            if not frames.keys() <= threads.keys():      # a thread started since the last sample
+                threads = {th.ident: (re.sub(r'[-_]\d+$', '', th.name), th.native_id)
+                           for th in threading.enumerate()}
+                threads.update((i, ('thread', None)) for i in frames.keys() - threads.keys())
+            for ident, f in frames.items():
+                if ident == me:
+                    continue
+                stack, app = [], idle
+                while f is not None:
+                    c = codes.get(f.f_code)
+                    if c is None:
+                        fn = f.f_code.co_filename
+                        c  = codes[f.f_code] = (f"{f.f_code.co_name} ({os.path.basename(fn)})",
+                                                fn.startswith(_APP_DIR) and 'site-packages' not in fn)
+                    stack.append(c[0])
+                    app = app or c[1]
+                    f = f.f_back
+                if not app:
+                    continue
+                name, nid = threads[ident]
+                cpu  = clocks.ns(nid) if nid else None
+                prev = last.get(ident)
+                last[ident] = (cpu, now_ns)
+                if prev is None:
+                    continue
+                tail = f"{name};{';'.join(reversed(stack))}"
+                span = (now_ns - prev[1]) // 1000
+                if cpu is None or prev[0] is None:
+                    stacks[f"unknown;{tail}"] += span
+                    unknown += 1
+                    continue
+                on = min(span, (cpu - prev[0]) // 1000)
+                if on:
+                    stacks[f"cpu;{tail}"] += on
+                if span - on:
+                    stacks[f"wait;{tail}"] += span - on
+            del frames
+            samples += 1
+            due += period
+            time.sleep(max(0.0, due - time.perf_counter()))
+    finally:
+        clocks.close()
+    wall = time.perf_counter() - t0
+    stats = {'samples': samples, 'seconds': round(wall, 3), 'hz': hz,
+             'cpu_ms':  sum(v for k, v in stacks.items() if k.startswith('cpu;')) // 1000,
+             'wait_ms': sum(v for k, v in stacks.items() if k.startswith('wait;')) // 1000,
+             'unknown': unknown,
+             'overhead': round((time.thread_time() - cpu0) / wall, 4)}    # sampler CPU / wall time
+    return stacks, stats
+
 # ─────────────────────────────────────────────────────────────
 # WEBHOOK
 # ─────────────────────────────────────────────────────────────
@@ -1239,30 +3884,134 @@ def verify():
         return request.args.get('hub.challenge'), 200
     return 'Forbidden', 403
 
+def process_delivery(data: dict):
+    statuses = delivery_statuses(data)
+    if statuses:
+        record_statuses(statuses)
+    msgs = delivery_messages(data)
+    if not msgs:
+        return                                      # status-only fast path
+    catalog_watch()
+    groups = group_by_phone(msgs)
+    if groups:
+        _cleanup()
+        dispatch(groups)
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
+    arrived = request_start()
     try:
         data = request.get_json(silent=True)
         if not data or data.get('object') != 'whatsapp_business_account':
             return jsonify({'status': 'ok'}), 200
-        msgs = (
-            data.get('entry',   [{}])[0]
-                .get('changes', [{}])[0]
-                .get('value',   {})
-                .get('messages', [])
-        )
-        for m in msgs:
-            phone  = m.get('from')
-            msg_id = m.get('id', '')
-            if phone and msg_id:
-                if _already_seen(msg_id):
-                    log.info(f"Duplicate skipped: {msg_id}")
-                    continue
-                handle(phone, m)
+        if request.headers.get('X-Cluster-Node'):
+            if not cluster_signed():
+                return 'Bad signature', 401
+            data, refused = admit(data)
+            if refused:                         # all or nothing: the sender handles the whole part itself
+                return jsonify({'status': 'overloaded'}), 503, {'Retry-After': str(ADMIT_RETRY_S)}
+            accept_forwarded(data, arrived)
+            return jsonify({'status': 'accepted'}), 202
+        queued(time.time() - arrived)
+        data, refused = admit(data)
+        with admitted():
+            local, pending = cluster_route(data)
+            if local:
+                process_delivery(local)
+            for part in cluster_fallback(pending):
+                process_delivery(part)
+        if refused:
+            return jsonify({'status': 'overloaded'}), 503, {'Retry-After': str(ADMIT_RETRY_S)}
     except Exception as e:
         log.error(f"Webhook: {e}")
     return jsonify({'status': 'ok'}), 200
 
+@app.route('/shopify/webhook', methods=['POST'])
+def shopify_webhook():
+    t = tenant_by_shop(request.headers.get('X-Shopify-Shop-Domain', ''))
+    if t is None or not t.hook_secret:
+        return 'Unknown shop', 404
+    raw  = request.get_data()
+    sig  = base64.b64encode(hmac.new(t.hook_secret.encode(), raw, hashlib.sha256).digest()).decode()
+    if not hmac.compare_digest(sig, request.headers.get('X-Shopify-Hmac-Sha256', '')):
+        return 'Bad signature', 401
+    try:
+        topic = request.headers.get('X-Shopify-Topic', '')
+        c     = json.loads(raw)
+        idx   = customer_index(t)
+        if idx and topic in ('customers/create', 'customers/update'):
+            idx.apply(c)
+        elif idx and topic == 'customers/delete':
+            idx.remove(c.get('id'))
+    except Exception as e:
+        log.error(f"Shopify webhook: {e}")
+    return jsonify({'status': 'ok'}), 200
+
+@app.route('/razorpay/webhook', methods=['POST'])
+def razorpay_webhook():
+    if not RZP_HOOK_SECRET:
+        return 'Not configured', 404
+    raw = request.get_data()
+    sig = hmac.new(RZP_HOOK_SECRET.encode(), raw, hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(sig, request.headers.get('X-Razorpay-Signature', '')):
+        return 'Bad signature', 401
+    try:
+        ev     = json.loads(raw)
+        status = _RZP_EVENTS.get(ev.get('event'))
+        link   = ((ev.get('payload') or {}).get('payment_link') or {}).get('entity') or {}
+        notes  = link.get('notes') or {}
+        node   = owner_of((link.get('customer') or {}).get('contact', ''))
+        if node and node != CLUSTER_SELF and not request.headers.get('X-Cluster-Node') \
+                and forward(node, '/razorpay/webhook', raw, {'X-Razorpay-Signature': sig}):
+            return jsonify({'status': 'ok'}), 200   # the ledger with this order is on its phone's node
+        if status and notes.get('order_ref'):
+            set_order_status(notes.get('tenant') or _default.id, notes['order_ref'], status)
+            count('orders', f"payment_{status}")
+    except Exception as e:
+        log.error(f"Razorpay webhook: {e}")
+    return jsonify({'status': 'ok'}), 200
+
+@app.route('/cluster/members', methods=['GET', 'POST'])
+def cluster_members():
+    if _ring is None:
+        return 'Not clustered', 404
+    if request.method == 'POST':
+        if not cluster_signed():
+            return 'Bad signature', 401
+        body = request.get_json(silent=True) or {}
+        _learn(body.get('members', []) + [body.get('node')])
+        if body.get('node'):
+            _peer_up(body['node'].rstrip('/'))
+    return jsonify({'node': CLUSTER_SELF, 'members': members()}), 200
+
+@app.route('/cluster/leave', methods=['POST'])
+def cluster_leave():
+    if _ring is None or not cluster_signed():
+        return 'Forbidden', 403
+    node = ((request.get_json(silent=True) or {}).get('node') or '').rstrip('/')
+    with _clock:
+        _peers.pop(node, None)
+        _left[node] = time.monotonic()
+    _rebalance()
+    return jsonify({'status': 'ok'}), 200
+
+@app.route('/cluster/sessions', methods=['POST'])
+def cluster_sessions():
+    if _ring is None or not cluster_signed():
+        return 'Forbidden', 403
+    return jsonify({'taken': take_sessions(request.get_json(silent=True) or {})}), 200
+
+@app.route('/media/<name>', methods=['GET'])
+def media_file(name):
+    """A stored customer image or thumbnail, behind a link from the admin email."""
+    if not (MEDIA_DIR and MEDIA_SECRET and _MEDIA_NAME.fullmatch(name)) or \
+            not hmac.compare_digest(media_sig(name), request.args.get('sig', '')):
+        return jsonify({'error': 'Not found'}), 404
+    path = os.path.abspath(media_path(name))
+    if not os.path.exists(path):
+        return jsonify({'error': 'Not found'}), 404
+    return send_file(path, max_age=365 * 86400)    # content-addressed: never changes
+
 @app.route('/', methods=['GET'])
 @app.route('/health', methods=['GET'])
 def health():
@@ -1270,10 +4019,54 @@ def health():
         'status':    'healthy',
         'service':   'A Jewel Studio WhatsApp Bot',
         'assistant': 'Aru',
-        'sessions':  len(_sessions),
+        'sessions':  all_sessions(),
+        'tenants':   {t.id: {'name':      t.name,
+                             'sessions':  len(t.sessions),
+                             'customers': len(t.customers.peek().names) if t.customers.peek() else None}
+                      for t in _tenants.values()},
+        'delivery':  delivery_stats(),
+        'breakers':  breaker_stats(),
+        'prefetch':  prefetch_stats(),
+        'cluster':   cluster_stats(),
+        'admission': admission_stats(),
+        'catalog':   {'version':     _catalog['version'],
+                      'collections': len(_catalog['id_to_name']),
+                      'loaded':      _catalog['loaded']},
         'timestamp': datetime.now().isoformat(),
     }), 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+@app.route('/admin/profile', methods=['GET'])
+def admin_profile():
+    if not admin_authorized():
+        return jsonify({'error': 'Not found'}), 404
+    try:
+        seconds = min(float(request.args.get('seconds', '10')), PROFILER_MAX_S)
+        hz      = max(1, min(int(request.args.get('hz', PROFILER_HZ)), 1000))
+    except ValueError:
+        return jsonify({'error': 'seconds and hz must be numbers'}), 400
+    if not _profile_lock.acquire(blocking=False):
+        return jsonify({'error': 'A profile is already running'}), 409
+    try:
+        stacks, st = sample_stacks(seconds, hz, request.args.get('idle') == '1')
+    finally:
+        _profile_lock.release()
+    log.info(f"Profile: {st}")
+    body = ''.join(f"{k} {v}\n" for k, v in sorted(stacks.items()))
+    return body, 200, {'Content-Type': 'text/plain; charset=utf-8',
+                       'Content-Disposition': f'attachment; filename="profile-{os.getpid()}-{int(time.time())}.collapsed"',
+                       'X-Profile-Stats': json.dumps(st)}
+
+@app.after_request
+def _prewarm_after_first(r):
+    if PREWARM and not _prewarmed.is_set():
+        _prewarmed.set()
+        threading.Thread(target=prewarm, name='prewarm', daemon=True).start()
+    return r
+
 @app.after_request
 def security(r):
     r.headers.update({'X-Content-Type-Options': 'nosniff',
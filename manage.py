@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""
+A JEWEL STUDIO — Admin commands
+
+Usage:  python manage.py <command> [options]
+
+  summary      events per day and message type
+  funnel       messaged → menu → collection → order, by distinct customer
+  collections  opens and orders per collection ("which collections convert")
+  dedup-sheets rewrite Registrations phones to E.164 and merge duplicate rows
+  campaign     send a WhatsApp template to every number in a CSV or the sheet
+
+Analytics commands read the files main.py writes under ANALYTICS_DIR
+(date=YYYY-MM-DD/part-*.parquet or *.jsonl.gz) and never import main.
+Sheets and campaign commands import main for its tenant config,
+clients and senders.
+"""
+
+import os, sys, csv, json, gzip, time, argparse, threading
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+ANALYTICS_DIR = os.getenv('ANALYTICS_DIR', 'analytics')
+
+# ─────────────────────────────────────────────────────────────
+# ANALYTICS
+# ─────────────────────────────────────────────────────────────
+
+def _read_file(path: str) -> list:
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        rows = pq.read_table(path).to_pylist()
+        for r in rows:
+            r['ts'] = r['ts'].timestamp() if r['ts'] else 0.0
+        return rows
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def read_events(root: str = ANALYTICS_DIR, since: str = None, until: str = None) -> list:
+    """All events in [since, until] (YYYY-MM-DD, inclusive), oldest first."""
+    if not os.path.isdir(root):
+        return []
+    out = []
+    for part in sorted(os.listdir(root)):
+        if not part.startswith('date='):
+            continue
+        day = part[5:]
+        if (since and day < since) or (until and day > until):
+            continue
+        d = os.path.join(root, part)
+        for name in sorted(os.listdir(d)):
+            if name.endswith(('.parquet', '.jsonl.gz')):
+                out += _read_file(os.path.join(d, name))
+    out.sort(key=lambda e: e['ts'])
+    return out
+
+def _is_menu(ev: dict) -> bool:
+    r = ev.get('route') or ''
+    return bool(r) and not ev.get('collection_id') and r not in ('ACT_ORDERS', 'ACT_CUSTOM')
+
+_STEPS = [
+    ('messaged',   lambda e: True),
+    ('menu',       _is_menu),
+    ('collection', lambda e: bool(e.get('collection_id'))),
+    ('order',      lambda e: e.get('order_total') is not None),
+]
+
+def funnel(events: list) -> list:
+    """[(step, customers)] — a customer reaches a step only after the previous one."""
+    reached = defaultdict(int)     # user → steps reached so far
+    for ev in events:
+        u = ev['user']
+        i = reached[u]
+        if i < len(_STEPS) and _STEPS[i][1](ev):
+            reached[u] = i + 1
+    return [(name, sum(1 for n in reached.values() if n > i))
+            for i, (name, _) in enumerate(_STEPS)]
+
+def collections(events: list, window_h: float = 72) -> list:
+    """
+    Per collection: opens, customers, and orders — an order counts for
+    the last collection the customer opened within window_h before it.
+    """
+    opens, users, orders, revenue = Counter(), defaultdict(set), Counter(), Counter()
+    names, last = {}, {}
+    for ev in events:
+        cid = ev.get('collection_id')
+        if cid:
+            opens[cid] += 1
+            users[cid].add(ev['user'])
+            names[cid] = ev.get('collection') or cid
+            last[ev['user']] = (cid, ev['ts'])
+        elif ev.get('order_total') is not None:
+            hit = last.pop(ev['user'], None)
+            if hit and ev['ts'] - hit[1] <= window_h * 3600:
+                orders[hit[0]] += 1
+                revenue[hit[0]] += ev['order_total'] or 0
+    rows = [{'id': cid, 'name': names[cid], 'opens': opens[cid], 'customers': len(users[cid]),
+             'orders': orders[cid], 'revenue': round(revenue[cid], 2),
+             'conversion': round(orders[cid] / len(users[cid]), 4)}
+            for cid in opens]
+    return sorted(rows, key=lambda r: (-r['orders'], -r['opens']))
+
+def _window(args) -> list:
+    since = args.since
+    if args.days and not since:
+        since = (datetime.now() - timedelta(days=args.days - 1)).strftime('%Y-%m-%d')
+    return read_events(args.dir, since, args.until)
+
+def cmd_summary(args):
+    events = _window(args)
+    by_day, users = defaultdict(Counter), defaultdict(set)
+    for ev in events:
+        day = datetime.fromtimestamp(ev['ts']).strftime('%Y-%m-%d')
+        by_day[day][ev.get('type') or '?'] += 1
+        users[day].add(ev['user'])
+    types = sorted({t for c in by_day.values() for t in c})
+    print(f"{'date':<12}" + ''.join(f"{t:>14}" for t in types) + f"{'customers':>11}")
+    for day in sorted(by_day):
+        print(f"{day:<12}" + ''.join(f"{by_day[day][t]:>14}" for t in types) + f"{len(users[day]):>11}")
+    print(f"\n{len(events)} events")
+    return 0
+
+def cmd_funnel(args):
+    steps = funnel(_window(args))
+    if args.json:
+        print(json.dumps(dict(steps)))
+        return 0
+    top = steps[0][1] or 1
+    prev = top
+    for name, n in steps:
+        print(f"{name:<12}{n:>8}   {n / top:6.1%} of all   {n / (prev or 1):6.1%} of previous")
+        prev = n
+    return 0
+
+def cmd_collections(args):
+    rows = collections(_window(args), args.window)[:args.top]
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False))
+        return 0
+    print(f"{'collection':<32}{'opens':>7}{'custs':>7}{'orders':>8}{'conv':>8}{'revenue':>12}")
+    for r in rows:
+        print(f"{r['name'][:31]:<32}{r['opens']:>7}{r['customers']:>7}{r['orders']:>8}"
+              f"{r['conversion']:>8.1%}{r['revenue']:>12,.0f}")
+    return 0
+
+# ─────────────────────────────────────────────────────────────
+# SHEETS
+# ─────────────────────────────────────────────────────────────
+
+def dedup_rows(rows: list, canon) -> tuple:
+    """
+    Registrations rows with column A rewritten to canon(phone) and
+    duplicates folded into the first row for that phone: its empty
+    cells take the later rows' values. Rows without a phone (header,
+    notes) stay where they are. Returns (rows, stats).
+    """
+    out, first = [], {}
+    stats = Counter()
+    for r in rows:
+        key = canon(r[0]) if r else ''
+        if not key:
+            out.append(list(r))
+            stats['kept_no_phone'] += 1
+            continue
+        if key in first:
+            keep = out[first[key]]
+            keep.extend([''] * (len(r) - len(keep)))
+            for i, v in enumerate(r[1:], 1):
+                if v and not keep[i]:
+                    keep[i] = v
+            stats['merged'] += 1
+            continue
+        stats['rewritten'] += key != r[0]
+        first[key] = len(out)
+        out.append([key] + list(r[1:]))
+    stats['phones'] = len(first)
+    return out, stats
+
+def _col(n: int) -> str:
+    s = ''
+    while n:
+        n, r = divmod(n - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+def cmd_dedup_sheets(args):
+    import main
+    t = main.tenant_for(args.tenant) if args.tenant else main.tenant()
+    if t is None:
+        print(f"unknown tenant {args.tenant}")
+        return 1
+    gc = t.gc.get()
+    if not gc or not (args.sheet or t.sheet_id):
+        print("Sheets not configured (GOOGLE_SERVICE_ACCOUNT_KEY / GOOGLE_SHEET_ID)")
+        return 1
+    ws   = gc.open_by_key(args.sheet or t.sheet_id).worksheet(args.worksheet)
+    rows = ws.get_all_values()
+    out, stats = dedup_rows(rows, main.canon_phone)
+    print(f"{len(rows)} rows → {len(out)}: {stats['phones']} phones, {stats['merged']} duplicate rows merged, "
+          f"{stats['rewritten']} phones rewritten, {stats['kept_no_phone']} rows without a phone kept")
+    if not args.apply:
+        print("dry run — pass --apply to write")
+        return 0
+    width = max((len(r) for r in rows), default=1)
+    ws.update(f"A1:{_col(width)}{max(len(out), 1)}", [r + [''] * (width - len(r)) for r in out])
+    if len(out) < len(rows):
+        ws.batch_clear([f"A{len(out) + 1}:{_col(width)}{len(rows)}"])
+    print("written")
+    return 0
+
+# ─────────────────────────────────────────────────────────────
+# CAMPAIGNS
+# Recipients are streamed (CSV rows, or the Registrations sheet a
+# page at a time) and sent a template through a worker pool, paced
+# by --rate on top of the tenant's own send limit. Every outcome is
+# appended to the journal; a rerun of the same command skips the
+# numbers it already reached, so an interrupted or crashed campaign
+# resumes where it stopped. Numbers repeated in the source are sent
+# once.
+# ─────────────────────────────────────────────────────────────
+
+def csv_recipients(path: str):
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            yield {(k or '').strip().lower(): (v or '').strip() for k, v in row.items()}
+
+def sheet_recipients(ws, page: int = 1000):
+    """Registrations rows as {'phone', 'first_name'}, one page of rows in memory at a time."""
+    start = 1
+    while True:
+        rows = ws.get(f"A{start}:B{start + page - 1}")
+        for r in rows:
+            yield {'phone': r[0] if r else '', 'first_name': r[1] if len(r) > 1 else ''}
+        if len(rows) < page:
+            return
+        start += page
+
+def read_journal(path: str) -> set:
+    """Phones (as phone keys) the journal records as sent."""
+    sent = set()
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                phone, _, ok = line.rstrip('\n').partition('\t')
+                if ok.startswith('1') and phone[1:].isdigit():
+                    sent.add(int(phone[1:]))
+    return sent
+
+def _params(specs: list):
+    """['first_name:Customer', 'code'] → record → ['Asha', 'X1']"""
+    fields = [s.partition(':') for s in specs]
+    return lambda rec: [rec.get(k.lower()) or default for k, _, default in fields]
+
+def run_campaign(main, t, recipients, send, journal: str, workers: int = 16,
+                 rate: float = 50, every: float = 5, stop: threading.Event = None) -> Counter:
+    """send(phone, record) → bool for every new valid phone; returns the counts."""
+    done   = read_journal(journal)
+    stats  = Counter(resumed=len(done))
+    bucket = main._Bucket(rate) if rate > 0 else None
+    window = threading.BoundedSemaphore(workers * 4)      # queued + in flight
+    lock   = threading.Lock()
+    stop   = stop or threading.Event()
+    jf     = open(journal, 'a', encoding='utf-8')
+    t0     = time.monotonic()
+
+    def one(phone: str, rec: dict):
+        main._tls.tenant = t
+        try:
+            if bucket:
+                bucket.take()
+            ok = bool(send(phone, rec))
+        except Exception as e:
+            main.log.error(f"Campaign {phone}: {e}")
+            ok = False
+        finally:
+            window.release()
+        with lock:
+            jf.write(f"{phone}\t{int(ok)}\t{int(time.time())}\n")
+            jf.flush()                                  # survives a kill; fsync'd by the reporter
+            stats['sent' if ok else 'failed'] += 1
+
+    def report(final: bool = False):
+        with lock:
+            jf.flush()
+            os.fsync(jf.fileno())
+            s = dict(stats)
+        el = time.monotonic() - t0
+        print(f"{'done' if final else 'progress'} {el:7.1f}s  sent {s.get('sent', 0)}  failed {s.get('failed', 0)}  "
+              f"skipped {s.get('skipped', 0) + s.get('duplicate', 0)}  invalid {s.get('invalid', 0)}  "
+              f"{s.get('sent', 0) / el if el else 0:,.0f} msg/s", flush=True)
+
+    def reporter():
+        while not stop.wait(every):
+            report()
+
+    threading.Thread(target=reporter, name='campaign-report', daemon=True).start()
+    seen = set(done)
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='campaign') as ex:
+            for rec in recipients:
+                if stop.is_set():
+                    break
+                key = main.phone_key(rec.get('phone'))
+                if key is None:
+                    stats['invalid'] += 1
+                    continue
+                if key in seen:
+                    stats['skipped' if key in done else 'duplicate'] += 1
+                    continue
+                seen.add(key)
+                window.acquire()
+                ex.submit(one, f"+{key}", rec)
+    except KeyboardInterrupt:
+        print("interrupted — finishing in-flight sends; rerun the same command to resume", flush=True)
+    finally:
+        stop.set()
+        report(final=True)
+        jf.close()
+    return stats
+
+def cmd_campaign(args):
+    import main
+    t = main.tenant_for(args.tenant) if args.tenant else main.tenant()
+    if t is None:
+        print(f"unknown tenant {args.tenant}")
+        return 1
+    if args.csv:
+        recipients = csv_recipients(args.csv)
+    else:
+        gc = t.gc.get()
+        if not gc or not (args.sheet or t.sheet_id):
+            print("Sheets not configured (GOOGLE_SERVICE_ACCOUNT_KEY / GOOGLE_SHEET_ID)")
+            return 1
+        recipients = sheet_recipients(gc.open_by_key(args.sheet or t.sheet_id).worksheet(args.worksheet))
+    params  = _params(args.param)
+    journal = args.journal or f"campaign-{args.template}.journal"
+    send    = lambda phone, rec: main.template(phone[1:], args.template, args.language, params(rec))
+    print(f"campaign {args.template} ({args.language}) → journal {journal}, "
+          f"{args.workers} workers, {args.rate or 'tenant'} msg/s", flush=True)
+    stats = run_campaign(main, t, recipients, send, journal, args.workers, args.rate, args.every)
+    return 0 if not stats['failed'] else 2
+
+# ─────────────────────────────────────────────────────────────
+# ENTRY
+# ─────────────────────────────────────────────────────────────
+
+def main_cli(argv=None) -> int:
+    ap  = argparse.ArgumentParser(description='A Jewel Studio admin commands')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+
+    def window(p):
+        p.add_argument('--dir', default=ANALYTICS_DIR)
+        p.add_argument('--since', help='YYYY-MM-DD, inclusive')
+        p.add_argument('--until', help='YYYY-MM-DD, inclusive')
+        p.add_argument('--days', type=int, help='last N days (ignored with --since)')
+
+    p = sub.add_parser('summary', help='events per day and type')
+    window(p)
+    p.set_defaults(fn=cmd_summary)
+
+    p = sub.add_parser('funnel', help='messaged → menu → collection → order')
+    window(p)
+    p.add_argument('--json', action='store_true')
+    p.set_defaults(fn=cmd_funnel)
+
+    p = sub.add_parser('collections', help='opens and orders per collection')
+    window(p)
+    p.add_argument('--window', type=float, default=72, help='hours from open to order')
+    p.add_argument('--top', type=int, default=30)
+    p.add_argument('--json', action='store_true')
+    p.set_defaults(fn=cmd_collections)
+
+    p = sub.add_parser('dedup-sheets', help='E.164 phones + merge duplicate Registrations rows')
+    p.add_argument('--tenant', help='phone_number_id (default: the env tenant)')
+    p.add_argument('--sheet', help='spreadsheet id (default: the tenant\'s)')
+    p.add_argument('--worksheet', default='Registrations')
+    p.add_argument('--apply', action='store_true', help='write the result (default: dry run)')
+    p.set_defaults(fn=cmd_dedup_sheets)
+
+    p = sub.add_parser('campaign', help='send a template to a CSV or the Registrations sheet')
+    src = p.add_mutually_exclusive_group(required=True)
+    src.add_argument('--csv', help='file with a "phone" column (other columns feed --param)')
+    src.add_argument('--from-sheet', action='store_true', help='the tenant\'s Registrations sheet')
+    p.add_argument('--template', required=True, help='approved WhatsApp template name')
+    p.add_argument('--language', default='en', help='template language code')
+    p.add_argument('--param', action='append', default=[],
+                   help='column for the next body parameter, with an optional default: first_name:Customer')
+    p.add_argument('--journal', help='progress file (default: campaign-<template>.journal)')
+    p.add_argument('--workers', type=int, default=16)
+    p.add_argument('--rate', type=float, default=50, help='sends/second (0 = only the tenant limit)')
+    p.add_argument('--every', type=float, default=5, help='seconds between progress lines')
+    p.add_argument('--tenant', help='phone_number_id (default: the env tenant)')
+    p.add_argument('--sheet', help='spreadsheet id (default: the tenant\'s)')
+    p.add_argument('--worksheet', default='Registrations')
+    p.set_defaults(fn=cmd_campaign)
+
+    args = ap.parse_args(argv)
+    return args.fn(args)
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
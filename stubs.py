@@ -0,0 +1,598 @@
+# -*- coding: utf-8 -*-
+"""
+A JEWEL STUDIO — Local upstream stubs
+
+In-process fakes of every service the bot talks to, for bench.py:
+Graph API (messages, media, catalog products), Shopify, Google Sheets,
+Gemini, Razorpay and SMTP. Each stub listens on 127.0.0.1, counts hits
+per route, and can inject latency and errors.
+
+    stubs = Stubs(latency={'shopify': 0.2}, errors={'gemini': 0.1}).start()
+    os.environ.update(stubs.env())
+    import main
+    stubs.attach(main)
+"""
+
+import base64, hashlib, json, random, re, threading, time, zlib
+from datetime import datetime, timedelta, timezone
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingTCPServer, StreamRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+
+import requests
+
+# ─────────────────────────────────────────────────────────────
+# BASE
+# ─────────────────────────────────────────────────────────────
+
+class Stub:
+    name = ''
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        self.latency    = latency
+        self.error_rate = error_rate
+        self.hits       = Counter()
+        self._lock      = threading.Lock()
+        self._srv       = None
+
+    # -- injection -------------------------------------------------
+    def _inject(self, route: str) -> bool:
+        """Count the hit, sleep the configured latency; True = fail this call."""
+        with self._lock:
+            self.hits[route] += 1
+        if self.latency:
+            time.sleep(self.latency * random.uniform(0.5, 1.5))
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    @property
+    def calls(self) -> int:
+        with self._lock:
+            return sum(self.hits.values())
+
+    # -- lifecycle -------------------------------------------------
+    def start(self):
+        stub = self
+
+        class H(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True     # headers and body go out as separate writes
+
+            def _do(self, method):
+                u     = urlsplit(self.path)
+                query = {k: v[0] for k, v in parse_qs(u.query).items()}
+                size  = int(self.headers.get('Content-Length') or 0)
+                raw   = self.rfile.read(size) if size else b''
+                try:
+                    body = json.loads(raw) if raw else {}
+                except ValueError:
+                    body = {}
+                route, handler = stub.match(method, unquote(u.path))
+                hdrs = []
+                if handler is None:
+                    status, out = 404, {'error': {'message': 'no route'}}
+                elif stub._inject(route):
+                    status, out = 500, {'error': {'code': 'SERVER_ERROR',
+                                                  'message': 'injected failure',
+                                                  'description': 'injected failure'}}
+                else:
+                    status, out, *hdrs = handler(query, body, self.headers)
+                self._reply(status, out, hdrs[0] if hdrs else {})
+
+            def _reply(self, status, out, headers):
+                if isinstance(out, (bytes, bytearray)):
+                    data, ctype = bytes(out), 'image/jpeg'
+                else:
+                    data, ctype = json.dumps(out).encode(), 'application/json'
+                self.send_response(status)
+                self.send_header('Content-Type', ctype)
+                self.send_header('Content-Length', str(len(data)))
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                try:
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True    # the client timed out first
+
+            def handle(self):
+                try:
+                    super().handle()
+                except ConnectionResetError:
+                    pass                            # the client went away mid-request
+
+            def do_GET(self):  self._do('GET')
+            def do_POST(self): self._do('POST')
+            def do_PUT(self):  self._do('PUT')
+            def log_message(self, *a): pass
+
+        class S(ThreadingHTTPServer):
+            daemon_threads     = True
+            request_queue_size = 256    # listen backlog; threaded workers open many connections at once
+
+        self._srv = S(('127.0.0.1', 0), H)
+        threading.Thread(target=self._srv.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._srv:
+            self._srv.shutdown()
+            self._srv.server_close()
+
+    @property
+    def url(self) -> str:
+        host, port = self._srv.server_address[:2]
+        return f"http://{host}:{port}"
+
+    # -- routing ---------------------------------------------------
+    routes: list = []     # [(method, regex, route name, handler attr)]
+
+    def match(self, method: str, path: str):
+        for m, rx, route, attr in self.routes:
+            g = re.fullmatch(rx, path) if m == method else None
+            if g:
+                fn = getattr(self, attr)
+                return route, lambda q, b, h, g=g, fn=fn: fn(g, q, b, h)
+        return f"{method} {path}", None
+
+# ─────────────────────────────────────────────────────────────
+# GRAPH API — messages, media, catalog products
+# ─────────────────────────────────────────────────────────────
+
+def _jpeg(px: int = 64, shade: int = 0) -> bytes:
+    """A px-wide 4:3 JPEG; px > 64 adds noise so it compresses like a photo."""
+    try:
+        import io
+        from PIL import Image
+        buf = io.BytesIO()
+        img = Image.new('RGB', (px, px * 3 // 4 or 1), (212, 175 - shade % 100, 55 + shade % 100))
+        if px > 64:
+            img = Image.blend(img, Image.effect_noise(img.size, 48).convert('RGB'), 0.35)
+        img.save(buf, 'JPEG', quality=85)
+        return buf.getvalue()
+    except Exception:
+        return b'\xff\xd8\xff\xe0' + bytes([shade % 256]) * 1024 + b'\xff\xd9'
+
+class GraphStub(Stub):
+    name   = 'graph'
+    routes = [
+        ('POST', r'/(\w+)/messages',  'messages', 'messages'),
+        ('GET',  r'/media/(\w+)',     'media_dl', 'media_dl'),
+        ('GET',  r'/(\d+)/products',  'products', 'products'),
+        ('GET',  r'/([\w.-]+)',       'media',    'media'),
+    ]
+
+    def __init__(self, *a, products: int = 12, empty: set = (), images: int = 1,
+                 image_px: int = 64, **kw):
+        super().__init__(*a, **kw)
+        self.n_products = products
+        self.empty    = set(empty)
+        self.sent     = Counter()     # message type → count
+        self.senders  = Counter()     # phone_number_id → messages sent
+        self.last     = {}            # recipient → last message body
+        self.recipients = Counter()   # recipient → messages sent
+        self._n       = 0
+        self._imgs    = [_jpeg(image_px, i) for i in range(images)]   # media id → one of these
+
+    def messages(self, g, q, body, h):
+        with self._lock:
+            self._n += 1
+            self.sent[body.get('type', '?')] += 1
+            self.senders[g.group(1)] += 1
+            wamid = f"wamid.STUB{self._n:012d}"
+            to    = body.get('to', '')
+            self.last[to] = body
+            self.recipients[to] += 1
+        return 200, {'messaging_product': 'whatsapp',
+                     'contacts': [{'input': to, 'wa_id': to}],
+                     'messages': [{'id': wamid}]}
+
+    def products(self, g, q, body, h):
+        cid = g.group(1)
+        n   = 0 if cid in self.empty else min(self.n_products, int(q.get('limit', 30)))
+        return 200, {'data': [{'retailer_id': f"{cid[-6:]}-{i}", 'id': f"{cid}{i}"}
+                              for i in range(n)]}
+
+    def image(self, mid: str) -> bytes:
+        return self._imgs[zlib.crc32(mid.encode()) % len(self._imgs)]
+
+    def media(self, g, q, body, h):
+        mid = g.group(1)
+        img = self.image(mid)
+        return 200, {'url': f"{self.url}/media/{mid}", 'mime_type': 'image/jpeg',
+                     'sha256': hashlib.sha256(img).hexdigest(), 'file_size': len(img), 'id': mid}
+
+    def media_dl(self, g, q, body, h):
+        return 200, self.image(g.group(1))
+
+# ─────────────────────────────────────────────────────────────
+# SHOPIFY
+# Customers are synthesised from the phone number: last digit 0 → unknown,
+# 1 → B2B, anything else → retail.
+# ─────────────────────────────────────────────────────────────
+
+_IST = timezone(timedelta(hours=5, minutes=30))
+
+def stub_customer(phone: str) -> dict | None:
+    digits = re.sub(r'\D', '', phone)
+    if not digits or digits[-1] == '0':
+        return None
+    return {
+        'id':         int(digits[-9:]),
+        'first_name': f"Cust{digits[-4:]}",
+        'phone':      f"+{digits}",
+        'tags':       'B2B, Gold' if digits[-1] == '1' else 'Retail',
+        'updated_at': '2024-01-01T00:00:00+05:30',
+    }
+
+def _shopify_time(ts: float) -> str:
+    return datetime.fromtimestamp(ts, _IST).isoformat(timespec='seconds')
+
+class ShopifyStub(Stub):
+    """
+    Customer search, plus a customer population for customers.json:
+    cursor pagination via Link/page_info, updated_at_min and fields.
+    With no population loaded, search answers by stub_customer()'s
+    phone rule; with one, only from the population.
+    """
+    name   = 'shopify'
+    routes = [
+        ('GET', r'/customers/search\.json', 'customers_search', 'search'),
+        ('GET', r'/customers\.json',        'customers_list',   'customers'),
+    ]
+
+    def __init__(self, *a, customers: int = 0, **kw):
+        super().__init__(*a, **kw)
+        self.people: dict   = {}    # id → [id, phone, first_name, tags, updated_at epoch]
+        self.order: list    = []    # ids, ascending
+        self.by_phone: dict = {}    # '+91…' → id
+        self._next_id = 10**10
+        if customers:
+            self.generate(customers)
+
+    # -- population ------------------------------------------------
+    def _put(self, cid: int, phone: str, first_name: str, tags: str, ts: float = None):
+        with self._lock:
+            if cid not in self.people:
+                self.order.append(cid)
+            old = self.people.get(cid)
+            if old and self.by_phone.get(old[1]) == cid:
+                del self.by_phone[old[1]]
+            self.people[cid] = [cid, phone, first_name, tags, time.time() if ts is None else ts]
+            if phone:
+                self.by_phone[phone] = cid
+
+    def generate(self, n: int, seed: int = 7):
+        rnd   = random.Random(seed)
+        names = ['Aarti', 'Priya', 'Neha', 'Rahul', 'Amit', 'Kavya', 'Isha', 'Rohan',
+                 'Sneha', 'Vikram', 'Pooja', 'Arjun', 'Meera', 'Karan', 'Anjali', 'Dev']
+        t0 = time.time() - 86400 * 365
+        for i in range(n):
+            self._put(self._next_id + i, f"+9177{i:08d}", rnd.choice(names),
+                      'B2B, Gold' if rnd.random() < 0.1 else 'Retail', t0 + i)
+        self._next_id += n
+        self.order.sort()
+
+    def seed(self, phones):
+        """Add stub_customer(phone) for each phone, so the index agrees with live search."""
+        for p in phones:
+            c = stub_customer(p)
+            if c and c['phone'] not in self.by_phone:
+                self._put(c['id'], c['phone'], c['first_name'], c['tags'], 0.0)
+        self.order.sort()
+
+    def add(self, phone: str, first_name: str, tags: str = '') -> int:
+        cid = self._next_id
+        self._next_id += 1
+        self._put(cid, phone, first_name, tags)
+        return cid
+
+    def update(self, cid: int, **fields):
+        _, phone, first_name, tags, _ = self.people[cid]
+        self._put(cid, fields.get('phone', phone), fields.get('first_name', first_name),
+                  fields.get('tags', tags))
+
+    def customer(self, cid: int) -> dict:
+        cid, phone, first_name, tags, ts = self.people[cid]
+        return {'id': cid, 'phone': phone, 'first_name': first_name, 'tags': tags,
+                'updated_at': _shopify_time(ts)}
+
+    # -- handlers --------------------------------------------------
+    def search(self, g, q, body, h):
+        m = re.match(r'phone:(.+)', q.get('query', ''))
+        if not m:
+            return 200, {'customers': []}
+        if self.people:
+            digits = re.sub(r'\D', '', m.group(1))
+            cid    = self.by_phone.get(f"+{digits}")
+            return 200, {'customers': [self.customer(cid)] if cid else []}
+        c = stub_customer(m.group(1))
+        return 200, {'customers': [c] if c else []}
+
+    def customers(self, g, q, body, h):
+        limit = min(250, int(q.get('limit', 50)))
+        if 'page_info' in q:
+            cur   = json.loads(base64.urlsafe_b64decode(q['page_info']))
+            pos, since = cur['pos'], cur['since']
+            fields = cur['fields']
+        else:
+            pos, fields = 0, q.get('fields', '')
+            since = (datetime.fromisoformat(q['updated_at_min']).timestamp()
+                     if q.get('updated_at_min') else None)
+        out = []
+        with self._lock:
+            ids = self.order
+            while pos < len(ids) and len(out) < limit:
+                c = self.people[ids[pos]]
+                pos += 1
+                if since is None or c[4] >= since:
+                    out.append(c)
+            more = pos < len(ids)
+        keep  = set(filter(None, fields.split(',')))
+        rows  = []
+        for cid, phone, first_name, tags, ts in out:
+            c = {'id': cid, 'phone': phone, 'first_name': first_name, 'tags': tags,
+                 'updated_at': _shopify_time(ts)}
+            rows.append({k: v for k, v in c.items() if k in keep} if keep else c)
+        headers = {}
+        if more:
+            token = base64.urlsafe_b64encode(json.dumps(
+                {'pos': pos, 'since': since, 'fields': fields}).encode()).decode()
+            headers['Link'] = f'<{self.url}/customers.json?limit={limit}&page_info={token}>; rel="next"'
+        return 200, {'customers': rows}, headers
+
+# ─────────────────────────────────────────────────────────────
+# GOOGLE SHEETS — enough of the v4 values API for gspread
+# ─────────────────────────────────────────────────────────────
+
+def _col_index(letters: str) -> int:
+    n = 0
+    for ch in letters:
+        n = n * 26 + (ord(ch) - 64)
+    return n
+
+class SheetsStub(Stub):
+    name   = 'sheets'
+    routes = [
+        ('GET',  r'/v4/spreadsheets/([\w-]+)',                 'metadata',     'metadata'),
+        ('GET',  r'/v4/spreadsheets/([\w-]+)/values/(.+)',     'values_get',   'values_get'),
+        ('POST', r'/v4/spreadsheets/([\w-]+)/values/(.+):append', 'values_append', 'values_append'),
+        ('PUT',  r'/v4/spreadsheets/([\w-]+)/values/(.+)',     'values_update', 'values_update'),
+        ('POST', r'/v4/spreadsheets/([\w-]+)/values:batchClear', 'values_clear', 'values_clear'),
+    ]
+
+    def __init__(self, *a, rows: list = None, **kw):
+        super().__init__(*a, **kw)
+        self.rows = list(rows or [])
+
+    def metadata(self, g, q, body, h):
+        return 200, {'spreadsheetId': g.group(1), 'properties': {'title': 'Stub'},
+                     'sheets': [{'properties': {
+                         'sheetId': 0, 'title': 'Registrations', 'index': 0,
+                         'gridProperties': {'rowCount': max(1000, len(self.rows)),
+                                            'columnCount': 26}}}]}
+
+    def _range(self, a1: str):
+        a1 = a1.split('!')[-1]
+        m  = re.fullmatch(r'([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?', a1)
+        c0, r0, c1, r1 = m.groups() if m else ('', '', '', '')
+        return (_col_index(c0) if c0 else 1, int(r0) if r0 else 1,
+                _col_index(c1) if c1 else None, int(r1) if r1 else None)
+
+    def values_get(self, g, q, body, h):
+        c0, r0, c1, r1 = self._range(g.group(2))
+        with self._lock:
+            rows = [r[c0 - 1:c1] for r in self.rows[r0 - 1:r1]]
+        if q.get('majorDimension') == 'COLUMNS':
+            width = max((len(r) for r in rows), default=0)
+            cols  = [[r[i] if i < len(r) else '' for r in rows] for i in range(width)]
+            for col in cols:
+                while col and col[-1] == '':
+                    col.pop()
+            rows = cols
+        out = {'range': g.group(2), 'majorDimension': q.get('majorDimension', 'ROWS')}
+        if any(rows):
+            out['values'] = rows      # the real API omits empty values
+        return 200, out
+
+    def values_append(self, g, q, body, h):
+        with self._lock:
+            self.rows.extend([str(v) for v in row] for row in body.get('values', []))
+            n = len(self.rows)
+        return 200, {'spreadsheetId': g.group(1),
+                     'updates': {'updatedRange': f"Registrations!A{n}", 'updatedRows': 1}}
+
+    def values_update(self, g, q, body, h):
+        c0, r0, _, _ = self._range(g.group(2))
+        values = body.get('values', [])
+        with self._lock:
+            for i, row in enumerate(values):
+                r = r0 - 1 + i
+                while len(self.rows) <= r:
+                    self.rows.append([])
+                cur = self.rows[r]
+                cur.extend([''] * (c0 - 1 + len(row) - len(cur)))
+                cur[c0 - 1:c0 - 1 + len(row)] = [str(v) for v in row]
+        return 200, {'spreadsheetId': g.group(1), 'updatedRange': g.group(2),
+                     'updatedRows': len(values)}
+
+    def values_clear(self, g, q, body, h):
+        with self._lock:
+            for a1 in body.get('ranges', []):
+                c0, r0, c1, r1 = self._range(a1)
+                for r in range(r0 - 1, min(r1 or len(self.rows), len(self.rows))):
+                    row = self.rows[r]
+                    for c in range(c0 - 1, min(c1 or len(row), len(row))):
+                        row[c] = ''
+            while self.rows and not any(self.rows[-1]):
+                self.rows.pop()
+        return 200, {'spreadsheetId': g.group(1), 'clearedRanges': body.get('ranges', [])}
+
+    def client(self, factory=None):
+        """A real gspread client (or factory's subclass) whose requests are redirected to this stub."""
+        import gspread
+        base = self.url
+
+        class _Session(requests.Session):
+            def request(self, method, url, *a, **kw):
+                url = url.replace('https://sheets.googleapis.com', base)
+                return super().request(method, url, *a, **kw)
+
+        return (factory or gspread.Client)(None, session=_Session())
+
+# ─────────────────────────────────────────────────────────────
+# GEMINI — generateContent over the REST transport
+# ─────────────────────────────────────────────────────────────
+
+class GeminiStub(Stub):
+    name   = 'gemini'
+    routes = [
+        ('POST', r'/v1beta/models/([\w.-]+):generateContent', 'generate', 'generate'),
+    ]
+
+    TEXT   = "Aapke liye hamari Traditional Jhumka collection perfect rahegi."
+    VISION = "A traditional gold jhumka earring with bridal detailing."
+
+    def generate(self, g, q, body, h):
+        parts  = [p for c in body.get('contents', []) for p in c.get('parts', [])]
+        vision = any('inline_data' in p or 'inlineData' in p for p in parts)
+        return 200, {'candidates': [{
+            'content': {'parts': [{'text': self.VISION if vision else self.TEXT}],
+                        'role': 'model'},
+            'finishReason': 'STOP', 'index': 0}]}
+
+# ─────────────────────────────────────────────────────────────
+# RAZORPAY
+# ─────────────────────────────────────────────────────────────
+
+class RazorpayStub(Stub):
+    name   = 'razorpay'
+    routes = [
+        ('POST', r'/v1/payment_links/?', 'payment_links', 'payment_link'),
+    ]
+
+    def payment_link(self, g, q, body, h):
+        with self._lock:
+            n = self.hits['payment_links']
+        return 200, {'id': f"plink_stub{n}", 'amount': body.get('amount'),
+                     'status': 'created', 'short_url': f"https://rzp.io/i/stub{n}",
+                     'notes': body.get('notes', {})}
+
+# ─────────────────────────────────────────────────────────────
+# SMTP — plain-text, AUTH accepted, mail discarded
+# ─────────────────────────────────────────────────────────────
+
+class SmtpStub(Stub):
+    name = 'smtp'
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.mails = 0
+        self.last  = ''       # last message accepted, as sent
+
+    def start(self):
+        stub = self
+
+        class H(StreamRequestHandler):
+            def handle(self):
+                w = lambda line: self.wfile.write(line.encode() + b'\r\n')
+                w('220 stub ESMTP')
+                in_data, data = False, []
+                for raw in self.rfile:
+                    line = raw.decode(errors='replace').rstrip('\r\n')
+                    if in_data:
+                        if line == '.':
+                            in_data = False
+                            if stub._inject('data'):
+                                w('451 injected failure')
+                            else:
+                                with stub._lock:
+                                    stub.mails += 1
+                                    stub.last = '\n'.join(data)
+                                w('250 OK queued')
+                        else:
+                            data.append(line)
+                        continue
+                    cmd = line[:4].upper()
+                    if cmd in ('EHLO', 'HELO'):
+                        w('250-stub'); w('250-AUTH PLAIN LOGIN'); w('250 OK')
+                    elif cmd == 'AUTH':
+                        w('235 Authentication successful')
+                    elif cmd == 'DATA':
+                        in_data, data = True, []
+                        w('354 End data with <CR><LF>.<CR><LF>')
+                    elif cmd == 'QUIT':
+                        w('221 Bye'); return
+                    else:
+                        w('250 OK')
+
+        class S(ThreadingTCPServer):
+            daemon_threads      = True
+            allow_reuse_address = True
+
+        self._srv = S(('127.0.0.1', 0), H)
+        threading.Thread(target=self._srv.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def url(self) -> str:
+        host, port = self._srv.server_address[:2]
+        return f"{host}:{port}"
+
+# ─────────────────────────────────────────────────────────────
+# ALL STUBS
+# ─────────────────────────────────────────────────────────────
+
+class Stubs:
+    KINDS = {'graph': GraphStub, 'shopify': ShopifyStub, 'sheets': SheetsStub,
+             'gemini': GeminiStub, 'razorpay': RazorpayStub, 'smtp': SmtpStub}
+
+    def __init__(self, latency: dict = None, errors: dict = None, **options):
+        latency, errors = latency or {}, errors or {}
+        self.all = {name: cls(latency.get(name, 0.0), errors.get(name, 0.0),
+                              **options.get(name, {}))
+                    for name, cls in self.KINDS.items()}
+        for name, stub in self.all.items():
+            setattr(self, name, stub)
+
+    def start(self):
+        for stub in self.all.values():
+            stub.start()
+        return self
+
+    def stop(self):
+        for stub in self.all.values():
+            stub.stop()
+
+    def calls(self) -> dict:
+        return {name: stub.calls for name, stub in self.all.items()}
+
+    def env(self) -> dict:
+        """Environment for main.py — must be applied before it is imported."""
+        smtp_host, smtp_port = self.smtp.url.split(':')
+        return {
+            'WHATSAPP_TOKEN':       'stub-token',
+            'WHATSAPP_PHONE_ID':    '100000000000001',
+            'WHATSAPP_CATALOG_ID':  'stub-catalog',
+            'GRAPH_API_BASE':       self.graph.url,
+            'SHOPIFY_ACCESS_TOKEN': 'stub-token',
+            'SHOPIFY_API_BASE':     self.shopify.url,
+            'GOOGLE_SHEET_ID':      'stub-sheet',
+            'RAZORPAY_KEY_ID':      'rzp_test_stub',
+            'RAZORPAY_KEY_SECRET':  'stub',
+            'RAZORPAY_API_BASE':    self.razorpay.url,
+            'GMAIL_USER':           'bot@stub.local',
+            'GMAIL_PASSWORD':       'stub',
+            'SMTP_HOST':            smtp_host,
+            'SMTP_PORT':            smtp_port,
+            'SMTP_SSL':             '0',
+        }
+
+    def attach(self, main):
+        """Point the SDK-backed clients (Sheets, Gemini) of an imported main at the stubs."""
+        import google.generativeai as genai
+        genai.configure(api_key='stub', transport='rest',
+                        client_options={'api_endpoint': self.gemini.url})
+        main._gc.factory = lambda: self.sheets.client(main.sheets_client_class())   # one per pooled client, as in production
+        main._gm.set(genai.GenerativeModel('gemini-pro'))
+        main._gv.set(genai.GenerativeModel('gemini-pro-vision'))
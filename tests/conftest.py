@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""Unit tests import main.py with no upstream credentials and scratch storage."""
+
+import os, sys, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Never talk to real upstreams from a test.
+for _k in ('WHATSAPP_TOKEN', 'SHOPIFY_ACCESS_TOKEN', 'GOOGLE_SERVICE_ACCOUNT_KEY',
+           'RAZORPAY_KEY_ID', 'GEMINI_API_KEY', 'GMAIL_USER', 'CLUSTER_NODES'):
+    os.environ.pop(_k, None)
+os.environ.setdefault('ANALYTICS_DIR', tempfile.mkdtemp(prefix='test-analytics-'))
+os.environ.setdefault('ORDERS_DB', os.path.join(tempfile.mkdtemp(prefix='test-orders-'), 'orders.db'))
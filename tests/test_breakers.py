@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+import main
+
+
+def test_slow_success_within_its_timeout_keeps_the_breaker_closed(monkeypatch):
+    monkeypatch.setattr(main, 'MSG_BUDGET_S', 8.0)
+    b = main.Breaker('gemini')
+    for _ in range(main.BREAKER_WINDOW):
+        b.record(False, 6.0, cap=10)
+    assert b.state == 'closed'
+    assert b.snapshot()['slow'] == 0
+
+
+def test_calls_near_their_timeout_are_slow(monkeypatch):
+    monkeypatch.setattr(main, 'MSG_BUDGET_S', 0.0)
+    b = main.Breaker('gemini')
+    for _ in range(main.BREAKER_MIN_CALLS):
+        b.record(False, 9.0, cap=10)
+    assert b.state == 'open'
+
+
+def _fail(b, n):
+    for _ in range(n):
+        b.record(True, 0.1)
+
+
+def test_opens_on_errors_once_it_has_enough_calls():
+    b = main.Breaker('shopify')
+    _fail(b, main.BREAKER_MIN_CALLS - 1)
+    assert b.state == 'closed'
+    _fail(b, 1)
+    assert b.state == 'open'
+    assert not b.allow()
+
+
+def test_half_open_lets_one_probe_through_and_closes_on_success(monkeypatch):
+    monkeypatch.setattr(main, 'BREAKER_OPEN_S', 0.0)
+    b = main.Breaker('shopify')
+    _fail(b, main.BREAKER_MIN_CALLS)
+    assert b.allow()
+    assert b.state == 'half_open'
+    assert not b.allow()                  # one probe at a time
+    b.record(False, 0.1)
+    assert b.state == 'closed'
+    assert b.snapshot()['calls'] == 0
+
+
+def test_failed_probe_opens_it_again(monkeypatch):
+    monkeypatch.setattr(main, 'BREAKER_OPEN_S', 0.0)
+    b = main.Breaker('shopify')
+    _fail(b, main.BREAKER_MIN_CALLS)
+    assert b.allow()
+    b.record(True, 0.1)
+    assert b.state == 'open'
+    assert b.trips == 2
+
+
+def _timeout(b, cut):
+    with pytest.raises(TimeoutError):
+        with b.call():
+            main._tls.cut, main._tls.cap = cut, 10
+            time.sleep(cut)
+            raise TimeoutError
+
+
+def test_a_timeout_the_budget_cut_short_is_not_held_against_the_upstream():
+    b = main.Breaker('gemini')
+    for _ in range(main.BREAKER_MIN_CALLS):
+        _timeout(b, 0.01)
+    assert b.state == 'closed'
+    assert b.snapshot()['calls'] == 0
+
+
+def test_a_budget_cut_timeout_past_the_fair_mark_counts(monkeypatch):
+    monkeypatch.setattr(main, 'BREAKER_FAIR_S', 0.005)
+    b = main.Breaker('gemini')
+    for _ in range(main.BREAKER_MIN_CALLS):
+        _timeout(b, 0.01)
+    assert b.state == 'open'
+
+
+def test_a_cut_probe_may_be_tried_again(monkeypatch):
+    monkeypatch.setattr(main, 'BREAKER_OPEN_S', 0.0)
+    b = main.Breaker('gemini')
+    _fail(b, main.BREAKER_MIN_CALLS)
+    _timeout(b, 0.01)
+    assert b.state == 'half_open'
+    assert b.allow()
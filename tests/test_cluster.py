@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import main
+
+PEER = 'http://peer.invalid'
+
+
+@pytest.fixture
+def down(monkeypatch):
+    """Peers marked down by forward()."""
+    marked = []
+    monkeypatch.setattr(main, '_peer_down', marked.append)
+    return marked
+
+
+def _answer(monkeypatch, result):
+    def post(node, path, raw, timeout, headers=None):
+        if isinstance(result, Exception):
+            raise result
+        return SimpleNamespace(ok=result)
+    monkeypatch.setattr(main, '_cluster_post', post)
+
+
+def test_accepted_part_is_left_to_the_owner(monkeypatch, down):
+    _answer(monkeypatch, True)
+    assert main.forward(PEER, '/webhook', b'{}')
+    assert down == []
+
+
+def test_unreachable_owner_is_marked_down_and_the_part_handled_here(monkeypatch, down):
+    _answer(monkeypatch, requests.exceptions.ConnectionError('refused'))
+    assert not main.forward(PEER, '/webhook', b'{}')
+    assert down == [PEER]
+
+
+def test_connect_timeout_counts_as_unreachable(monkeypatch, down):
+    _answer(monkeypatch, requests.exceptions.ConnectTimeout('no answer to SYN'))
+    assert not main.forward(PEER, '/webhook', b'{}')
+    assert down == [PEER]
+
+
+def test_late_answer_is_left_to_the_owner(monkeypatch, down):
+    _answer(monkeypatch, requests.exceptions.ReadTimeout('late'))
+    assert main.forward(PEER, '/webhook', b'{}')
+    assert down == []
+
+
+def test_refused_part_is_handled_here_without_marking_the_owner_down(monkeypatch, down):
+    _answer(monkeypatch, False)                 # a 503 from an overloaded owner
+    assert not main.forward(PEER, '/webhook', b'{}')
+    assert down == []
+
+
+def test_fallback_keeps_only_the_parts_not_taken():
+    def done(ok):
+        f = Future()
+        f.set_result(ok)
+        return f
+    pending = [({'part': 1}, done(True)), ({'part': 2}, done(False))]
+    assert main.cluster_fallback(pending) == [{'part': 2}]
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+class _NoCustomers:
+    """A customers.json page with nothing on it, for the index's loader thread."""
+    status_code = 200
+    headers     = {}
+    links       = {}
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {'customers': []}
+
+
+@pytest.fixture
+def idx():
+    t = SimpleNamespace(name='test', shopify_api='http://shop.invalid', shopify_token='x',
+                        http=SimpleNamespace(get=lambda *a, **kw: _NoCustomers()))
+    i = main.CustomerIndex(t)
+    i.ready = True
+    return i
+
+
+def _c(cid, phone, name='Asha', tags=''):
+    return {'id': cid, 'phone': phone, 'first_name': name, 'tags': tags}
+
+
+def test_add_update_remove(idx):
+    idx.apply(_c(1, '+919812345678'))
+    assert idx.lookup('919812345678') == {'exists': True, 'first_name': 'Asha', 'b2b': False}
+    idx.apply(_c(1, '+919812345679', tags='Wholesale'))
+    assert idx.lookup('919812345678') == {'exists': False}
+    assert idx.lookup('919812345679') == {'exists': True, 'first_name': 'Asha', 'b2b': True}
+    idx.remove(1)
+    assert idx.lookup('919812345679') == {'exists': False}
+    assert not idx.owners and not idx.b2b_ids
+
+
+def test_shared_phone_is_dropped_with_its_last_customer(idx):
+    idx.apply(_c(1, '+919812345678', 'Asha'))
+    idx.apply(_c(2, '+919812345678', 'Ravi'))
+    idx.remove(1)
+    assert idx.lookup('919812345678')['exists']
+    idx.apply(_c(2, '+919812345600', 'Ravi'))
+    assert idx.lookup('919812345678') == {'exists': False}
+    assert idx.lookup('919812345600')['first_name'] == 'Ravi'
+
+
+def test_shared_phone_is_b2b_if_any_customer_is(idx):
+    idx.apply(_c(1, '+919812345678', tags='b2b'))
+    idx.apply(_c(2, '+919812345678'))
+    assert idx.lookup('919812345678')['b2b']
+    idx.apply(_c(1, '+919812345678', tags=''))
+    assert not idx.lookup('919812345678')['b2b']
+    idx.apply(_c(2, '+919812345678', tags='wholesale'))
+    idx.remove(2)
+    assert not idx.lookup('919812345678')['b2b']
+    assert idx.lookup('919812345678')['exists']
+
+
+def test_registration_is_reused_until_it_expires(idx, monkeypatch):
+    calls = []
+    def lookup(phone):
+        calls.append(phone)
+        return {'exists': False}
+    monkeypatch.setattr(main, 'sheets_lookup', lookup)
+    assert idx.registration('919812345678') == {'exists': False}
+    assert idx.registration('919812345678') == {'exists': False}
+    assert len(calls) == 1
+    monkeypatch.setattr(main, 'SHEETS_TTL_S', 0.0)
+    idx.registration('919812345678')
+    assert len(calls) == 2
+
+
+def test_failed_registration_lookup_is_not_kept(idx, monkeypatch):
+    calls = []
+    def lookup(phone):
+        calls.append(phone)
+        return {'exists': False, 'failed': True}
+    monkeypatch.setattr(main, 'sheets_lookup', lookup)
+    idx.registration('919812345678')
+    idx.registration('919812345678')
+    assert len(calls) == 2